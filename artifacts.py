@@ -0,0 +1,138 @@
+"""
+Compressed storage for generated meshes under exports/.
+
+Pixel-extruded STLs are mostly repeated facets and shrink several times under
+gzip, so `store()` replaces a finished STL with `<name>.stl.gz`. Everything
+else keeps using the logical path (`.../name.stl`), as it appears in the
+orders table: `locate()` finds whichever form is stored, so uncompressed
+files from before this change keep working. Reads go through storage.py, so
+the same paths work on local disk and on S3.
+
+    ARTIFACT_COMPRESSION=gzip|none   (default gzip)
+    ARTIFACT_GZIP_LEVEL=6
+"""
+
+import os
+import gzip
+import shutil
+import logging
+
+import metrics
+import storage
+
+ARTIFACT_COMPRESSION = os.environ.get("ARTIFACT_COMPRESSION", "gzip").lower()
+ARTIFACT_GZIP_LEVEL = int(os.environ.get("ARTIFACT_GZIP_LEVEL", "6"))
+COMPRESSED_SUFFIX = ".gz"
+COMPRESSIBLE_EXTENSIONS = (".stl",)
+CHUNK_SIZE = 256 * 1024
+
+
+def locate(path):
+    """Return (stored_path, compressed) for a logical path, or (None, False) if missing."""
+    if storage.exists(path):
+        return path, path.endswith(COMPRESSED_SUFFIX)
+    if storage.exists(path + COMPRESSED_SUFFIX):
+        return path + COMPRESSED_SUFFIX, True
+    return None, False
+
+
+def exists(path):
+    return locate(path)[0] is not None
+
+
+def store(path):
+    """Compress a freshly written local artifact in place; returns the stored path.
+
+    The compressed copy is written to a temp file and renamed over, so readers
+    see either the plain file or the complete .gz, never a partial one.
+    """
+    if ARTIFACT_COMPRESSION != "gzip" or not path.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+        return path
+    target = path + COMPRESSED_SUFFIX
+    tmp = target + ".tmp"
+    try:
+        with open(path, "rb") as src, gzip.open(tmp, "wb", compresslevel=ARTIFACT_GZIP_LEVEL) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp, target)
+    except Exception as e:
+        logging.warning(f"Could not compress {path}, keeping it uncompressed: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return path
+    original, stored = os.path.getsize(path), os.path.getsize(target)
+    os.remove(path)
+    metrics.inc("artifact_bytes_saved_total", original - stored)
+    logging.info(f"Compressed {os.path.basename(path)}: {original} -> {stored} bytes")
+    return target
+
+
+class _GzipStream(gzip.GzipFile):
+    """Decompressing reader that also closes the underlying stream."""
+
+    def __init__(self, raw):
+        super().__init__(fileobj=raw, mode="rb")
+        self._raw = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+
+def open_artifact(path, offset=0):
+    """Binary reader over the original (uncompressed) bytes of a logical path, from `offset` on."""
+    stored, compressed = locate(path)
+    if stored is None:
+        raise FileNotFoundError(path)
+    if not compressed:
+        return storage.open_stream(stored, offset)
+    f = _GzipStream(storage.open_stream(stored))
+    if offset:
+        f.seek(offset)  # Forward seeks decompress and discard; no seek on the raw stream
+    return f
+
+
+def size(path):
+    """Uncompressed size in bytes of a logical path."""
+    stored, compressed = locate(path)
+    if stored is None:
+        raise FileNotFoundError(path)
+    if not compressed:
+        return storage.size(stored)
+    return int.from_bytes(storage.tail(stored, 4), "little")  # gzip ISIZE trailer (size mod 2**32)
+
+
+def _iter(opener):
+    with opener() as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_stored(stored_path):
+    """Stream a stored file's bytes as they are (still gzipped for .gz)."""
+    return _iter(lambda: storage.open_stream(stored_path))
+
+
+def iter_decompressed(stored_path):
+    """Stream a .gz artifact's contents for clients that don't accept gzip."""
+    return _iter(lambda: _GzipStream(storage.open_stream(stored_path)))
+
+
+def compress_tree(root):
+    """Compress every uncompressed mesh under a local `root`; returns (files, bytes_saved)."""
+    files = saved = 0
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            if not name.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            before = os.path.getsize(path)
+            stored = store(path)
+            if stored != path:
+                files += 1
+                saved += before - os.path.getsize(stored)
+    return files, saved
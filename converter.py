@@ -4,6 +4,11 @@ from stl import mesh
 import os
 import logging
 
+import metrics
+
+# Triangle counts for the stamp meshes; a full 1000px logo lands near the top
+TRIANGLE_BUCKETS = (1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2e6, 5e6)
+
 class LogoConverter:
     def __init__(self):
         self.target_size = (1000, 1000) # Standardize processing resolution
@@ -60,7 +65,8 @@ class LogoConverter:
         """
         try:
             # 1. Get binary masks
-            logo_mask = self.process_image(image_path)
+            with metrics.timer("conversion_stage_seconds", stage="mask"):
+                logo_mask = self.process_image(image_path)
             
             # 2. Resize to printable resolution (~1000px max dim for High Fidelity)
             # 1000px on 60mm = 0.06mm/pixel (very high quality)
@@ -97,18 +103,22 @@ class LogoConverter:
             pixel_scale = 60.0 / max(logo_mask.shape)
             
             logging.info("Generating Base Mesh...")
-            base_mesh = self.mask_to_mesh(base_mask, 0.0, self.stamp_thickness, pixel_scale)
+            with metrics.timer("conversion_stage_seconds", stage="base_mesh"):
+                base_mesh = self.mask_to_mesh(base_mask, 0.0, self.stamp_thickness, pixel_scale)
             
             logging.info("Generating Logo Relief Mesh...")
             # Logo sits ON TOP of base (start_z = stamp_thickness)
-            logo_mesh = self.mask_to_mesh(logo_mask, self.stamp_thickness, self.stamp_thickness + self.relief_height, pixel_scale)
+            with metrics.timer("conversion_stage_seconds", stage="relief_mesh"):
+                logo_mesh = self.mask_to_mesh(logo_mask, self.stamp_thickness, self.stamp_thickness + self.relief_height, pixel_scale)
             
             # 5. Combine and Save
             # Concatenate data
             combined_data = np.concatenate([base_mesh.data, logo_mesh.data])
             combined_mesh = mesh.Mesh(combined_data)
+            metrics.observe("conversion_triangles", len(combined_data), buckets=TRIANGLE_BUCKETS)
             
-            combined_mesh.save(output_path)
+            with metrics.timer("conversion_stage_seconds", stage="save"):
+                combined_mesh.save(output_path)
             logging.info(f"STL Saved: {output_path}")
             
         except Exception as e:
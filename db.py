@@ -0,0 +1,430 @@
+"""
+Database connections for the orders store (PostgreSQL or SQLite).
+
+PostgreSQL connections come from a process-local pool, so a request reuses an
+open session instead of paying the TCP/TLS/auth handshake every time. Every
+connection handed out is wrapped in `Connection`, which works as a context
+manager (commit on success, rollback on error, always released) and still
+supports the older explicit `conn.close()` style. Its cursors time every
+statement through querylog.py (slow-query log, queries per request).
+"""
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+import metrics
+import querylog
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+USE_POSTGRES = DATABASE_URL is not None
+DB_FILE = "orders.db"
+
+# Pool sizing is per worker process: keep DB_POOL_MAX * workers under the
+# server's connection limit.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "4"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))  # Seconds to wait for a free connection
+DB_POOL_CHECK_INTERVAL = float(os.environ.get("DB_POOL_CHECK_INTERVAL", "30"))  # Ping connections idle longer than this
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", "5"))
+
+# SQLite tuning: WAL lets readers run alongside the single writer, and the busy
+# timeout makes concurrent writers queue instead of failing with "database is locked".
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")  # Durable in WAL mode except on power loss
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "10000"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+if USE_POSTGRES:
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    logging.info("🐘 Using PostgreSQL database")
+else:
+    logging.info("📁 Using SQLite database (local dev)")
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the pool timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of DB-API connections.
+
+    `connect` opens a new raw connection. Connections idle for longer than
+    `check_interval` are pinged with `SELECT 1` before reuse and replaced if
+    the ping fails.
+    """
+
+    def __init__(self, connect, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 timeout=DB_POOL_TIMEOUT, check_interval=DB_POOL_CHECK_INTERVAL, name="postgres"):
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.name = name
+        self._idle = []  # (raw_conn, last_used)
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        return len(self._idle) + self._in_use
+
+    def _publish(self):
+        metrics.set_gauge("db_pool_in_use", self._in_use, pool=self.name)
+        metrics.set_gauge("db_pool_idle", len(self._idle), pool=self.name)
+        metrics.set_gauge("db_pool_saturation", self._in_use / self.maxconn, mode="max", pool=self.name)
+
+    def _open(self):
+        with metrics.timer("db_connect_seconds", pool=self.name):
+            conn = self._connect()
+        metrics.inc("db_pool_connects_total", pool=self.name)
+        return conn
+
+    def _healthy(self, conn, last_used):
+        if getattr(conn, "closed", False):
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logging.warning(f"Discarding stale {self.name} connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        metrics.inc("db_pool_discarded_total", pool=self.name)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def fill(self):
+        """Open connections up to `minconn`."""
+        with self._cond:
+            while self.size < self.minconn:
+                self._idle.append((self._open(), time.monotonic()))
+            self._publish()
+
+    def getconn(self):
+        """Check out a raw connection, waiting up to `timeout` seconds."""
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        conn = last_used = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self.size < self.maxconn:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.inc("db_pool_timeouts_total", pool=self.name)
+                    raise PoolTimeout(f"No {self.name} connection free after {self.timeout}s "
+                                      f"({self._in_use}/{self.maxconn} in use)")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._publish()
+
+        # Ping or connect outside the lock so returns are never blocked on the network
+        try:
+            if conn is not None and not self._healthy(conn, last_used):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._publish()
+                self._cond.notify()
+            raise
+        metrics.observe("db_pool_wait_seconds", time.perf_counter() - started, pool=self.name)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection; any open transaction is rolled back."""
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or getattr(conn, "closed", False) or len(self._idle) >= self.maxconn:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._publish()
+            self._cond.notify()
+
+    def closeall(self):
+        """Close idle connections (checked-out ones are closed on return)."""
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._publish()
+
+
+class Connection:
+    """A checked-out connection.
+
+    Use as `with get_db_connection() as conn:` to commit on success, roll back
+    on error and always release it. `close()` releases it explicitly.
+    The time from checkout to release is recorded as db_connection_held_seconds.
+    """
+
+    def __init__(self, raw, release):
+        self._raw = raw
+        self._release = release
+        self._checked_out = time.perf_counter()
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def cursor(self, *args, **kwargs):
+        return _Cursor(self._raw.cursor(*args, **kwargs), self._raw.cursor)
+
+    def execute(self, sql, params=()):
+        # sqlite3.Connection.execute shortcut, timed like a cursor
+        cur = self.cursor()
+        cur.execute(sql, params)
+        return cur
+
+    def executemany(self, sql, seq_of_params):
+        cur = self.cursor()
+        cur.executemany(sql, seq_of_params)
+        return cur
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._release(raw)
+            metrics.observe("db_connection_held_seconds", time.perf_counter() - self._checked_out,
+                            pool="postgres" if USE_POSTGRES else "sqlite")
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._raw is not None:
+                if exc_type is None:
+                    self._raw.commit()
+                else:
+                    self._raw.rollback()
+        finally:
+            self.close()
+        return False
+
+
+def _qmark_to_format(sql):
+    """Rewrite sqlite-style `?` placeholders as psycopg2 `%s` (outside string literals)."""
+    if "?" not in sql:
+        return sql
+    parts = sql.split("'")
+    for i in range(0, len(parts), 2):
+        parts[i] = parts[i].replace("?", "%s")
+    return "'".join(parts)
+
+
+class _Cursor:
+    """Cursor that times each statement (querylog.py).
+
+    On PostgreSQL it also accepts the `?` placeholders used throughout
+    server.py. `explain_cursor` opens a side cursor for slow-query plans.
+    """
+
+    def __init__(self, cur, explain_cursor):
+        self._cur = cur
+        self._explain_cursor = explain_cursor
+
+    def execute(self, sql, params=None):
+        """Run one statement; returns the cursor on both backends, so `.execute(...).fetchone()` works."""
+        if USE_POSTGRES:
+            sql = _qmark_to_format(sql)
+            querylog.timed(lambda: self._cur.execute(sql, params), sql, params, "postgres", self._explain_cursor)
+            return self
+        args = (sql,) if params is None else (sql, params)
+        querylog.timed(lambda: self._cur.execute(*args), sql, params, "sqlite", self._explain_cursor)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        if USE_POSTGRES:
+            sql = _qmark_to_format(sql)
+        querylog.timed(lambda: self._cur.executemany(sql, seq_of_params), sql, None,
+                       "postgres" if USE_POSTGRES else "sqlite", many=True)
+        return self
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cur.close()
+        return False
+
+
+# --- SQLite: one tuned connection per thread ---
+_sqlite_local = threading.local()
+
+
+def _sqlite_connect(path):
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    return conn
+
+
+def _sqlite_checkout():
+    """Hand out this thread's cached connection, or a private one if it is busy.
+
+    Nested get_db_connection() calls on one thread must not share a transaction,
+    so only the outermost caller gets the cached connection.
+    """
+    cached = getattr(_sqlite_local, "conn", None)
+    if cached is not None and _sqlite_local.path != DB_FILE:
+        cached.close()
+        cached = _sqlite_local.conn = None
+    if cached is None:
+        cached = _sqlite_local.conn = _sqlite_connect(DB_FILE)
+        _sqlite_local.path = DB_FILE
+        _sqlite_local.busy = False
+        metrics.inc("db_pool_connects_total", pool="sqlite")
+    if _sqlite_local.busy:
+        return _sqlite_connect(DB_FILE), lambda raw: raw.close()
+
+    _sqlite_local.busy = True
+
+    def release(raw):
+        try:
+            raw.rollback()  # Whatever the caller did not commit
+        finally:
+            _sqlite_local.busy = False
+
+    return cached, release
+
+
+def _close_thread_sqlite():
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _sqlite_local.conn = None
+
+
+# --- Process-local pool ---
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _pg_connect():
+    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor, connect_timeout=DB_CONNECT_TIMEOUT)
+
+
+def get_pool():
+    """Return this process's Postgres pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(_pg_connect)
+                pool.fill()
+                _pool = pool
+    return _pool
+
+
+def _before_fork():
+    # gunicorn forks workers from the preloaded master: never let a live
+    # socket or SQLite handle be inherited by (and shared between) processes.
+    if _pool is not None:
+        _pool.closeall()
+    _close_thread_sqlite()
+
+
+def _after_fork_in_child():
+    global _pool, _sqlite_local
+    _pool = None
+    _sqlite_local = threading.local()
+
+
+os.register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
+
+def get_db_connection(write=False):
+    """Get database connection (PostgreSQL or SQLite).
+
+    Each call checks out its own connection, so callers never share one across
+    request threads. Pass `write=True` for a write transaction: on SQLite it
+    starts with BEGIN IMMEDIATE, so the write lock is queued for up front
+    (honouring the busy timeout) instead of failing mid-transaction. Keep
+    those blocks short and put related writes in one of them.
+    """
+    if USE_POSTGRES:
+        pool = get_pool()
+        raw = pool.getconn()
+
+        def release(conn):
+            pool.putconn(conn, discard=conn.closed != 0)
+
+        return Connection(raw, release)
+    else:
+        raw, release = _sqlite_checkout()
+        if write:
+            try:
+                raw.execute("BEGIN IMMEDIATE")
+            except Exception:
+                release(raw)
+                raise
+        return Connection(raw, release)
+
+
+# --- Change versions ---
+# A counter per table, bumped in the same transaction as every write, lets read
+# endpoints answer conditional requests without re-running their queries.
+
+def bump_version(c, name='orders'):
+    """Increment the change version for `name`; call inside the write transaction."""
+    c.execute('UPDATE change_versions SET version = version + 1 WHERE name = ?', (name,))
+
+
+def get_version(c, name='orders'):
+    c.execute('SELECT version FROM change_versions WHERE name = ?', (name,))
+    row = c.fetchone()
+    return dict(row)['version'] if row else 0
@@ -0,0 +1,199 @@
+"""
+Order events for the admin dashboard's Server-Sent Events feed.
+
+Write paths call `record()` inside their transaction, so an event exists only
+if the change it describes was committed. Each worker process runs one
+`EventBroker` poller thread, and only while someone is subscribed. It reads new rows by
+primary key and fans them out to every stream in that process, so the cost
+is one indexed query per poll interval per process, not one per dashboard.
+
+Streams are plain generators. Under gthread each open stream holds one worker
+thread, so the number per process is capped (EVENTS_MAX_STREAMS) and every
+stream ends after EVENTS_STREAM_MAX_SECONDS. The browser's EventSource then
+reconnects with Last-Event-ID and resumes where it stopped.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+import metrics
+from db import get_db_connection
+
+EVENT_TYPES = ('order-created', 'status-changed', 'conversion-finished')
+
+EVENTS_POLL_INTERVAL = float(os.environ.get("EVENTS_POLL_INTERVAL", "1"))  # Seconds between checks for new rows
+EVENTS_HEARTBEAT_SECONDS = float(os.environ.get("EVENTS_HEARTBEAT_SECONDS", "15"))  # Keeps proxies from idling out the stream
+EVENTS_STREAM_MAX_SECONDS = float(os.environ.get("EVENTS_STREAM_MAX_SECONDS", "300"))
+EVENTS_MAX_STREAMS = int(os.environ.get("EVENTS_MAX_STREAMS", "8"))  # Per process; 0 disables streaming (clients poll)
+EVENTS_RETENTION_HOURS = int(os.environ.get("EVENTS_RETENTION_HOURS", "24"))
+EVENTS_RETRY_MS = 3000  # Reconnect delay suggested to EventSource
+
+_BATCH = 200
+_PRUNE_EVERY = 3600
+
+
+def _now(offset=0.0):
+    # UTC, written explicitly: CURRENT_TIMESTAMP follows the session time zone on PostgreSQL
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() + offset))
+
+
+def record(c, event_type, order_id, **data):
+    """Append an event; call inside the write transaction it describes."""
+    assert event_type in EVENT_TYPES, event_type
+    c.execute('INSERT INTO order_events (type, order_id, data, created_at) VALUES (?, ?, ?, ?)',
+              (event_type, order_id, json.dumps({"id": order_id, **data}), _now()))
+
+
+def record_many(c, event_type, items):
+    """Append one event per (order_id, data) pair with a single executemany."""
+    assert event_type in EVENT_TYPES, event_type
+    now = _now()
+    c.executemany('INSERT INTO order_events (type, order_id, data, created_at) VALUES (?, ?, ?, ?)',
+                  [(event_type, order_id, json.dumps({"id": order_id, **data}), now) for order_id, data in items])
+
+
+def _row(row):
+    row = dict(row)
+    return {"id": row["id"], "type": row["type"], "data": row["data"]}
+
+
+def fetch_after(last_id, limit=_BATCH):
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT id, type, data FROM order_events WHERE id > ? ORDER BY id LIMIT ?', (last_id, limit))
+        return [_row(r) for r in c.fetchall()]
+
+
+def latest_id():
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT MAX(id) AS id FROM order_events')
+        return dict(c.fetchone())['id'] or 0
+
+
+def prune(hours=EVENTS_RETENTION_HOURS):
+    """Drop events older than the retention window; returns the number deleted."""
+    cutoff = _now(-hours * 3600)
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM order_events WHERE created_at < ?', (cutoff,))
+        return c.rowcount
+
+
+class EventBroker:
+    """Per-process fan-out of new order events to open streams."""
+
+    def __init__(self, poll_interval=EVENTS_POLL_INTERVAL, max_streams=EVENTS_MAX_STREAMS, buffer_size=1000):
+        self.poll_interval = poll_interval
+        self.max_streams = max_streams
+        self._buffer = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._subscribers = 0
+        self._thread = None
+        self._floor = None  # Events with id > _floor are all in the buffer
+        self._last_prune = 0.0
+
+    def subscribe(self):
+        """Reserve a stream slot; False when this process is at its limit."""
+        with self._cond:
+            if self._subscribers >= self.max_streams:
+                metrics.inc("sse_rejected_total")
+                return False
+            self._subscribers += 1
+            metrics.set_gauge("sse_streams", self._subscribers)
+            if self._thread is None:
+                self._floor = latest_id()
+                self._buffer.clear()
+                self._thread = threading.Thread(target=self._run, name="order-events", daemon=True)
+                self._thread.start()
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+            metrics.set_gauge("sse_streams", self._subscribers)
+
+    def wait(self, last_id, timeout):
+        """Events after `last_id`, blocking up to `timeout` seconds for one to arrive."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            floor = self._floor
+        if last_id < floor:
+            # Older than the buffer (a resuming client): read the backlog from the table
+            backlog = fetch_after(last_id)
+            if backlog:
+                return backlog
+            last_id = floor
+        with self._cond:
+            while True:
+                events = [e for e in self._buffer if e["id"] > last_id]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self._cond.wait(remaining)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._subscribers == 0:
+                    self._thread = None
+                    return
+                last_id = self._buffer[-1]["id"] if self._buffer else self._floor
+            try:
+                events = fetch_after(last_id)
+                if time.monotonic() - self._last_prune > _PRUNE_EVERY:
+                    self._last_prune = time.monotonic()
+                    prune()
+            except Exception as e:
+                logging.warning(f"Order events poll failed: {e}")
+                events = []
+            if events:
+                with self._cond:
+                    if len(self._buffer) + len(events) > self._buffer.maxlen:
+                        dropped = len(self._buffer) + len(events) - self._buffer.maxlen
+                        self._floor = (list(self._buffer) + events)[dropped - 1]["id"]
+                    self._buffer.extend(events)
+                    self._cond.notify_all()
+            if len(events) < _BATCH:
+                time.sleep(self.poll_interval)
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {event['data']}\n\n"
+
+
+def stream(broker, last_id, max_seconds=EVENTS_STREAM_MAX_SECONDS, heartbeat=EVENTS_HEARTBEAT_SECONDS):
+    """SSE body for one subscriber; releases its slot when the client goes away."""
+    try:
+        yield f"retry: {EVENTS_RETRY_MS}\n\n"
+        deadline = time.monotonic() + max_seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return  # EventSource reconnects with Last-Event-ID
+            events = broker.wait(last_id, min(heartbeat, remaining))
+            for event in events:
+                yield format_event(event)
+                last_id = event["id"]
+            if events:
+                metrics.inc("sse_events_sent_total", len(events))
+            elif time.monotonic() < deadline:
+                yield ": ping\n\n"
+    finally:
+        broker.unsubscribe()
+
+
+broker = EventBroker()
+
+
+def _after_fork_in_child():
+    # The poller thread does not survive fork; start clean in each worker
+    global broker
+    broker = EventBroker()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -2,20 +2,63 @@
 # Production WSGI Server Configuration
 
 import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+_config_loaded = time.perf_counter()
 
 # Server Socket
 bind = "0.0.0.0:5000"
 backlog = 2048
 
 # Worker Processes
-workers = multiprocessing.cpu_count() * 2 + 1  # Recommended formula
-worker_class = "sync"
-worker_connections = 1000
+# Most requests wait on Stripe, SMTP, FTPS or the database rather than the CPU,
+# so the default is threaded workers: each process serves `threads` requests
+# concurrently. Set GUNICORN_WORKER_CLASS=sync to get the old one-request-per-
+# process model, or gevent if it is installed (then worker_connections applies).
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# gunicorn silently upgrades sync to gthread when threads > 1, so only default
+# to a thread pool for gthread.
+threads = int(os.environ.get("GUNICORN_THREADS", "8" if worker_class == "gthread" else "1"))
+worker_connections = 1000  # gevent/eventlet only
 max_requests = 1000  # Restart workers after this many requests (prevents memory leaks)
 max_requests_jitter = 50  # Add randomness to prevent all workers restarting at once
 timeout = 30
 keepalive = 2
 
+# Admin event stream (/api/orders/events): each open stream holds a thread
+# under gthread, so leave at least half of them for ordinary requests. A sync
+# worker would be blocked outright, so streaming is off there and the
+# dashboard polls.
+if worker_class == "gthread":
+    _event_streams = threads // 2
+elif worker_class in ("gevent", "eventlet"):
+    _event_streams = worker_connections // 2
+else:
+    _event_streams = 0
+os.environ.setdefault("EVENTS_MAX_STREAMS", str(_event_streams))
+
+# Rate limits: memory:// would give each worker its own counters, multiplying
+# every limit by the worker count. Share them through a local SQLite file.
+if workers > 1:
+    os.environ.setdefault("RATELIMIT_STORAGE_URI", "sqlite:///ratelimit.db")
+
+# Metrics: each worker keeps its own registry, so /api/metrics would show
+# whichever worker answered. Workers write theirs to a shared directory and
+# the endpoint merges them. A fresh directory per master keeps a previous
+# deploy's totals out.
+if workers > 1 and not os.environ.get("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="gassstro-metrics-")
+
+# Startup
+# Import the app once in the master: schema setup and the Flask/Stripe imports
+# then happen once per deploy, and workers (including max_requests recycles)
+# fork with everything already loaded. GUNICORN_PRELOAD=false to disable.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() != "false"
+
 # Logging
 # Use stdout/stderr for Render.com (no file system access needed)
 accesslog = "-"  # stdout
@@ -42,3 +85,37 @@ tmp_upload_dir = None
 limit_request_line = 4094
 limit_request_fields = 100
 limit_request_field_size = 8190
+
+
+# Startup timing hooks
+def when_ready(server):
+    server.log.info(f"Master ready in {(time.perf_counter() - _config_loaded) * 1000:.0f} ms (preload_app={preload_app})")
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+def post_worker_init(worker):
+    worker.log.info(f"Worker {worker.pid} ready in {(time.perf_counter() - worker.forked_at) * 1000:.0f} ms after fork")
+    # Pick up jobs, mail and printer uploads that a recycled worker left behind
+    from server import resume_background_work
+    resume_background_work()
+    # Sweeps and re-dispatch run here too, so a web-only deploy needs no worker service
+    import jobs
+    jobs.start_periodic()
+    import metrics
+    metrics.start_flusher()
+
+def worker_exit(server, worker):
+    # Last numbers since the previous flush
+    import metrics
+    metrics.flush()
+
+def child_exit(server, worker):
+    # Runs in the master: keep the exited worker's counters in the totals
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+def on_exit(server):
+    metrics_dir = os.environ.get("METRICS_DIR", "")
+    if os.path.basename(metrics_dir).startswith("gassstro-metrics-"):
+        shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,365 @@
+"""
+Durable background jobs, stored in the `jobs` table.
+
+Write paths call `enqueue(c, kind, payload)` inside their transaction, so a
+job exists exactly when the change that needs it was committed. Workers
+claim one job at a time: PostgreSQL uses FOR UPDATE SKIP LOCKED, SQLite an
+atomic UPDATE under its write lock. The claim holds a lease that a heartbeat
+thread renews while the handler runs. If a worker dies (gunicorn's
+max_requests recycle, a deploy, an OOM kill), its lease runs out and another
+worker picks the job up again. Handlers must therefore be safe to run twice.
+
+Due jobs run highest priority first, then oldest first. Speculative work
+(PRIORITY_LOW) only gets a worker when nothing paid is waiting.
+
+A handler that raises is retried with exponential backoff. After
+max_attempts the job is parked as 'dead' (dead-lettered) for an admin to
+inspect and retry.
+
+Where jobs run:
+- Inline (JOBS_INLINE=true, the default): each web process starts a worker
+  thread when it enqueues work, and a thread for the periodic tasks
+  registered with `every()` (started by gunicorn's post_worker_init).
+- Standalone: `python manage.py worker` processes the queue and runs the
+  periodic tasks from any host.
+Both can run at once. Each periodic task has a row in `periodic_tasks`, and
+a process runs the task only after moving that row's next_run_at forward.
+So every interval runs once across the deployment, however many web workers
+and standalone workers there are.
+"""
+
+import os
+import json
+import time
+import signal
+import socket
+import logging
+import threading
+
+import metrics
+from db import USE_POSTGRES, get_db_connection
+from workers import OnDemandWorker, seconds_until
+
+JOBS_INLINE = os.environ.get("JOBS_INLINE", "true").lower() == "true"
+JOBS_CONCURRENCY = int(os.environ.get("JOBS_CONCURRENCY", "2"))  # Standalone worker threads
+JOBS_LEASE_SECONDS = float(os.environ.get("JOBS_LEASE_SECONDS", "120"))
+JOBS_MAX_ATTEMPTS = int(os.environ.get("JOBS_MAX_ATTEMPTS", "5"))
+JOBS_RETRY_BACKOFF = float(os.environ.get("JOBS_RETRY_BACKOFF", "30"))  # Seconds, doubled per attempt
+JOBS_IDLE_SECONDS = float(os.environ.get("JOBS_IDLE_SECONDS", "30"))  # Inline thread exits after this long idle
+JOBS_POLL_INTERVAL = 1.0
+
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+JOB_FIELDS = ('id', 'kind', 'payload', 'status', 'priority', 'attempts', 'max_attempts', 'last_error', 'locked_by',
+              'lease_until', 'run_after', 'created_at', 'finished_at')
+
+_handlers = {}
+_periodic = []
+
+
+def _now(offset=0.0):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() + offset))
+
+
+def handler(kind):
+    """Register `fn(**payload)` as the handler for jobs of `kind`."""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def every(seconds, name):
+    """Register `fn()` to run every `seconds` (once per interval across all processes)."""
+    def register(fn):
+        _periodic.append((name, seconds, fn))
+        return fn
+    return register
+
+
+def enqueue(c, kind, payload, max_attempts=JOBS_MAX_ATTEMPTS, delay=0, priority=PRIORITY_NORMAL):
+    """Add a job inside the caller's transaction; returns its id. Call `wake()` after commit."""
+    assert kind in _handlers, kind
+    c.execute('INSERT INTO jobs (kind, payload, status, priority, max_attempts, run_after, created_at) '
+              "VALUES (?, ?, 'queued', ?, ?, ?, ?)" + (' RETURNING id' if USE_POSTGRES else ''),
+              (kind, json.dumps(payload), priority, max_attempts, _now(delay), _now()))
+    metrics.inc("jobs_total", kind=kind, outcome="queued")
+    return c.fetchone()['id'] if USE_POSTGRES else c.lastrowid
+
+
+def get_job(job_id):
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,))
+        row = c.fetchone()
+    return dict(row) if row else None
+
+
+def list_jobs(status=None, limit=50):
+    where, params = ('WHERE status = ?', [status]) if status else ('', [])
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs {where} ORDER BY id DESC LIMIT ?", params + [limit])
+        return [dict(row) for row in c.fetchall()]
+
+
+def retry(job_id):
+    """Requeue a dead job (or one waiting out its backoff) to run now; False if there is none."""
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?, updated_at = ? "
+                  "WHERE id = ? AND status IN ('dead', 'queued')", (_now(), _now(), job_id))
+        found = c.rowcount > 0
+    if found:
+        wake()
+    return found
+
+
+def next_due():
+    """Seconds until the earliest queued job is due (<= 0 if one is due now), or None if none is queued."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT MIN(run_after) AS run_after FROM jobs WHERE status = 'queued'")
+        row = c.fetchone()
+    return seconds_until(dict(row)['run_after']) if row else None
+
+
+def _claim(worker):
+    """Atomically take the next due job (highest priority first), or one whose lease ran out."""
+    now = _now()
+    due = "(status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?)"
+    lock = ' FOR UPDATE SKIP LOCKED' if USE_POSTGRES else ''
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, lease_until = ?, updated_at = ?
+            WHERE id = (SELECT id FROM jobs WHERE {due} ORDER BY priority DESC, id LIMIT 1{lock}) AND ({due})
+            RETURNING id, kind, payload, attempts, max_attempts
+        ''', (worker, _now(JOBS_LEASE_SECONDS), now, now, now, now, now))
+        row = c.fetchone()
+    return dict(row) if row else None
+
+
+def _finish(job, worker, **fields):
+    """Record the outcome, unless the lease was lost and someone else owns the job now."""
+    fields['updated_at'] = _now()
+    assignments = ', '.join(f'{key} = ?' for key in fields)
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute(f"UPDATE jobs SET {assignments}, locked_by = NULL, lease_until = NULL "
+                  "WHERE id = ? AND locked_by = ? AND status = 'running'", (*fields.values(), job['id'], worker))
+        return c.rowcount > 0
+
+
+class _Lease:
+    """Renews a claimed job's lease while its handler runs."""
+
+    def __init__(self, job_id, worker):
+        self.job_id = job_id
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"job-{job_id}-lease", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(JOBS_LEASE_SECONDS / 3):
+            try:
+                with get_db_connection(write=True) as conn:
+                    conn.cursor().execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND locked_by = ?",
+                                          (_now(JOBS_LEASE_SECONDS), self.job_id, self.worker))
+            except Exception as e:
+                logging.warning(f"Job #{self.job_id}: could not renew lease: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def run_one(worker):
+    """Claim and run one job; returns False when nothing was due."""
+    job = _claim(worker)
+    if job is None:
+        return False
+    kind, attempts = job['kind'], job['attempts']
+    if attempts > job['max_attempts']:
+        # Only reachable through expired leases: the job keeps taking its worker down with it
+        logging.error(f"Job #{job['id']} ({kind}) lost its worker {attempts - 1} times, moved to dead letters")
+        _finish(job, worker, status='dead', last_error='Lease expired on every attempt', finished_at=_now())
+        metrics.inc("jobs_total", kind=kind, outcome="dead")
+        return True
+    started = time.perf_counter()
+    try:
+        fn = _handlers[kind]
+        with _Lease(job['id'], worker):
+            fn(**json.loads(job['payload']))
+    except Exception as e:
+        if attempts < job['max_attempts']:
+            delay = JOBS_RETRY_BACKOFF * 2 ** (attempts - 1)
+            logging.warning(f"Job #{job['id']} ({kind}) attempt {attempts} failed: {e}; retrying in {delay:.0f}s")
+            _finish(job, worker, status='queued', last_error=str(e), run_after=_now(delay))
+            metrics.inc("jobs_total", kind=kind, outcome="retry")
+        else:
+            logging.error(f"Job #{job['id']} ({kind}) failed {attempts} times, moved to dead letters: {e}")
+            _finish(job, worker, status='dead', last_error=str(e), finished_at=_now())
+            metrics.inc("jobs_total", kind=kind, outcome="dead")
+        return True
+    elapsed = time.perf_counter() - started
+    if not _finish(job, worker, status='done', finished_at=_now()):
+        logging.warning(f"Job #{job['id']} ({kind}) finished after its lease was taken over")
+    metrics.inc("jobs_total", kind=kind, outcome="done")
+    metrics.observe("job_seconds", elapsed, kind=kind)
+    logging.info(f"Job #{job['id']} ({kind}) done in {elapsed * 1000:.0f} ms")
+    return True
+
+
+def _worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+# --- Inline worker (inside web processes) ---
+
+class InlineWorker(OnDemandWorker):
+    """On-demand worker thread in a web process; exits after JOBS_IDLE_SECONDS without work."""
+
+    thread_name = "jobs"
+
+    def idle_seconds(self):
+        return JOBS_IDLE_SECONDS
+
+    def poll_interval(self):
+        return JOBS_POLL_INTERVAL
+
+    def describe_error(self, error):
+        return f"Job queue: could not claim a job: {error}"
+
+    def step(self):
+        return run_one(_worker_id())
+
+    def next_due(self):
+        return next_due()
+
+
+_inline = InlineWorker()
+_standalone = threading.Event()  # Set while run_worker() serves the queue in this process
+
+
+def wake():
+    """Nudge this process's inline worker after committing new jobs."""
+    if JOBS_INLINE and not _standalone.is_set():
+        _inline.wake()
+
+
+def _after_fork_in_child():
+    # The worker thread does not survive fork; start clean in each process
+    global _inline, _periodic_runner
+    _inline = InlineWorker()
+    _periodic_runner = _PeriodicRunner()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+# --- Periodic tasks ---
+
+def _claim_periodic(name, seconds, worker):
+    """Take this interval's run of a periodic task.
+
+    Returns (True, seconds) if the caller should run it now, otherwise
+    (False, seconds until another process's run makes it due again).
+    """
+    now = _now()
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO periodic_tasks (name, next_run_at) VALUES (?, ?) ON CONFLICT (name) DO NOTHING",
+                  (name, now))
+        c.execute("UPDATE periodic_tasks SET next_run_at = ?, last_run_at = ?, last_run_by = ? "
+                  "WHERE name = ? AND next_run_at <= ?", (_now(seconds), now, worker, name, now))
+        if c.rowcount > 0:
+            return True, seconds
+        c.execute("SELECT next_run_at FROM periodic_tasks WHERE name = ?", (name,))
+        return False, seconds_until(dict(c.fetchone())['next_run_at'])
+
+
+def run_periodic(stop):
+    """Run the `every()` tasks whose interval has come round, until `stop` is set."""
+    worker = _worker_id()
+    check_at = {name: 0.0 for name, _, _ in _periodic}
+    while not stop.is_set():
+        for name, seconds, fn in _periodic:
+            if time.monotonic() < check_at[name]:
+                continue
+            try:
+                claimed, wait = _claim_periodic(name, seconds, worker)
+            except Exception as e:
+                logging.warning(f"Periodic task {name}: could not claim its run: {e}")
+                claimed, wait = False, JOBS_POLL_INTERVAL
+            check_at[name] = time.monotonic() + max(wait, JOBS_POLL_INTERVAL)
+            if claimed:
+                try:
+                    fn()
+                except Exception as e:
+                    logging.warning(f"Periodic task {name} failed: {e}")
+        stop.wait(JOBS_POLL_INTERVAL)
+
+
+class _PeriodicRunner:
+    """The web process's periodic task thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stop = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=run_periodic, args=(self.stop,), name="periodic", daemon=True)
+                self._thread.start()
+
+
+_periodic_runner = _PeriodicRunner()
+
+
+def start_periodic():
+    """Run the periodic tasks in this web process too (with JOBS_INLINE); call once per worker after fork."""
+    if JOBS_INLINE and not _standalone.is_set():
+        _periodic_runner.start()
+
+
+# --- Standalone worker ---
+
+def run_worker(concurrency=JOBS_CONCURRENCY, stop=None):
+    """Process jobs until SIGTERM/SIGINT (or `stop` is set); in-flight jobs finish first."""
+    stop = stop or threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: stop.set())
+
+    def loop():
+        worker = _worker_id()
+        while not stop.is_set():
+            try:
+                ran = run_one(worker)
+            except Exception as e:
+                logging.warning(f"Job queue: could not claim a job: {e}")
+                ran = False
+            if not ran:
+                stop.wait(JOBS_POLL_INTERVAL)
+
+    _standalone.set()  # This process's job threads are the ones below
+    threads = [threading.Thread(target=loop, name=f"jobs-{i}") for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    logging.info(f"Job worker started with {concurrency} thread(s): {', '.join(sorted(_handlers))}")
+
+    run_periodic(stop)
+
+    logging.info("Job worker stopping; waiting for running jobs")
+    for t in threads:
+        t.join()
+    _standalone.clear()
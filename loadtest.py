@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Minimal concurrent load generator for the GASsstro API.
+
+Fires requests from N client threads for a fixed duration and reports
+throughput and latency percentiles. Point the backend at mock_stripe.py
+(STRIPE_API_BASE) and disable rate limiting (RATELIMIT_ENABLED=false) when
+load testing /api/create-payment.
+
+    python loadtest.py --url http://127.0.0.1:5000 --route create-payment -c 32 -d 15
+"""
+
+import argparse
+import io
+import threading
+import time
+
+import requests
+
+# 1x1 PNG, enough for the upload validation
+PNG_BYTES = (
+    b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x00\x00\x00\x00:~\x9bU"
+    b"\x00\x00\x00\nIDATx\x9cc\xf8\x0f\x00\x01\x01\x01\x00\x18\xdd\x8d\xb4\x00\x00\x00\x00IEND\xaeB`\x82"
+)
+
+
+def _create_payment(session, base_url, token):
+    files = {'file': ('logo.png', io.BytesIO(PNG_BYTES), 'image/png')}
+    data = {'name': 'Load Test', 'email': 'load@test.local', 'quantity': 50, 'total_price': 185.0}
+    return session.post(f"{base_url}/api/create-payment", files=files, data=data, timeout=60)
+
+
+def _get(path):
+    def call(session, base_url, token):
+        return session.get(f"{base_url}{path}", headers={'X-Admin-Token': token or ''}, timeout=60)
+    return call
+
+
+ROUTES = {
+    'create-payment': _create_payment,
+    'health': _get('/api/health'),
+    'orders': _get('/api/orders'),
+    'stats': _get('/api/admin/stats'),
+}
+
+
+def run(base_url, route, concurrency, duration, token=None):
+    call = ROUTES[route]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                ok = call(session, base_url, token).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': len(latencies) / duration,
+        'p50_ms': pct(0.50),
+        'p95_ms': pct(0.95),
+        'p99_ms': pct(0.99),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="GASsstro API load generator")
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--route', choices=sorted(ROUTES), default='create-payment')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10.0)
+    parser.add_argument('--token', help="Admin token for protected routes")
+    args = parser.parse_args()
+
+    result = run(args.url, args.route, args.concurrency, args.duration, args.token)
+    print(f"{args.route}: {result['requests']} ok, {result['errors']} errors, "
+          f"{result['rps']:.1f} req/s, p50 {result['p50_ms']:.0f} ms, "
+          f"p95 {result['p95_ms']:.0f} ms, p99 {result['p99_ms']:.0f} ms")
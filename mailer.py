@@ -0,0 +1,332 @@
+"""
+Outbound email queue with a reusable SMTP session.
+
+`enqueue()` stores the message in `outbound_emails` and returns at once, so
+request and conversion threads never wait on the mail server. Each worker
+process runs one sender thread, and only while there is mail to send. The
+thread claims queued messages in batches and sends them over one
+authenticated SMTP session: STARTTLS and login happen once. The session is
+reused until it has sent MAIL_MAX_PER_SESSION messages or sat idle for
+MAIL_SESSION_IDLE_SECONDS.
+
+Transient failures (connection errors, 4xx replies) requeue the message with
+exponential backoff; a broken connection is also dropped and reopened.
+Permanent 5xx rejections fail the message at once. Delivery latency, measured
+from enqueue to the server accepting the message, is stored on the row and
+exported as `mail_delivery_seconds`.
+
+Test locally against mock_smtp.py.
+"""
+
+import os
+import time
+import socket
+import smtplib
+import logging
+import datetime
+import threading
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+import metrics
+from db import USE_POSTGRES, get_db_connection
+from workers import OnDemandWorker, seconds_until
+
+# To use Gmail: Generate an App Password at https://myaccount.google.com/apppasswords
+SMTP_EMAIL = os.environ.get("SMTP_EMAIL", "orders@gassstro.com")
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD")  # MUST be set in .env
+SMTP_SERVER = os.environ.get("SMTP_SERVER", "mail.gassstro.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "true").lower() == "true"  # Ignored on port 465 (implicit TLS)
+
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", "15"))
+MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE", "20"))
+MAIL_MAX_PER_SESSION = int(os.environ.get("MAIL_MAX_PER_SESSION", "100"))  # Many servers cap messages per connection
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", "5"))
+MAIL_RETRY_BACKOFF = float(os.environ.get("MAIL_RETRY_BACKOFF", "30"))  # Seconds, doubled per attempt
+MAIL_SESSION_IDLE_SECONDS = float(os.environ.get("MAIL_SESSION_IDLE_SECONDS", "60"))
+MAIL_STALE_SECONDS = float(os.environ.get("MAIL_STALE_SECONDS", "300"))  # Requeue 'sending' rows silent this long
+MAIL_RETENTION_DAYS = int(os.environ.get("MAIL_RETENTION_DAYS", "30"))
+MAIL_POLL_INTERVAL = 1.0
+_PRUNE_EVERY = 3600
+
+FROM_NAME = "GASsstro System"
+
+
+def _now(offset=0.0):
+    # Millisecond precision, so delivery latency can be measured from created_at
+    now = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=offset)
+    return now.strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+
+
+def _epoch(value):
+    """Seconds since the epoch for a stored UTC timestamp (str on SQLite, datetime on PostgreSQL)."""
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def configured():
+    return bool(SMTP_EMAIL and SMTP_PASSWORD)
+
+
+class SMTPClient:
+    """One reusable, authenticated SMTP session."""
+
+    def __init__(self, host=SMTP_SERVER, port=SMTP_PORT, user=SMTP_EMAIL, password=SMTP_PASSWORD,
+                 starttls=SMTP_STARTTLS, timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._smtp = None
+        self._last_used = 0.0
+        self.sent_in_session = 0
+
+    def _connect(self):
+        with metrics.timer("smtp_connect_seconds"):
+            if self.port == 465:
+                smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+            else:
+                smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+                if self.starttls:
+                    smtp.starttls()
+            if self.user and self.password:
+                smtp.login(self.user, self.password)
+        metrics.inc("smtp_sessions_total")
+        logging.info(f"SMTP session open to {self.host}:{self.port}")
+        self.sent_in_session = 0
+        return smtp
+
+    def session(self):
+        """The open session, checked with NOOP if it sat idle; reconnects as needed."""
+        if self._smtp is not None and (self.sent_in_session >= MAIL_MAX_PER_SESSION
+                                       or time.monotonic() - self._last_used > 30 and not self._alive()):
+            self.close()
+        if self._smtp is None:
+            self._smtp = self._connect()
+        self._last_used = time.monotonic()
+        return self._smtp
+
+    def _alive(self):
+        try:
+            return self._smtp.noop()[0] == 250
+        except (OSError, smtplib.SMTPException):
+            return False
+
+    def send(self, msg):
+        self.session().send_message(msg)
+        self.sent_in_session += 1
+        self._last_used = time.monotonic()
+
+    @property
+    def connected(self):
+        return self._smtp is not None
+
+    def close(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except (OSError, smtplib.SMTPException):
+            smtp.close()
+
+
+def build_message(to_addr, subject, html):
+    msg = MIMEMultipart()
+    msg['From'] = f"{FROM_NAME} <{SMTP_EMAIL}>"
+    msg['To'] = to_addr
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html, 'html'))
+    return msg
+
+
+# --- Queue table ---
+
+def enqueue(to_addr, subject, html, order_id=None):
+    """Queue one message for delivery; returns its id (None when SMTP isn't configured)."""
+    if not configured():
+        logging.warning("Email not configured. Skipping email.")
+        return None
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO outbound_emails (order_id, to_addr, subject, body, status, created_at) "
+                  "VALUES (?, ?, ?, ?, 'queued', ?)" + (' RETURNING id' if USE_POSTGRES else ''),
+                  (order_id, to_addr, subject, html, _now()))
+        email_id = c.fetchone()['id'] if USE_POSTGRES else c.lastrowid
+    metrics.inc("mail_total", outcome="queued")
+    sender().wake()
+    return email_id
+
+
+def queued_for_order(order_id):
+    """True if a message for this order is already queued or sent (keeps job retries from duplicating it)."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM outbound_emails WHERE order_id = ? AND status <> 'failed' LIMIT 1", (order_id,))
+        return c.fetchone() is not None
+
+
+def get_email(email_id):
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT id, order_id, to_addr, subject, status, attempts, error, created_at, sent_at, latency_ms '
+                  'FROM outbound_emails WHERE id = ?', (email_id,))
+        row = c.fetchone()
+    return dict(row) if row else None
+
+
+def next_due():
+    """Seconds until the earliest queued message is due (<= 0 if one is due now), or None if none is queued."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT next_attempt_at FROM outbound_emails WHERE status = 'queued' "
+                  "ORDER BY next_attempt_at IS NOT NULL, next_attempt_at LIMIT 1")
+        row = c.fetchone()
+    if row is None:
+        return None
+    return seconds_until(dict(row)['next_attempt_at']) or 0.0
+
+
+def _claim(worker, limit=MAIL_BATCH_SIZE):
+    """Atomically take up to `limit` due messages (plus any a dead worker left in 'sending')."""
+    now = _now()
+    due = ("(status = 'queued' AND (next_attempt_at IS NULL OR next_attempt_at <= ?)) "
+           "OR (status = 'sending' AND updated_at < ?)")
+    params = (now, _now(-MAIL_STALE_SECONDS))
+    lock = ' FOR UPDATE SKIP LOCKED' if USE_POSTGRES else ''
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            UPDATE outbound_emails SET status = 'sending', attempts = attempts + 1, worker = ?, updated_at = ?
+            WHERE id IN (SELECT id FROM outbound_emails WHERE {due} ORDER BY id LIMIT ?{lock}) AND ({due})
+            RETURNING id, to_addr, subject, body, attempts, created_at
+        ''', (worker, now) + params + (limit,) + params)
+        rows = [dict(row) for row in c.fetchall()]
+    return sorted(rows, key=lambda row: row['id'])
+
+
+def _update(email_id, **fields):
+    fields['updated_at'] = _now()
+    assignments = ', '.join(f'{key} = ?' for key in fields)
+    with get_db_connection(write=True) as conn:
+        conn.cursor().execute(f'UPDATE outbound_emails SET {assignments} WHERE id = ?', (*fields.values(), email_id))
+
+
+def prune(days=MAIL_RETENTION_DAYS):
+    """Drop sent messages older than the retention window; returns the number deleted."""
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM outbound_emails WHERE status = 'sent' AND sent_at < ?", (_now(-days * 86400),))
+        return c.rowcount
+
+
+def _is_permanent(error):
+    """A 5xx rejection of this message won't succeed on retry; connection errors and 4xx might."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    # A failed login is a configuration problem, not this message's: keep it queued
+    return (isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+            and not isinstance(error, smtplib.SMTPAuthenticationError))
+
+
+def _answered(error):
+    """True when the server replied with an error (other than 421, which closes the connection)."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code != 421
+
+
+class Sender(OnDemandWorker):
+    """Per-process sender thread that owns the SMTP session."""
+
+    thread_name = "mail-sender"
+
+    def __init__(self, client=None):
+        super().__init__()
+        self.client = client or SMTPClient()
+        self._last_prune = 0.0
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    # Nothing due: keep the session open for a while, then let the thread go
+    def idle_seconds(self):
+        return MAIL_SESSION_IDLE_SECONDS
+
+    def poll_interval(self):
+        return MAIL_POLL_INTERVAL
+
+    def on_idle(self):
+        self.client.close()
+
+    def describe_error(self, error):
+        return f"Mail queue: could not claim messages: {error}"
+
+    def next_due(self):
+        return next_due()
+
+    def step(self):
+        if time.monotonic() - self._last_prune > _PRUNE_EVERY:
+            self._last_prune = time.monotonic()
+            prune()
+        batch = _claim(self.worker)
+        if batch:
+            self._send_batch(batch)
+        return bool(batch)
+
+    def _send_batch(self, batch):
+        for i, row in enumerate(batch):
+            started = time.perf_counter()
+            try:
+                self.client.send(build_message(row['to_addr'], row['subject'], row['body']))
+            except Exception as e:
+                self._failed(row, e)
+                if _answered(e):
+                    continue  # The server refused this message but the session is still usable
+                self.client.close()  # The connection broke, maybe mid-reply; start clean
+                for rest in batch[i + 1:]:
+                    # Never reached the server: hand them back untouched for the next claim
+                    _update(rest['id'], status='queued', attempts=rest['attempts'] - 1)
+                return
+            latency = max(0.0, time.time() - _epoch(row['created_at']))
+            _update(row['id'], status='sent', sent_at=_now(), latency_ms=int(latency * 1000), error=None)
+            metrics.inc("mail_total", outcome="sent")
+            metrics.observe("mail_send_seconds", time.perf_counter() - started)
+            metrics.observe("mail_delivery_seconds", latency)
+            logging.info(f"Email #{row['id']} sent to {row['to_addr']} ({latency * 1000:.0f} ms after queueing)")
+
+    def _failed(self, row, error):
+        attempts = row['attempts']
+        retry = attempts < MAIL_MAX_ATTEMPTS and not _is_permanent(error)
+        logging.warning(f"Email #{row['id']} to {row['to_addr']} attempt {attempts} failed: {error}"
+                        + (" (will retry)" if retry else ""))
+        if retry:
+            _update(row['id'], status='queued', error=str(error),
+                    next_attempt_at=_now(MAIL_RETRY_BACKOFF * 2 ** (attempts - 1)))
+        else:
+            _update(row['id'], status='failed', error=str(error))
+        metrics.inc("mail_total", outcome="retry" if retry else "failed")
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def sender():
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = Sender()
+        return _sender
+
+
+def _after_fork_in_child():
+    # Threads and SMTP sockets don't survive fork; each worker builds its own
+    global _sender, _sender_lock
+    _sender = None
+    _sender_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
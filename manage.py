@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the GASsstro backend.
+
+    python manage.py init-db        # create/upgrade the schema (run once per deploy)
+    python manage.py rebuild-stats  # recompute the dashboard rollups from the orders table
+    python manage.py compress-artifacts  # gzip meshes stored before compression was enabled
+    python manage.py dispatch       # assign ready orders to printers and upload them
+    python manage.py worker         # process background jobs (conversion, email) until stopped
+    python manage.py sweep          # delete expired uploads and exports (--dry-run to preview)
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+# Commands call what they need explicitly; importing the app must not do work
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+
+def cmd_init_db(args):
+    from server import init_db
+
+    started = time.perf_counter()
+    init_db()
+    logging.info(f"Database schema ready in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return 0
+
+
+def cmd_rebuild_stats(args):
+    import stats
+
+    started = time.perf_counter()
+    days = stats.rebuild()
+    logging.info(f"Rebuilt stats for {days} days in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return 0
+
+
+def cmd_compress_artifacts(args):
+    import artifacts
+
+    started = time.perf_counter()
+    files, saved = artifacts.compress_tree(args.root)
+    logging.info(f"Compressed {files} file(s), saved {saved / 1024 / 1024:.1f} MB "
+                 f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return 0
+
+
+def cmd_dispatch(args):
+    import printer
+    import scheduler
+
+    assigned = scheduler.dispatch()
+    logging.info(f"Dispatched {len(assigned)} order(s)")
+    # The uploads run on this process's threads; stay until they settle
+    pending = {job_id for _, _, job_id in assigned}
+    while pending:
+        time.sleep(1)
+        pending = {job_id for job_id in pending if printer.get_job(job_id)['status'] in ('queued', 'uploading')}
+    return 0
+
+
+def cmd_worker(args):
+    import jobs
+    import server  # Registers the job handlers and periodic tasks
+
+    jobs.run_worker(args.concurrency or jobs.JOBS_CONCURRENCY)
+    return 0
+
+
+def cmd_sweep(args):
+    import retention
+
+    reports = retention.sweep(args.root, dry_run=args.dry_run)
+    reclaimed = sum(report['bytes'] for report in reports.values())
+    logging.info(f"{'Would reclaim' if args.dry_run else 'Reclaimed'} {reclaimed / 1024 / 1024:.1f} MB")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GASsstro maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("init-db", help="Create or upgrade the database schema").set_defaults(func=cmd_init_db)
+    sub.add_parser("rebuild-stats", help="Recompute the dashboard stats rollups").set_defaults(func=cmd_rebuild_stats)
+    compress = sub.add_parser("compress-artifacts", help="Gzip uncompressed STL files in place")
+    compress.add_argument("--root", default="exports")
+    compress.set_defaults(func=cmd_compress_artifacts)
+    sub.add_parser("dispatch", help="Assign ready orders to printers and upload them").set_defaults(func=cmd_dispatch)
+    worker = sub.add_parser("worker", help="Process background jobs until SIGTERM")
+    worker.add_argument("--concurrency", type=int, default=None, help="Job threads (default JOBS_CONCURRENCY)")
+    worker.set_defaults(func=cmd_worker)
+    sweep = sub.add_parser("sweep", help="Delete expired temp uploads and old exports")
+    sweep.add_argument("--root", default="exports")
+    sweep.add_argument("--dry-run", action="store_true", help="Report what would be deleted")
+    sweep.set_defaults(func=cmd_sweep)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
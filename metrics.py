@@ -0,0 +1,309 @@
+"""
+In-process metrics registry (counters, gauges and latency histograms).
+
+Hot paths record into this module with `inc`, `set_gauge`, `observe` or the
+`timer` context manager. Everything is guarded by a single lock so the
+registry is safe to use from request threads and background workers alike.
+
+Across processes: with METRICS_DIR set (gunicorn.conf.py does so when it runs
+several workers), each process writes its registry to <METRICS_DIR>/<pid>.json
+every METRICS_FLUSH_INTERVAL seconds. `collect()` merges every file into one
+view. Counters and histograms are summed. Gauges are summed, or take the
+maximum when set with mode='max'. When a worker exits, the master folds its
+counters and histograms into archive.json (`mark_process_dead`), so totals
+never go backwards. Its gauges are dropped. `render()` formats a view in the
+Prometheus text exposition format.
+"""
+
+import os
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import accumulate
+
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+ARCHIVE = "archive.json"
+
+# Histogram buckets in seconds, tuned for HTTP calls and DB round-trips
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_gauge_modes = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def inc(name, amount=1, **labels):
+    """Increment a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, mode="sum", **labels):
+    """Set a gauge to an absolute value.
+
+    `mode` says how processes combine: 'sum' for per-process amounts (pool
+    connections, open streams), 'max' for values every process computes alike.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+        _gauge_modes[name] = mode
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Record one observation in a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            # Per-bucket counts; snapshot() turns them into cumulative ones
+            hist = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            _histograms[key] = hist
+        i = bisect_left(hist["buckets"], value)
+        if i < len(hist["counts"]):
+            hist["counts"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the wrapped block and record it in a histogram.
+
+    The block may set `labels['outcome']` (or any other label) on the yielded
+    dict before it exits; an exception marks the outcome as 'error'.
+    """
+    labels.setdefault("outcome", "ok")
+    start = time.perf_counter()
+    try:
+        yield labels
+    except Exception:
+        if labels["outcome"] == "ok":
+            labels["outcome"] = "error"
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def snapshot():
+    """Return a copy of all metrics, keyed by (name, labels)."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {
+                k: {"buckets": v["buckets"], "counts": list(accumulate(v["counts"])), "sum": v["sum"], "count": v["count"]}
+                for k, v in _histograms.items()
+            },
+        }
+
+
+def reset():
+    """Clear every metric (used by tests)."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+# --- Cross-process aggregation ---
+
+def _dump(snap):
+    return {
+        "counters": [[name, labels, value] for (name, labels), value in snap["counters"].items()],
+        "gauges": [[name, labels, value, _gauge_modes.get(name, "sum")]
+                   for (name, labels), value in snap["gauges"].items()],
+        "histograms": [[name, labels, hist] for (name, labels), hist in snap["histograms"].items()],
+    }
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None  # Gone, or being replaced
+    key = lambda name, labels: (name, tuple(tuple(pair) for pair in labels))  # noqa: E731
+    return {
+        "counters": {key(n, l): v for n, l, v in data["counters"]},
+        "gauges": {key(n, l): (v, mode) for n, l, v, mode in data["gauges"]},
+        "histograms": {key(n, l): h for n, l, h in data["histograms"]},
+    }
+
+
+def _merge(into, snap):
+    for key, value in snap["counters"].items():
+        into["counters"][key] = into["counters"].get(key, 0) + value
+    for key, hist in snap["histograms"].items():
+        total = into["histograms"].get(key)
+        if total is None or list(total["buckets"]) != list(hist["buckets"]):
+            into["histograms"][key] = {"buckets": hist["buckets"], "counts": list(hist["counts"]),
+                                       "sum": hist["sum"], "count": hist["count"]}
+        else:
+            total["counts"] = [a + b for a, b in zip(total["counts"], hist["counts"])]
+            total["sum"] += hist["sum"]
+            total["count"] += hist["count"]
+
+
+def _write(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def flush():
+    """Write this process's registry to METRICS_DIR (no-op without it)."""
+    if not METRICS_DIR:
+        return
+    snap = snapshot()
+    with _lock:
+        data = _dump(snap)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), data)
+
+
+def mark_process_dead(pid):
+    """Fold an exited process's counters and histograms into the archive (call from one process only)."""
+    if not METRICS_DIR:
+        return
+    path = os.path.join(METRICS_DIR, f"{pid}.json")
+    dead = _load(path)
+    if dead is None:
+        return
+    archive_path = os.path.join(METRICS_DIR, ARCHIVE)
+    archive = _load(archive_path) or {"counters": {}, "gauges": {}, "histograms": {}}
+    _merge(archive, dead)
+    archive["gauges"] = {}
+    with _lock:
+        data = _dump(archive)
+    _write(archive_path, data)
+    os.remove(path)
+
+
+def collect():
+    """All processes' metrics merged, in the shape of `snapshot()`."""
+    own = snapshot()
+    if not METRICS_DIR:
+        return own
+    flush()
+    merged = {"counters": {}, "gauges": {}, "histograms": {}}
+    try:
+        names = sorted(os.listdir(METRICS_DIR))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        snap = _load(os.path.join(METRICS_DIR, name))
+        if snap is None:
+            continue
+        _merge(merged, snap)
+        for key, (value, mode) in snap["gauges"].items():
+            current = merged["gauges"].get(key)
+            if current is None:
+                merged["gauges"][key] = value
+            else:
+                merged["gauges"][key] = max(current, value) if mode == "max" else current + value
+    return merged
+
+
+class _Flusher:
+    """Background thread writing this process's registry every METRICS_FLUSH_INTERVAL."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if not METRICS_DIR:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                flush()
+            except Exception as e:
+                logging.warning(f"Metrics: could not flush to {METRICS_DIR}: {e}")
+
+
+_flusher = _Flusher()
+
+
+def start_flusher():
+    _flusher.start()
+
+
+def _after_fork_in_child():
+    # A forked worker starts with the parent's numbers; count only its own
+    global _flusher
+    reset()
+    _flusher = _Flusher()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+# --- Prometheus text format ---
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snap=None, prefix="gassstro_"):
+    """Prometheus text exposition of `snap` (default: `collect()`)."""
+    snap = collect() if snap is None else snap
+    lines = []
+
+    def family(items, kind, emit):
+        by_name = {}
+        for (name, labels), value in sorted(items, key=lambda item: item[0]):
+            by_name.setdefault(name, []).append((labels, value))
+        for name, series in by_name.items():
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+            for labels, value in series:
+                emit(prefix + name, labels, value)
+
+    def counter(name, labels, value):
+        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    def histogram(name, labels, hist):
+        for bound, count in zip(hist["buckets"], hist["counts"]):
+            lines.append(f"{name}_bucket{_labels(labels, [('le', _number(float(bound)))])} {count}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {hist['count']}")
+        lines.append(f"{name}_sum{_labels(labels)} {_number(float(hist['sum']))}")
+        lines.append(f"{name}_count{_labels(labels)} {hist['count']}")
+
+    family(snap["counters"].items(), "counter", counter)
+    family(snap["gauges"].items(), "gauge", counter)
+    family(snap["histograms"].items(), "histogram", histogram)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,410 @@
+"""
+Versioned schema migrations, shared by the SQLite and PostgreSQL backends.
+
+Each migration has a version, a name, and per-dialect steps. A step is either
+an SQL string or a callable `step(cursor)` for changes that need to look at
+the existing schema first. Applied versions are recorded in
+`schema_migrations`. Startup only reads that table once the schema is current,
+so there is no per-column probing on every boot.
+
+To change the schema, append a migration with the next version number. Never
+edit one that has already shipped.
+"""
+
+import logging
+
+from db import USE_POSTGRES, get_db_connection
+
+DIALECT = "postgres" if USE_POSTGRES else "sqlite"
+
+# Arbitrary key for pg_advisory_xact_lock, so instances deploying at the same
+# time apply migrations one after the other.
+_PG_LOCK_KEY = 4175001
+
+
+def _columns(c, table):
+    if USE_POSTGRES:
+        c.execute("SELECT column_name AS name FROM information_schema.columns WHERE table_name = %s", (table,))
+    else:
+        c.execute(f"PRAGMA table_info({table})")
+    return {dict(row)["name"] for row in c.fetchall()}
+
+
+def _add_legacy_columns(c):
+    """Bring databases created before these columns existed up to the baseline."""
+    existing = _columns(c, "orders")
+    for column, ddl in [
+        ("stripe_session_id", "stripe_session_id TEXT"),
+        ("payment_status", "payment_status TEXT DEFAULT 'Unpaid'"),
+        ("original_filepath", "original_filepath TEXT"),
+        ("notes", "notes TEXT"),
+    ]:
+        if column not in existing:
+            logging.info(f"Migrating DB: Adding {column}")
+            c.execute(f"ALTER TABLE orders ADD COLUMN {ddl}")
+
+
+def _dedupe_stripe_sessions(c):
+    """Make room for the unique session index.
+
+    Webhook retries could insert the same Checkout Session twice. The first
+    order keeps the session id; later copies get the id with a ':dup:<id>'
+    suffix, so nothing is lost and they stay easy to find.
+    """
+    c.execute('''
+        SELECT id, stripe_session_id FROM orders o
+        WHERE stripe_session_id IS NOT NULL
+          AND id > (SELECT MIN(id) FROM orders d WHERE d.stripe_session_id = o.stripe_session_id)
+    ''')
+    duplicates = [dict(row) for row in c.fetchall()]
+    for row in duplicates:
+        c.execute('UPDATE orders SET stripe_session_id = ? WHERE id = ?',
+                  (f"{row['stripe_session_id']}:dup:{row['id']}", row['id']))
+    if duplicates:
+        logging.warning(f"Migrating DB: {len(duplicates)} duplicate Stripe session order(s) suffixed with ':dup:<id>'")
+
+
+ORDERS_COLUMNS = '''
+                name TEXT,
+                email TEXT,
+                quantity INTEGER,
+                total_price REAL,
+                date_event TEXT,
+                message TEXT,
+                filename TEXT,
+                filepath TEXT,
+                status TEXT DEFAULT 'Pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                stripe_session_id TEXT,
+                payment_status TEXT DEFAULT 'Unpaid',
+                original_filepath TEXT,
+                notes TEXT
+'''
+
+PRINTER_JOBS_COLUMNS = '''
+                order_id INTEGER,
+                printer TEXT NOT NULL,
+                filepath TEXT NOT NULL,
+                remote_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                bytes_total BIGINT,
+                bytes_sent BIGINT NOT NULL DEFAULT 0,
+                bytes_per_second REAL,
+                error TEXT,
+                worker TEXT,
+                created_at TIMESTAMP,
+                started_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                next_attempt_at TIMESTAMP,
+                finished_at TIMESTAMP
+'''
+
+OUTBOUND_EMAILS_COLUMNS = '''
+                order_id INTEGER,
+                to_addr TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                worker TEXT,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                next_attempt_at TIMESTAMP,
+                sent_at TIMESTAMP,
+                latency_ms INTEGER
+'''
+
+JOBS_COLUMNS = '''
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                last_error TEXT,
+                locked_by TEXT,
+                lease_until TIMESTAMP,
+                run_after TIMESTAMP NOT NULL,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                finished_at TIMESTAMP
+'''
+
+STRIPE_EVENTS_SQL = [
+    '''CREATE TABLE IF NOT EXISTS stripe_events (
+        event_id TEXT PRIMARY KEY,
+        type TEXT NOT NULL,
+        session_id TEXT,
+        payload TEXT NOT NULL,
+        order_id INTEGER,
+        received_at TIMESTAMP NOT NULL,
+        processed_at TIMESTAMP
+    )''',
+    # A session completes once, whatever event id a redelivery carries
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_stripe_events_session ON stripe_events (type, session_id)",
+]
+
+PERIODIC_TASKS_SQL = [
+    # One row per jobs.every() task: whoever moves next_run_at forward runs it
+    '''CREATE TABLE IF NOT EXISTS periodic_tasks (
+        name TEXT PRIMARY KEY,
+        next_run_at TIMESTAMP NOT NULL,
+        last_run_at TIMESTAMP,
+        last_run_by TEXT
+    )''',
+]
+
+def _stats_backfill(day):
+    """Migration 7's first fill of the rollups from the orders table.
+
+    A copy of stats.rebuild_in as it was then, so later changes to the live
+    rollup code can't change what this migration does.
+    """
+    return [
+        "DELETE FROM stats_daily",
+        "DELETE FROM stats_counts",
+        f'''INSERT INTO stats_daily (day, orders, stamps, revenue, paid_revenue)
+            SELECT {day}, COUNT(*), COALESCE(SUM(quantity), 0), COALESCE(SUM(total_price), 0),
+                   COALESCE(SUM(CASE WHEN payment_status = 'Paid' THEN total_price ELSE 0 END), 0)
+            FROM orders GROUP BY {day}''',
+        "INSERT INTO stats_counts (dimension, value, count) "
+        "SELECT 'status', COALESCE(status, 'Unknown'), COUNT(*) FROM orders GROUP BY COALESCE(status, 'Unknown')",
+        "INSERT INTO stats_counts (dimension, value, count) SELECT 'payment_status', COALESCE(payment_status, 'Unknown'), "
+        "COUNT(*) FROM orders GROUP BY COALESCE(payment_status, 'Unknown')",
+    ]
+
+
+MIGRATIONS = [
+    (1, "orders table", {
+        "sqlite": [
+            f"CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY AUTOINCREMENT, {ORDERS_COLUMNS})",
+            _add_legacy_columns,
+        ],
+        "postgres": [
+            f"CREATE TABLE IF NOT EXISTS orders (id SERIAL PRIMARY KEY, {ORDERS_COLUMNS})",
+            _add_legacy_columns,
+        ],
+    }),
+    (2, "indexes for admin listing, filters and lookups", {
+        "sqlite": [
+            "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at DESC, id DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_payment_status ON orders (payment_status, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_email ON orders (email)",
+        ],
+        "postgres": [
+            "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at DESC, id DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_payment_status ON orders (payment_status, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_email ON orders (email)",
+        ],
+    }),
+    (3, "unique Stripe session per order", {
+        "sqlite": [
+            _dedupe_stripe_sessions,
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_stripe_session_id ON orders (stripe_session_id)",
+        ],
+        "postgres": [
+            _dedupe_stripe_sessions,
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_stripe_session_id ON orders (stripe_session_id)",
+        ],
+    }),
+    (4, "change versions for conditional GETs", {
+        "sqlite": [
+            "CREATE TABLE IF NOT EXISTS change_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)",
+            "INSERT OR IGNORE INTO change_versions (name, version) VALUES ('orders', 1)",
+        ],
+        "postgres": [
+            "CREATE TABLE IF NOT EXISTS change_versions (name TEXT PRIMARY KEY, version BIGINT NOT NULL DEFAULT 0)",
+            "INSERT INTO change_versions (name, version) VALUES ('orders', 1) ON CONFLICT DO NOTHING",
+        ],
+    }),
+    (5, "order events for the admin event stream", {
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS order_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type TEXT NOT NULL,
+                order_id INTEGER,
+                data TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_order_events_created_at ON order_events (created_at)",
+        ],
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS order_events (
+                id BIGSERIAL PRIMARY KEY,
+                type TEXT NOT NULL,
+                order_id INTEGER,
+                data TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_order_events_created_at ON order_events (created_at)",
+        ],
+    }),
+    (6, "full-text search index", {
+        "sqlite": [
+            # External-content FTS5 table: stores only the index, rows stay in orders
+            """CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+                name, email, message, notes, filename,
+                content='orders', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )""",
+            """CREATE TRIGGER IF NOT EXISTS orders_fts_insert AFTER INSERT ON orders BEGIN
+                INSERT INTO orders_fts (rowid, name, email, message, notes, filename)
+                VALUES (new.id, new.name, new.email, new.message, new.notes, new.filename);
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS orders_fts_delete AFTER DELETE ON orders BEGIN
+                INSERT INTO orders_fts (orders_fts, rowid, name, email, message, notes, filename)
+                VALUES ('delete', old.id, old.name, old.email, old.message, old.notes, old.filename);
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS orders_fts_update AFTER UPDATE OF name, email, message, notes, filename ON orders BEGIN
+                INSERT INTO orders_fts (orders_fts, rowid, name, email, message, notes, filename)
+                VALUES ('delete', old.id, old.name, old.email, old.message, old.notes, old.filename);
+                INSERT INTO orders_fts (rowid, name, email, message, notes, filename)
+                VALUES (new.id, new.name, new.email, new.message, new.notes, new.filename);
+            END""",
+            "INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')",
+        ],
+        "postgres": [
+            # Split emails and filenames on the same separators as SQLite's
+            # unicode61 tokenizer; the GIN expression index keeps itself current
+            """CREATE OR REPLACE FUNCTION orders_search_document(name TEXT, email TEXT, message TEXT, notes TEXT, filename TEXT)
+            RETURNS tsvector LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+                SELECT setweight(to_tsvector('simple', translate(coalesce(name, '') || ' ' || coalesce(email, ''), '@._-/', '     ')), 'A')
+                    || setweight(to_tsvector('simple', translate(coalesce(filename, ''), '@._-/', '     ')), 'B')
+                    || setweight(to_tsvector('simple', coalesce(notes, '')), 'B')
+                    || setweight(to_tsvector('simple', coalesce(message, '')), 'C')
+            $$""",
+            "CREATE INDEX IF NOT EXISTS idx_orders_search ON orders USING GIN (orders_search_document(name, email, message, notes, filename))",
+        ],
+    }),
+    (7, "stats rollups", {
+        "sqlite": [
+            "CREATE TABLE IF NOT EXISTS stats_daily (day TEXT PRIMARY KEY, orders INTEGER NOT NULL, stamps INTEGER NOT NULL, "
+            "revenue REAL NOT NULL, paid_revenue REAL NOT NULL)",
+            "CREATE TABLE IF NOT EXISTS stats_counts (dimension TEXT, value TEXT, count INTEGER NOT NULL, PRIMARY KEY (dimension, value))",
+            *_stats_backfill("DATE(created_at)"),
+        ],
+        "postgres": [
+            "CREATE TABLE IF NOT EXISTS stats_daily (day TEXT PRIMARY KEY, orders INTEGER NOT NULL, stamps BIGINT NOT NULL, "
+            "revenue DOUBLE PRECISION NOT NULL, paid_revenue DOUBLE PRECISION NOT NULL)",
+            "CREATE TABLE IF NOT EXISTS stats_counts (dimension TEXT, value TEXT, count INTEGER NOT NULL, PRIMARY KEY (dimension, value))",
+            *_stats_backfill("CAST(DATE(created_at) AS TEXT)"),
+        ],
+    }),
+    (8, "printer upload jobs", {
+        "sqlite": [
+            f"CREATE TABLE IF NOT EXISTS printer_jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, {PRINTER_JOBS_COLUMNS})",
+            "CREATE INDEX IF NOT EXISTS idx_printer_jobs_queue ON printer_jobs (printer, status, id)",
+            "CREATE INDEX IF NOT EXISTS idx_printer_jobs_order ON printer_jobs (order_id)",
+        ],
+        "postgres": [
+            f"CREATE TABLE IF NOT EXISTS printer_jobs (id SERIAL PRIMARY KEY, {PRINTER_JOBS_COLUMNS})",
+            "CREATE INDEX IF NOT EXISTS idx_printer_jobs_queue ON printer_jobs (printer, status, id)",
+            "CREATE INDEX IF NOT EXISTS idx_printer_jobs_order ON printer_jobs (order_id)",
+        ],
+    }),
+    (9, "printer farm schedule", {
+        "sqlite": [
+            "CREATE TABLE IF NOT EXISTS printers (name TEXT PRIMARY KEY, enabled INTEGER NOT NULL DEFAULT 1, updated_at TIMESTAMP)",
+            "ALTER TABLE printer_jobs ADD COLUMN estimated_seconds INTEGER",
+            "ALTER TABLE printer_jobs ADD COLUMN print_start_at TIMESTAMP",
+            "ALTER TABLE printer_jobs ADD COLUMN print_end_at TIMESTAMP",
+            "CREATE INDEX IF NOT EXISTS idx_printer_jobs_plan ON printer_jobs (printer, print_end_at)",
+        ],
+        "postgres": [
+            "CREATE TABLE IF NOT EXISTS printers (name TEXT PRIMARY KEY, enabled INTEGER NOT NULL DEFAULT 1, updated_at TIMESTAMP)",
+            "ALTER TABLE printer_jobs ADD COLUMN IF NOT EXISTS estimated_seconds INTEGER",
+            "ALTER TABLE printer_jobs ADD COLUMN IF NOT EXISTS print_start_at TIMESTAMP",
+            "ALTER TABLE printer_jobs ADD COLUMN IF NOT EXISTS print_end_at TIMESTAMP",
+            "CREATE INDEX IF NOT EXISTS idx_printer_jobs_plan ON printer_jobs (printer, print_end_at)",
+        ],
+    }),
+    (10, "outbound email queue", {
+        "sqlite": [
+            f"CREATE TABLE IF NOT EXISTS outbound_emails (id INTEGER PRIMARY KEY AUTOINCREMENT, {OUTBOUND_EMAILS_COLUMNS})",
+            "CREATE INDEX IF NOT EXISTS idx_outbound_emails_queue ON outbound_emails (status, next_attempt_at, id)",
+        ],
+        "postgres": [
+            f"CREATE TABLE IF NOT EXISTS outbound_emails (id SERIAL PRIMARY KEY, {OUTBOUND_EMAILS_COLUMNS})",
+            "CREATE INDEX IF NOT EXISTS idx_outbound_emails_queue ON outbound_emails (status, next_attempt_at, id)",
+        ],
+    }),
+    (11, "durable job queue", {
+        "sqlite": [
+            f"CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, {JOBS_COLUMNS})",
+            "CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, run_after, id)",
+            "CREATE INDEX IF NOT EXISTS idx_outbound_emails_order ON outbound_emails (order_id)",
+        ],
+        "postgres": [
+            f"CREATE TABLE IF NOT EXISTS jobs (id BIGSERIAL PRIMARY KEY, {JOBS_COLUMNS})",
+            "CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, run_after, id)",
+            "CREATE INDEX IF NOT EXISTS idx_outbound_emails_order ON outbound_emails (order_id)",
+        ],
+    }),
+    (12, "stripe webhook event log", {
+        "sqlite": STRIPE_EVENTS_SQL,
+        "postgres": STRIPE_EVENTS_SQL,
+    }),
+    (13, "job priorities", {
+        "sqlite": [
+            "ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0",
+            "DROP INDEX IF EXISTS idx_jobs_queue",
+            "CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, priority, id)",
+        ],
+        "postgres": [
+            "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0",
+            "DROP INDEX IF EXISTS idx_jobs_queue",
+            "CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, priority, id)",
+        ],
+    }),
+    (14, "periodic task schedule", {
+        "sqlite": PERIODIC_TASKS_SQL,
+        "postgres": PERIODIC_TASKS_SQL,
+    }),
+]
+
+
+def current_version(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('SELECT MAX(version) AS version FROM schema_migrations')
+    return dict(c.fetchone())['version'] or 0
+
+
+def migrate(target=None):
+    """Apply pending migrations in order; returns the list of versions applied."""
+    target = target or MIGRATIONS[-1][0]
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        version = current_version(c)
+    if version >= target:
+        return []
+
+    applied = []
+    for number, name, steps in MIGRATIONS:
+        if number > target:
+            break
+        # One transaction per migration; re-check under the lock in case
+        # another process got there first.
+        with get_db_connection(write=True) as conn:
+            c = conn.cursor()
+            if USE_POSTGRES:
+                c.execute('SELECT pg_advisory_xact_lock(%s)', (_PG_LOCK_KEY,))
+            if current_version(c) >= number:
+                continue
+            logging.info(f"Applying migration {number}: {name}")
+            for step in steps[DIALECT]:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (number, name))
+        applied.append(number)
+    return applied
@@ -0,0 +1,222 @@
+"""
+Local stand-in for the printer's FTPS server, for tests and manual runs.
+
+Speaks the subset of FTP that the upload queue uses: explicit TLS
+(AUTH TLS, PBSZ, PROT P), login, passive-mode STOR with REST for resumed
+uploads, plus SIZE and NOOP. Received files are kept in memory (`.files`).
+`fail_after` drops the first transfer of a file after that many bytes, to
+exercise resume.
+
+    python mock_printer.py --port 9990 --access-code 12345678
+
+Then run the backend with BAMBU_IP=127.0.0.1 BAMBU_PORT=9990 BAMBU_ACCESS_CODE=12345678.
+A throwaway self-signed certificate is created with the `openssl` CLI unless
+--cert/--key are given.
+"""
+
+import argparse
+import os
+import socket
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+
+
+def make_self_signed_cert(directory):
+    """Create a localhost certificate with the openssl CLI; returns (certfile, keyfile)."""
+    cert, key = os.path.join(directory, "printer.crt"), os.path.join(directory, "printer.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.tls = False
+        self.protect_data = False
+        self.user = None
+        self.authenticated = False
+        self.rest = 0
+        self.pasv = None
+        with self.server.lock:
+            self.server.connections += 1
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply("220 Mock printer ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command, _, arg = line.decode().strip().partition(" ")
+            command = command.upper()
+            with self.server.lock:
+                self.server.commands.append(command)
+            handler = getattr(self, f"cmd_{command}", None)
+            if handler is None:
+                self.reply(f"502 {command} not implemented")
+            elif command not in ("AUTH", "USER", "PASS", "QUIT", "NOOP") and not self.authenticated:
+                self.reply("530 Not logged in")
+            elif handler(arg) is False:
+                break
+        if self.pasv:
+            self.pasv.close()
+
+    def cmd_AUTH(self, arg):
+        self.reply("234 AUTH TLS ok")
+        self.request = self.server.tls_context.wrap_socket(self.request, server_side=True)
+        self.rfile = self.request.makefile("rb")
+        self.wfile = self.request.makefile("wb")
+        self.tls = True
+
+    def cmd_USER(self, arg):
+        self.user = arg
+        self.reply("331 Password required")
+
+    def cmd_PASS(self, arg):
+        if self.tls and self.user == self.server.user and arg == self.server.access_code:
+            self.authenticated = True
+            with self.server.lock:
+                self.server.logins += 1
+            self.reply("230 Logged in")
+        else:
+            self.reply("530 Login incorrect")
+
+    def cmd_PBSZ(self, arg):
+        self.reply("200 PBSZ=0")
+
+    def cmd_PROT(self, arg):
+        self.protect_data = arg.upper() == "P"
+        self.reply("200 Protection level set")
+
+    def cmd_TYPE(self, arg):
+        self.reply("200 Type set")
+
+    def cmd_NOOP(self, arg):
+        self.reply("200 OK")
+
+    def cmd_QUIT(self, arg):
+        self.reply("221 Bye")
+        return False
+
+    def cmd_PASV(self, arg):
+        if self.pasv:
+            self.pasv.close()
+        self.pasv = socket.create_server((self.server.host, 0))
+        port = self.pasv.getsockname()[1]
+        self.reply(f"227 Entering Passive Mode ({self.server.host.replace('.', ',')},{port >> 8},{port & 0xFF})")
+
+    def cmd_REST(self, arg):
+        self.rest = int(arg)
+        self.reply(f"350 Restarting at {self.rest}")
+
+    def cmd_SIZE(self, arg):
+        with self.server.lock:
+            data = self.server.files.get(arg)
+        if data is None:
+            self.reply("550 No such file")
+        else:
+            self.reply(f"213 {len(data)}")
+
+    def cmd_STOR(self, name):
+        if not self.pasv:
+            self.reply("425 Use PASV first")
+            return
+        offset, self.rest = self.rest, 0
+        self.reply("150 Ready for data")
+        conn, _ = self.pasv.accept()
+        self.pasv.close()
+        self.pasv = None
+        if self.protect_data:
+            conn = self.server.tls_context.wrap_socket(conn, server_side=True)
+
+        with self.server.lock:
+            data = bytearray(self.server.files.get(name, b"")[:offset])
+            fail_after = self.server.fail_after if name not in self.server.failed else None
+        aborted = False
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            if fail_after is not None and len(data) >= fail_after:
+                del data[fail_after:]
+                aborted = True
+                break
+        try:
+            if aborted:
+                conn.shutdown(socket.SHUT_RDWR)
+            elif self.protect_data:
+                conn.unwrap()
+        except OSError:
+            pass
+        conn.close()
+
+        with self.server.lock:
+            self.server.files[name] = bytes(data)
+            if aborted:
+                self.server.failed.add(name)
+        self.reply("426 Connection closed; transfer aborted" if aborted else "226 Transfer complete")
+
+
+class MockPrinterServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, access_code="12345678", user="bblp",
+                 certfile=None, keyfile=None, fail_after=None):
+        super().__init__((host, port), _Handler)
+        self.host = host
+        self.user = user
+        self.access_code = access_code
+        self.fail_after = fail_after
+        self.lock = threading.Lock()
+        self.files = {}
+        self.failed = set()
+        self.commands = []
+        self.connections = 0
+        self.logins = 0
+        self._tmpdir = None
+        if not certfile:
+            self._tmpdir = tempfile.TemporaryDirectory()
+            certfile, keyfile = make_self_signed_cert(self._tmpdir.name)
+        self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.tls_context.load_cert_chain(certfile, keyfile)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local printer FTPS stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9990)
+    parser.add_argument("--access-code", default="12345678")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    parser.add_argument("--fail-after", type=int, help="Drop each file's first transfer after this many bytes")
+    args = parser.parse_args()
+
+    server = MockPrinterServer(args.host, args.port, args.access_code, certfile=args.cert, keyfile=args.key,
+                               fail_after=args.fail_after)
+    print(f"Mock printer FTPS listening on {args.host}:{server.port}")
+    server.serve_forever()
@@ -0,0 +1,240 @@
+"""
+Local stand-in for an S3-compatible object store, for tests and manual runs.
+
+Path-style requests only (http://host:port/<bucket>/<key>). Implements what
+storage.py uses: PUT/GET (with Range)/HEAD/DELETE object, server-side copy,
+multipart uploads, ListObjectsV2 (prefix and delimiter) and DeleteObjects.
+Signatures are not checked. Objects are kept in memory (`.buckets`), and
+`.completed_uploads` records the part count of each finished multipart
+upload.
+
+    python mock_s3.py --port 9000
+
+Then run the backend with ARTIFACT_STORAGE=s3 S3_ENDPOINT_URL=http://127.0.0.1:9000
+S3_BUCKET=gassstro S3_ACCESS_KEY_ID=x S3_SECRET_ACCESS_KEY=x.
+"""
+
+import argparse
+import hashlib
+import re
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+_NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class _Object:
+    def __init__(self, data):
+        self.data = data
+        self.etag = f'"{hashlib.md5(data).hexdigest()}"'
+        self.modified = time.time()
+
+
+def _iso(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(ts))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse(self):
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        return unquote(bucket), unquote(key), query
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body=b"", headers=None, head=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+    def _xml(self, status, root, children):
+        parts = "".join(children)
+        body = f'<?xml version="1.0" encoding="UTF-8"?><{root} xmlns="{_NS}">{parts}</{root}>'.encode()
+        self._send(status, body, {"Content-Type": "application/xml"})
+
+    def _error(self, status, code, head=False):
+        if head:
+            return self._send(status, head=True)
+        self._xml(status, "Error", [f"<Code>{code}</Code><Message>{code}</Message>"])
+
+    def _bucket(self, name):
+        with self.server.lock:
+            return self.server.buckets.setdefault(name, {})
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        body = self._body()
+        with self.server.lock:
+            self.server.requests.append(("PUT", key, query.get("partNumber")))
+        objects = self._bucket(bucket)
+        if "uploadId" in query:
+            upload = self.server.uploads.get(query["uploadId"])
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            part = _Object(body)
+            upload["parts"][int(query["partNumber"])] = part
+            return self._send(200, headers={"ETag": part.etag})
+        source = self.headers.get("x-amz-copy-source")
+        if source:
+            src_bucket, _, src_key = unquote(source).lstrip("/").partition("/")
+            original = self._bucket(src_bucket).get(src_key)
+            if original is None:
+                return self._error(404, "NoSuchKey")
+            copy = objects[key] = _Object(original.data)
+            return self._xml(200, "CopyObjectResult",
+                             [f"<LastModified>{_iso(copy.modified)}</LastModified><ETag>{escape(copy.etag)}</ETag>"])
+        obj = objects[key] = _Object(body)
+        self._send(200, headers={"ETag": obj.etag})
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        body = self._body()
+        objects = self._bucket(bucket)
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {"key": key, "parts": {}}
+            return self._xml(200, "InitiateMultipartUploadResult",
+                             [f"<Bucket>{bucket}</Bucket><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>"])
+        if "uploadId" in query:
+            upload = self.server.uploads.pop(query["uploadId"], None)
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            tree = ElementTree.fromstring(body)
+            numbers = [int(e.text) for e in tree.iter() if e.tag.endswith("PartNumber")]
+            obj = objects[key] = _Object(b"".join(upload["parts"][n].data for n in sorted(numbers)))
+            with self.server.lock:
+                self.server.completed_uploads.append((key, len(numbers)))
+            return self._xml(200, "CompleteMultipartUploadResult",
+                             [f"<Bucket>{bucket}</Bucket><Key>{escape(key)}</Key><ETag>{escape(obj.etag)}</ETag>"])
+        if "delete" in query:
+            tree = ElementTree.fromstring(body)
+            keys = [e.text for e in tree.iter() if e.tag.endswith("Key")]
+            with self.server.lock:
+                for name in keys:
+                    objects.pop(name, None)
+            return self._xml(200, "DeleteResult", [f"<Deleted><Key>{escape(k)}</Key></Deleted>" for k in keys])
+        self._error(400, "InvalidRequest")
+
+    def do_GET(self, head=False):
+        bucket, key, query = self._parse()
+        objects = self._bucket(bucket)
+        if not key:
+            return self._list(objects, query)
+        obj = objects.get(key)
+        if obj is None:
+            return self._error(404, "NoSuchKey", head)
+        headers = {"ETag": obj.etag, "Last-Modified": formatdate(obj.modified, usegmt=True),
+                   "Content-Type": "application/octet-stream", "Accept-Ranges": "bytes"}
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and not head:
+            start, end = match.groups()
+            size = len(obj.data)
+            if start == "":
+                start, end = max(size - int(end), 0), size - 1
+            else:
+                start, end = int(start), min(int(end) if end else size - 1, size - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return self._send(206, obj.data[start:end + 1], headers)
+        if head:
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(obj.data)))
+            return self.end_headers()
+        self._send(200, obj.data, headers)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        if "uploadId" in query:
+            self.server.uploads.pop(query["uploadId"], None)
+            with self.server.lock:
+                self.server.aborted_uploads += 1
+        else:
+            objects = self._bucket(bucket)
+            with self.server.lock:
+                objects.pop(key, None)
+        self._send(204)
+
+    def _list(self, objects, query):
+        prefix, delimiter = query.get("prefix", ""), query.get("delimiter")
+        contents, prefixes = [], set()
+        with self.server.lock:
+            items = sorted(objects.items())
+        for name, obj in items:
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter, 1)[0] + delimiter)
+                continue
+            contents.append(f"<Contents><Key>{escape(name)}</Key><LastModified>{_iso(obj.modified)}</LastModified>"
+                            f"<ETag>{escape(obj.etag)}</ETag><Size>{len(obj.data)}</Size></Contents>")
+        common = [f"<CommonPrefixes><Prefix>{escape(p)}</Prefix></CommonPrefixes>" for p in sorted(prefixes)]
+        self._xml(200, "ListBucketResult",
+                  [f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(contents) + len(common)}</KeyCount>"
+                   "<IsTruncated>false</IsTruncated>", *contents, *common])
+
+
+class MockS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), _Handler)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+        self.completed_uploads = []
+        self.aborted_uploads = 0
+        self.requests = []
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def objects(self, bucket):
+        """{key: bytes} snapshot of one bucket."""
+        with self.lock:
+            return {key: obj.data for key, obj in self.buckets.get(bucket, {}).items()}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local S3-compatible object store stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+
+    server = MockS3Server(args.host, args.port)
+    print(f"Mock S3 listening on {server.url} (path-style: {server.url}/<bucket>/<key>)")
+    server.serve_forever()
@@ -0,0 +1,207 @@
+"""
+Local SMTP sink for tests and manual runs.
+
+Speaks the subset of ESMTP that the mail queue uses: EHLO, STARTTLS, AUTH
+PLAIN/LOGIN, MAIL/RCPT/DATA, RSET, NOOP and QUIT. Accepted messages are kept
+in memory (`.messages`, as (recipients, raw bytes) pairs). Failures can be
+injected: `reject` is a set of recipients to refuse with 550, and
+`fail_data` answers that many DATA commands with 451.
+
+    python mock_smtp.py --port 2525
+
+Then run the backend with SMTP_SERVER=127.0.0.1 SMTP_PORT=2525 SMTP_PASSWORD=x.
+STARTTLS is offered when the `openssl` CLI can create a throwaway
+certificate, or when --cert/--key are given.
+"""
+
+import argparse
+import base64
+import shutil
+import socketserver
+import ssl
+import tempfile
+import threading
+
+from mock_printer import make_self_signed_cert
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.tls = False
+        self.authenticated = False
+        self.sender = None
+        self.recipients = []
+        with self.server.lock:
+            self.server.connections += 1
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+        self.wfile.flush()
+
+    def readline(self):
+        return self.rfile.readline().decode("utf-8", "replace").rstrip("\r\n")
+
+    def handle(self):
+        self.reply("220 mock-smtp ESMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command, _, arg = line.decode("utf-8", "replace").strip().partition(" ")
+            command = command.upper()
+            with self.server.lock:
+                self.server.commands.append(command)
+            handler = getattr(self, f"cmd_{command}", None)
+            if handler is None:
+                self.reply(f"502 {command} not implemented")
+            elif handler(arg) is False:
+                break
+
+    def cmd_EHLO(self, arg):
+        features = ["mock-smtp", "AUTH PLAIN LOGIN", "8BITMIME"]
+        if self.server.tls_context and not self.tls:
+            features.append("STARTTLS")
+        for feature in features[:-1]:
+            self.reply(f"250-{feature}")
+        self.reply(f"250 {features[-1]}")
+
+    cmd_HELO = cmd_EHLO
+
+    def cmd_STARTTLS(self, arg):
+        if not self.server.tls_context:
+            self.reply("454 TLS not available")
+            return
+        self.reply("220 Ready to start TLS")
+        self.request = self.server.tls_context.wrap_socket(self.request, server_side=True)
+        self.rfile = self.request.makefile("rb")
+        self.wfile = self.request.makefile("wb")
+        self.tls = True
+
+    def cmd_AUTH(self, arg):
+        mechanism, _, initial = arg.partition(" ")
+        if mechanism.upper() == "PLAIN":
+            if not initial:
+                self.reply("334 ")
+                initial = self.readline()
+            _, user, password = base64.b64decode(initial).decode().split("\0")
+        elif mechanism.upper() == "LOGIN":
+            self.reply("334 " + base64.b64encode(b"Username:").decode())
+            user = base64.b64decode(self.readline()).decode()
+            self.reply("334 " + base64.b64encode(b"Password:").decode())
+            password = base64.b64decode(self.readline()).decode()
+        else:
+            self.reply("504 Unrecognized authentication type")
+            return
+        if self.server.password is not None and password != self.server.password:
+            self.reply("535 Authentication credentials invalid")
+            return
+        self.authenticated = True
+        with self.server.lock:
+            self.server.logins += 1
+        self.reply("235 Authentication successful")
+
+    def cmd_MAIL(self, arg):
+        self.sender = arg.partition(":")[2].strip()
+        self.recipients = []
+        self.reply("250 OK")
+
+    def cmd_RCPT(self, arg):
+        address = arg.partition(":")[2].strip().strip("<>")
+        if address in self.server.reject:
+            self.reply(f"550 No such user {address}")
+            return
+        self.recipients.append(address)
+        self.reply("250 OK")
+
+    def cmd_DATA(self, arg):
+        if not self.recipients:
+            self.reply("503 No valid recipients")
+            return
+        with self.server.lock:
+            fail = self.server.fail_data > 0
+            if fail:
+                self.server.fail_data -= 1
+        if fail:
+            self.reply("451 Temporary local problem, try again")
+            return
+        self.reply("354 End data with <CR><LF>.<CR><LF>")
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if line in (b".\r\n", b".\n", b""):
+                break
+            lines.append(line[1:] if line.startswith(b"..") else line)
+        with self.server.lock:
+            self.server.messages.append((list(self.recipients), b"".join(lines)))
+        if self.server.echo:
+            print(f"Message for {', '.join(self.recipients)}: {sum(map(len, lines))} bytes")
+        self.recipients = []
+        self.reply("250 OK: queued")
+
+    def cmd_RSET(self, arg):
+        self.sender, self.recipients = None, []
+        self.reply("250 OK")
+
+    def cmd_NOOP(self, arg):
+        self.reply("250 OK")
+
+    def cmd_QUIT(self, arg):
+        self.reply("221 Bye")
+        return False
+
+
+class MockSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, password=None, certfile=None, keyfile=None, tls=True):
+        super().__init__((host, port), _Handler)
+        self.password = password
+        self.lock = threading.Lock()
+        self.messages = []
+        self.commands = []
+        self.reject = set()
+        self.fail_data = 0
+        self.echo = False
+        self.connections = 0
+        self.logins = 0
+        self._tmpdir = None
+        self.tls_context = None
+        if tls and not certfile and shutil.which("openssl"):
+            self._tmpdir = tempfile.TemporaryDirectory()
+            certfile, keyfile = make_self_signed_cert(self._tmpdir.name)
+        if tls and certfile:
+            self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls_context.load_cert_chain(certfile, keyfile)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local SMTP sink")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--password", help="Require this password (any is accepted by default)")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    parser.add_argument("--no-tls", action="store_true", help="Don't offer STARTTLS")
+    args = parser.parse_args()
+
+    server = MockSMTPServer(args.host, args.port, args.password, args.cert, args.key, tls=not args.no_tls)
+    server.echo = True
+    print(f"Mock SMTP listening on {args.host}:{server.port} (STARTTLS {'on' if server.tls_context else 'off'})")
+    server.serve_forever()
@@ -0,0 +1,175 @@
+"""
+Local stand-in for the Stripe API, for tests and load tests.
+
+Implements just what the backend uses: creating and retrieving Checkout
+Sessions. It can also fire a signed `checkout.session.completed` webhook at the
+backend, so a full order can be driven end to end without touching Stripe.
+
+    python mock_stripe.py --port 12111 --latency 0.3 \\
+        --webhook-url http://127.0.0.1:5000/api/webhook --webhook-secret whsec_test
+
+Then start the backend with STRIPE_API_BASE=http://127.0.0.1:12111 and complete
+a session with `curl -X POST http://127.0.0.1:12111/_mock/sessions/<id>/complete`.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+def _parse_form(body):
+    """Decode Stripe's form encoding, keeping `metadata[...]` as a dict."""
+    params = {"metadata": {}}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        match = re.fullmatch(r"metadata\[(.+)\]", key)
+        if match:
+            params["metadata"][match.group(1)] = value
+        else:
+            params[key] = value
+    return params
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Build a `Stripe-Signature` header the same way Stripe does."""
+    timestamp = int(timestamp or time.time())
+    signed = f"{timestamp}.{payload}".encode()
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so client pooling is observable
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Request-Id", f"req_{uuid.uuid4().hex[:14]}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode() if length else ""
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+
+        if self.path == "/v1/checkout/sessions":
+            params = _parse_form(body)
+            session_id = f"cs_test_{uuid.uuid4().hex}"
+            session = {
+                "id": session_id,
+                "object": "checkout.session",
+                "url": f"{self.server.url}/pay/{session_id}",
+                "mode": params.get("mode", "payment"),
+                "payment_status": "unpaid",
+                "status": "open",
+                "success_url": params.get("success_url"),
+                "cancel_url": params.get("cancel_url"),
+                "metadata": params["metadata"],
+            }
+            with self.server.lock:
+                self.server.sessions[session_id] = session
+            return self._send_json(200, session)
+
+        match = re.fullmatch(r"/_mock/sessions/([\w-]+)/complete", self.path)
+        if match:
+            session = self.server.sessions.get(match.group(1))
+            if not session:
+                return self._send_json(404, {"error": {"message": "No such session"}})
+            status = self.server.complete(session)
+            return self._send_json(200, {"webhook_status": status})
+
+        self._send_json(404, {"error": {"message": f"Unrecognized request URL (POST: {self.path})"}})
+
+    def do_GET(self):
+        match = re.fullmatch(r"/v1/checkout/sessions/([\w-]+)", self.path)
+        session = self.server.sessions.get(match.group(1)) if match else None
+        if session:
+            return self._send_json(200, session)
+        self._send_json(404, {"error": {"message": "No such checkout.session"}})
+
+
+class MockStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, webhook_url=None, webhook_secret=None):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.sessions = {}
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def complete(self, session):
+        """Mark a session paid and deliver `checkout.session.completed`."""
+        session.update(payment_status="paid", status="complete")
+        event = {
+            "id": f"evt_{uuid.uuid4().hex}",
+            "object": "event",
+            "type": "checkout.session.completed",
+            "created": int(time.time()),
+            "data": {"object": session},
+        }
+        if not self.webhook_url:
+            return None
+        payload = json.dumps(event)
+        headers = {"Content-Type": "application/json"}
+        if self.webhook_secret:
+            headers["Stripe-Signature"] = sign_payload(payload, self.webhook_secret)
+        req = urllib.request.Request(self.webhook_url, data=payload.encode(), headers=headers, method="POST")
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Stripe API stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to delay each API call")
+    parser.add_argument("--webhook-url")
+    parser.add_argument("--webhook-secret")
+    args = parser.parse_args()
+
+    server = MockStripeServer(args.host, args.port, args.latency, args.webhook_url, args.webhook_secret)
+    print(f"Mock Stripe listening on {server.url}")
+    server.serve_forever()
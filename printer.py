@@ -0,0 +1,311 @@
+"""
+Background upload queue for the printer's FTPS server.
+
+`enqueue()` records a job in `printer_jobs` and returns at once. Each worker
+process starts an uploader thread per printer when it has work. The thread
+claims queued jobs from the table and uploads them over one authenticated FTPS
+session, which it reuses until the session has been idle for
+PRINTER_SESSION_IDLE_SECONDS. A failed transfer drops the session, since its
+control channel can be left mid-reply. The job then goes back to the queue
+with exponential backoff and resumes from the bytes the printer already has
+(SIZE, then REST + STOR). Job state, progress and throughput live in the
+table, so any worker can answer a status request.
+
+Printers are listed in PRINTERS as comma-separated `name=host[:port]/access_code`
+entries; without it a BAMBU_IP printer, if one is set, is registered as
+"default". With neither, the farm is empty and nothing is uploaded.
+scheduler.py decides which printer gets which order.
+
+Test locally against mock_printer.py.
+"""
+
+import os
+import time
+import ftplib
+import socket
+import logging
+import threading
+
+import metrics
+import artifacts
+from workers import OnDemandWorker
+from db import USE_POSTGRES, get_db_connection
+
+BAMBU_IP = os.environ.get("BAMBU_IP", "192.168.1.108")
+BAMBU_PORT = int(os.environ.get("BAMBU_PORT", "990"))
+BAMBU_USER = os.environ.get("BAMBU_USER", "bblp")
+BAMBU_ACCESS_CODE = os.environ.get("BAMBU_ACCESS_CODE", "CHANGE_ME")
+
+PRINTERS = os.environ.get("PRINTERS", "")  # e.g. "p1=192.168.1.108/12345678,p2=192.168.1.109:990/87654321"
+
+PRINTER_TIMEOUT = float(os.environ.get("PRINTER_TIMEOUT", "10"))  # Socket timeout per FTP operation
+PRINTER_MAX_ATTEMPTS = int(os.environ.get("PRINTER_MAX_ATTEMPTS", "4"))
+PRINTER_RETRY_BACKOFF = float(os.environ.get("PRINTER_RETRY_BACKOFF", "2"))  # Seconds, doubled per attempt
+PRINTER_SESSION_IDLE_SECONDS = float(os.environ.get("PRINTER_SESSION_IDLE_SECONDS", "120"))
+PRINTER_STALE_SECONDS = float(os.environ.get("PRINTER_STALE_SECONDS", "300"))  # Requeue 'uploading' jobs silent this long
+PRINTER_POLL_INTERVAL = 1.0
+PRINTER_BLOCK_SIZE = 64 * 1024
+_PROGRESS_EVERY = 0.5  # Seconds between progress writes
+
+# Called with the job after its upload fails for good (scheduler.py re-dispatches the order)
+upload_failed_hooks = []
+
+JOB_FIELDS = ('id', 'order_id', 'printer', 'remote_name', 'status', 'attempts', 'bytes_total', 'bytes_sent',
+              'bytes_per_second', 'error', 'created_at', 'started_at', 'finished_at',
+              'estimated_seconds', 'print_start_at', 'print_end_at')
+
+
+def parse_registry(spec):
+    """{name: {host, port, access_code}} from a PRINTERS string."""
+    registry = {}
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        name, _, target = entry.partition("=")
+        address, _, access_code = target.partition("/")
+        host, _, port = address.partition(":")
+        if not (name and host and access_code):
+            raise ValueError(f"Bad PRINTERS entry {entry!r}; expected name=host[:port]/access_code")
+        registry[name.strip()] = {"host": host, "port": int(port or BAMBU_PORT), "access_code": access_code}
+    return registry
+
+
+# The BAMBU_* defaults are placeholders: only a printer that was configured joins the farm
+REGISTRY = parse_registry(PRINTERS) or ({
+    "default": {"host": BAMBU_IP, "port": BAMBU_PORT, "access_code": BAMBU_ACCESS_CODE},
+} if os.environ.get("BAMBU_IP") else {})
+
+
+def _now(offset=0.0):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() + offset))
+
+
+class PrinterClient:
+    """One reusable, authenticated FTPS session to a printer."""
+
+    def __init__(self, host=BAMBU_IP, port=BAMBU_PORT, access_code=BAMBU_ACCESS_CODE, user=BAMBU_USER,
+                 timeout=PRINTER_TIMEOUT, name="default"):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.access_code = access_code
+        self.timeout = timeout
+        self.name = name
+        self._ftps = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        with metrics.timer("printer_connect_seconds", printer=self.name):
+            ftps = ftplib.FTP_TLS(timeout=self.timeout)
+            ftps.connect(self.host, self.port)
+            ftps.login(self.user, self.access_code)
+            ftps.prot_p()
+        metrics.inc("printer_sessions_total", printer=self.name)
+        logging.info(f"Printer {self.name}: FTPS session open to {self.host}:{self.port}")
+        return ftps
+
+    def session(self):
+        """The open session, checked with NOOP if it sat idle; reconnects as needed."""
+        if self._ftps is not None and time.monotonic() - self._last_used > 30:
+            try:
+                self._ftps.voidcmd("NOOP")
+            except (OSError, EOFError, ftplib.Error):
+                self.close()
+        if self._ftps is None:
+            self._ftps = self._connect()
+        self._last_used = time.monotonic()
+        return self._ftps
+
+    def remote_size(self, remote_name):
+        try:
+            return self.session().size(remote_name)
+        except ftplib.error_perm:
+            return None
+
+    def upload(self, fileobj, remote_name, offset=0, callback=None):
+        ftps = self.session()
+        ftps.storbinary(f"STOR {remote_name}", fileobj, PRINTER_BLOCK_SIZE, callback, rest=offset or None)
+        self._last_used = time.monotonic()
+
+    @property
+    def connected(self):
+        return self._ftps is not None
+
+    def close(self):
+        ftps, self._ftps = self._ftps, None
+        if ftps is None:
+            return
+        try:
+            ftps.quit()
+        except (OSError, EOFError, ftplib.Error):
+            ftps.close()
+
+
+# --- Job table ---
+
+def insert_job(c, order_id, filepath, printer, remote_name=None, **plan):
+    """Add a queued job inside the caller's transaction; returns its id. Wake the uploader after commit."""
+    fields = {'order_id': order_id, 'printer': printer, 'filepath': filepath,
+              'remote_name': remote_name or os.path.basename(filepath), 'status': 'queued', 'created_at': _now(), **plan}
+    c.execute(f"INSERT INTO printer_jobs ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})"
+              + (' RETURNING id' if USE_POSTGRES else ''), tuple(fields.values()))
+    metrics.inc("printer_jobs_total", printer=printer, outcome="queued")
+    return c.fetchone()['id'] if USE_POSTGRES else c.lastrowid
+
+
+def enqueue(order_id, filepath, remote_name=None, printer="default"):
+    """Queue `filepath` (a logical exports/ path) for upload; returns the job."""
+    with get_db_connection(write=True) as conn:
+        job_id = insert_job(conn.cursor(), order_id, filepath, printer, remote_name)
+    uploader(printer).wake()
+    return get_job(job_id)
+
+
+def get_job(job_id):
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM printer_jobs WHERE id = ?", (job_id,))
+        row = c.fetchone()
+    return dict(row) if row else None
+
+
+def list_jobs(order_id=None, limit=50):
+    where, params = ('WHERE order_id = ?', [order_id]) if order_id is not None else ('', [])
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM printer_jobs {where} ORDER BY id DESC LIMIT ?",
+                  params + [limit])
+        return [dict(row) for row in c.fetchall()]
+
+
+def _claim(printer, worker):
+    """Atomically take the next due job (or a stale one a dead worker left behind)."""
+    now = _now()
+    due = ("printer = ? AND ((status = 'queued' AND (next_attempt_at IS NULL OR next_attempt_at <= ?)) "
+           "OR (status = 'uploading' AND updated_at < ?))")
+    params = (printer, now, _now(-PRINTER_STALE_SECONDS))
+    lock = ' FOR UPDATE SKIP LOCKED' if USE_POSTGRES else ''
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            UPDATE printer_jobs SET status = 'uploading', attempts = attempts + 1, worker = ?,
+                started_at = COALESCE(started_at, ?), updated_at = ?
+            WHERE id = (SELECT id FROM printer_jobs WHERE {due} ORDER BY id LIMIT 1{lock}) AND {due}
+            RETURNING id, order_id, filepath, remote_name, attempts
+        ''', (worker, now, now) + params + params)
+        row = c.fetchone()
+    return dict(row) if row else None
+
+
+def _update(job_id, **fields):
+    fields['updated_at'] = _now()
+    assignments = ', '.join(f'{key} = ?' for key in fields)
+    with get_db_connection(write=True) as conn:
+        conn.cursor().execute(f'UPDATE printer_jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+
+class Uploader(OnDemandWorker):
+    """Per-process, per-printer upload thread that owns the FTPS session."""
+
+    def __init__(self, printer="default", client=None):
+        super().__init__()
+        self.printer = printer
+        self.client = client or PrinterClient(name=printer)
+        self.thread_name = f"printer-{printer}"
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    # Nothing due: keep the session warm for a while, then let the thread go
+    def idle_seconds(self):
+        return PRINTER_SESSION_IDLE_SECONDS
+
+    def poll_interval(self):
+        return PRINTER_POLL_INTERVAL
+
+    def on_idle(self):
+        self.client.close()
+
+    def describe_error(self, error):
+        return f"Printer {self.printer}: could not claim a job: {error}"
+
+    def step(self):
+        job = _claim(self.printer, self.worker)
+        if job:
+            self._process(job)
+        return bool(job)
+
+    def _process(self, job):
+        job_id, path, remote_name = job['id'], job['filepath'], job['remote_name']
+        started = time.perf_counter()
+        sent = offset = 0
+        try:
+            total = artifacts.size(path)
+            if job['attempts'] > 1:
+                # Resume from what the printer already has
+                have = self.client.remote_size(remote_name) or 0
+                offset = have if have < total else 0
+            _update(job_id, bytes_total=total, bytes_sent=offset, error=None)
+
+            last_report = time.monotonic()
+
+            def progress(block):
+                nonlocal sent, last_report
+                sent += len(block)
+                if time.monotonic() - last_report >= _PROGRESS_EVERY:
+                    last_report = time.monotonic()
+                    elapsed = time.perf_counter() - started
+                    _update(job_id, bytes_sent=offset + sent, bytes_per_second=sent / elapsed if elapsed else None)
+
+            with artifacts.open_artifact(path, offset) as f:
+                self.client.upload(f, remote_name, offset, progress)
+        except Exception as e:
+            self.client.close()  # The control channel may be mid-reply; start clean
+            self._failed(job, e, offset + sent)
+            return
+
+        elapsed = time.perf_counter() - started
+        rate = sent / elapsed if elapsed else None
+        _update(job_id, status='done', bytes_sent=offset + sent, bytes_per_second=rate, finished_at=_now())
+        metrics.inc("printer_jobs_total", printer=self.printer, outcome="done")
+        metrics.inc("printer_upload_bytes_total", sent, printer=self.printer)
+        metrics.observe("printer_upload_seconds", elapsed, printer=self.printer)
+        logging.info(f"Printer {self.printer}: job #{job_id} uploaded {remote_name} "
+                     f"({offset + sent} bytes, resumed at {offset}, {(rate or 0) / 1024:.0f} KiB/s)")
+
+    def _failed(self, job, error, bytes_sent):
+        attempts = job['attempts']
+        retry = attempts < PRINTER_MAX_ATTEMPTS and not isinstance(error, FileNotFoundError)
+        logging.warning(f"Printer {self.printer}: job #{job['id']} attempt {attempts} failed: {error}"
+                        + (" (will retry)" if retry else ""))
+        if retry:
+            backoff = PRINTER_RETRY_BACKOFF * 2 ** (attempts - 1)
+            _update(job['id'], status='queued', error=str(error), bytes_sent=bytes_sent,
+                    next_attempt_at=_now(backoff))
+        else:
+            _update(job['id'], status='failed', error=str(error), bytes_sent=bytes_sent, finished_at=_now())
+        metrics.inc("printer_jobs_total", printer=self.printer, outcome="retry" if retry else "failed")
+        if not retry:
+            for hook in upload_failed_hooks:
+                try:
+                    hook(job)
+                except Exception as e:
+                    logging.error(f"Printer {self.printer}: job #{job['id']} failure hook failed: {e}")
+
+
+_uploaders = {}
+_uploaders_lock = threading.Lock()
+
+
+def uploader(printer="default"):
+    with _uploaders_lock:
+        if printer not in _uploaders:
+            # Jobs for a printer since removed from the registry fall back to the BAMBU_* one
+            _uploaders[printer] = Uploader(printer, PrinterClient(name=printer, **REGISTRY.get(printer, {})))
+        return _uploaders[printer]
+
+
+def _after_fork_in_child():
+    # Threads and FTPS sockets don't survive fork; each worker builds its own
+    global _uploaders_lock
+    _uploaders.clear()
+    _uploaders_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
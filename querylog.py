@@ -0,0 +1,162 @@
+"""
+Per-statement SQL timing, per-request query counts and the slow-query log.
+
+Every cursor handed out by db.get_db_connection() reports each execute() here
+(SQLite and PostgreSQL alike). The statement is timed into the
+db_query_seconds{op} histogram and counted against the current request.
+
+- A statement slower than DB_SLOW_QUERY_MS is logged once, with its SQL
+  normalized (literals become ?, whitespace and IN lists collapsed) and its
+  parameters redacted to their types. Customer names and emails never
+  reach the log.
+- With DB_EXPLAIN_SLOW_QUERIES=true the log also carries the plan (EXPLAIN
+  on PostgreSQL, EXPLAIN QUERY PLAN on SQLite). Only SELECT/INSERT/UPDATE/
+  DELETE/WITH statements are explained, and only after they succeed.
+- server.py brackets each request with `begin_request()` / `end_request()`.
+  That gives db_queries_per_request and a warning when one request runs
+  more than DB_QUERIES_PER_REQUEST_WARN statements, which usually means a
+  loop is querying row by row.
+
+    DB_SLOW_QUERY_MS=250
+    DB_EXPLAIN_SLOW_QUERIES=false
+    DB_QUERIES_PER_REQUEST_WARN=100
+"""
+
+import os
+import re
+import time
+import logging
+import functools
+import contextvars
+
+import metrics
+
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "250"))
+DB_EXPLAIN_SLOW_QUERIES = os.environ.get("DB_EXPLAIN_SLOW_QUERIES", "false").lower() == "true"
+DB_QUERIES_PER_REQUEST_WARN = int(os.environ.get("DB_QUERIES_PER_REQUEST_WARN", "100"))
+
+# Most requests run a handful of statements; the top buckets catch N+1 loops
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+MAX_LOGGED_SQL = 1000
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_SPACE = re.compile(r"\s+")
+
+_request = contextvars.ContextVar("querylog_request", default=None)
+
+
+@functools.lru_cache(maxsize=1024)  # Statements are mostly constant strings
+def operation(sql):
+    """First keyword of a statement (SELECT, UPDATE, ...), for metric labels."""
+    word = sql.lstrip().split(None, 1)[:1]
+    op = word[0].upper() if word else ''
+    return op if op in EXPLAINABLE or op in ('BEGIN', 'PRAGMA', 'CREATE', 'ALTER', 'DROP') else 'OTHER'
+
+
+def normalize(sql):
+    """The statement's shape: literals replaced by ?, whitespace and IN (?, ?, ...) collapsed."""
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _IN_LIST.sub("IN (?, ...)", sql)
+    sql = _SPACE.sub(" ", sql).strip()
+    return sql if len(sql) <= MAX_LOGGED_SQL else sql[:MAX_LOGGED_SQL] + "..."
+
+
+def _redact_value(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def redact(params):
+    """Parameters with their values replaced by type (and length for strings)."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _redact_value(value) for key, value in params.items()}
+    return [_redact_value(value) for value in params]
+
+
+class _RequestStats:
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+def begin_request():
+    """Start counting statements for the current request; returns a token for `end_request`."""
+    return _request.set(_RequestStats())
+
+
+def end_request(token, route=None):
+    """Stop counting and record the request's totals; returns (queries, seconds)."""
+    stats = _request.get()
+    _request.reset(token)
+    if stats is None:
+        return 0, 0.0
+    metrics.observe("db_queries_per_request", stats.queries, buckets=QUERY_COUNT_BUCKETS)
+    metrics.observe("db_time_per_request_seconds", stats.seconds)
+    if stats.queries > DB_QUERIES_PER_REQUEST_WARN:
+        logging.warning(f"{route or 'Request'} ran {stats.queries} SQL statements "
+                        f"({stats.seconds * 1000:.0f} ms in the database)")
+    return stats.queries, stats.seconds
+
+
+def _explain(cursor_factory, sql, params, postgres):
+    """The statement's plan as text lines."""
+    cur = cursor_factory()
+    try:
+        if postgres:
+            # A failed EXPLAIN must not abort the caller's transaction
+            cur.execute("SAVEPOINT querylog_explain")
+            try:
+                cur.execute("EXPLAIN " + sql, params)
+                plan = [row["QUERY PLAN"] if isinstance(row, dict) else row[0] for row in cur.fetchall()]
+            finally:
+                cur.execute("ROLLBACK TO SAVEPOINT querylog_explain")
+            return plan
+        cur.execute("EXPLAIN QUERY PLAN " + sql, params or ())
+        return [row[3] for row in cur.fetchall()]
+    except Exception as e:
+        return [f"(no plan: {str(e).splitlines()[0] if str(e) else type(e).__name__})"]
+    finally:
+        cur.close()
+
+
+def record(sql, params, elapsed, backend, explain=None, many=False):
+    """Account one executed statement; `explain` is a zero-argument cursor factory for plans."""
+    op = operation(sql)
+    metrics.observe("db_query_seconds", elapsed, op=op, backend=backend)
+    stats = _request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += elapsed
+    if elapsed * 1000 < DB_SLOW_QUERY_MS:
+        return
+    metrics.inc("db_slow_queries_total", op=op, backend=backend)
+    shown = "(executemany)" if many else redact(params)
+    message = f"Slow query ({elapsed * 1000:.0f} ms, {backend}): {normalize(sql)} params={shown}"
+    if explain is not None and DB_EXPLAIN_SLOW_QUERIES and not many and op in EXPLAINABLE:
+        message += "\n    " + "\n    ".join(_explain(explain, sql, params, backend == "postgres"))
+    logging.warning(message)
+
+
+def timed(execute, sql, params, backend, explain=None, many=False):
+    """Run `execute()` and record it; failures are timed too but never explained."""
+    started = time.perf_counter()
+    try:
+        result = execute()
+    except Exception:
+        record(sql, params, time.perf_counter() - started, backend, many=many)
+        raise
+    record(sql, params, time.perf_counter() - started, backend, explain, many)
+    return result
@@ -0,0 +1,177 @@
+"""
+Rate-limit counters shared by every worker process on one host.
+
+Flask-Limiter's `memory://` storage lives inside one process, so with N
+gunicorn workers each limit is really N times the configured one. The
+counters also reset whenever a worker is recycled. This module registers a
+`sqlite://` storage with the `limits` package. The counters live in a
+local SQLite file in WAL mode, which every worker opens. A hit is a single
+UPSERT ... RETURNING statement. SQLite's write lock makes it atomic across
+processes, and no external service is needed.
+
+    RATELIMIT_STORAGE_URI=sqlite:///ratelimit.db      # relative to the working directory
+    RATELIMIT_STORAGE_URI=sqlite:////var/run/app/rl.db  # absolute
+
+Counters are disposable, so the file skips fsync (synchronous=OFF). A crash
+can lose the last few hits, never the file. Only the fixed-window strategy
+(Flask-Limiter's default) is supported.
+
+    python ratelimit.py --bench   # cost per hit against memory://
+"""
+
+import os
+import time
+import sqlite3
+import argparse
+import threading
+
+from limits.storage import Storage
+
+RATELIMIT_BUSY_TIMEOUT_MS = 5000
+RATELIMIT_PURGE_INTERVAL = 60.0  # Seconds between sweeps of expired counters
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS counters (
+        key TEXT PRIMARY KEY,
+        count INTEGER NOT NULL,
+        expires_at REAL NOT NULL
+    ) WITHOUT ROWID
+'''
+
+# A counter whose window has passed starts over, in the same statement
+_INCR = '''
+    INSERT INTO counters (key, count, expires_at) VALUES (?1, ?2, ?3 + ?4)
+    ON CONFLICT (key) DO UPDATE SET
+        count = CASE WHEN expires_at <= ?3 THEN ?2 ELSE count + ?2 END,
+        expires_at = CASE WHEN expires_at <= ?3 THEN ?3 + ?4 ELSE expires_at END
+    RETURNING count
+'''
+
+
+class SQLiteStorage(Storage):
+    """`limits` storage backed by a SQLite file; one connection per thread."""
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        # sqlite:///relative.db or sqlite:////absolute.db, as in SQLAlchemy
+        self.path = (uri or "sqlite:///ratelimit.db").split("://", 1)[1][1:] or "ratelimit.db"
+        self._local = threading.local()
+        self._next_purge = 0.0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        os.register_at_fork(after_in_child=self._after_fork_in_child)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _after_fork_in_child(self):
+        # A connection must not cross fork(); each process opens its own
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=RATELIMIT_BUSY_TIMEOUT_MS / 1000,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute(f"PRAGMA busy_timeout = {RATELIMIT_BUSY_TIMEOUT_MS}")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _purge(self, conn, now):
+        if now >= self._next_purge:
+            self._next_purge = now + RATELIMIT_PURGE_INTERVAL
+            conn.execute("DELETE FROM counters WHERE expires_at <= ?", (now,))
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        conn = self._conn()
+        self._purge(conn, now)
+        return conn.execute(_INCR, (key, amount, now, expiry)).fetchone()[0]
+
+    def get(self, key):
+        row = self._conn().execute("SELECT count FROM counters WHERE key = ? AND expires_at > ?",
+                                   (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._conn().execute("SELECT expires_at FROM counters WHERE key = ? AND expires_at > ?",
+                                   (key, now)).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            self._conn().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self._conn().execute("DELETE FROM counters").rowcount
+
+    def clear(self, key):
+        self._conn().execute("DELETE FROM counters WHERE key = ?", (key,))
+
+
+# --- Benchmark ---
+
+def _bench_worker(uri, hits, keys, results=None):
+    from limits import parse
+    from limits.storage import storage_from_string
+    from limits.strategies import FixedWindowRateLimiter
+
+    limiter = FixedWindowRateLimiter(storage_from_string(uri))
+    # What one request costs: the two default limits plus a route limit
+    limits = [parse("2000 per day"), parse("500 per hour"), parse("20 per minute")]
+    started = time.perf_counter()
+    for i in range(hits):
+        for item in limits:
+            limiter.hit(item, f"10.0.0.{i % keys}")
+    elapsed = time.perf_counter() - started
+    if results is not None:
+        results.put(elapsed)
+    return elapsed
+
+
+def bench(hits=20000, processes=4, path="ratelimit-bench.db"):
+    """Print microseconds per request (3 limit checks) for memory:// and sqlite://."""
+    import multiprocessing
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    uri = f"sqlite:///{path}"
+    try:
+        for name, target in (("memory://", "memory://"), ("sqlite://", uri)):
+            elapsed = _bench_worker(target, hits, 64)
+            print(f"{name:10} 1 process:  {elapsed / hits * 1e6:7.1f} us/request")
+        # Shared counters only matter across processes; memory:// has nothing to compare here
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_bench_worker, args=(uri, hits, 64, results))
+                   for _ in range(processes)]
+        started = time.perf_counter()
+        for w in workers:
+            w.start()
+        per_process = [results.get() for _ in workers]
+        for w in workers:
+            w.join()
+        wall = time.perf_counter() - started
+        print(f"{'sqlite://':10} {processes} processes: {sum(per_process) / len(per_process) / hits * 1e6:7.1f} "
+              f"us/request each, {processes * hits / wall:,.0f} requests/s in total")
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the shared rate-limit storage")
+    parser.add_argument("--bench", action="store_true", required=True)
+    parser.add_argument("--hits", type=int, default=20000)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+    bench(args.hits, args.processes)
@@ -0,0 +1,150 @@
+"""
+Retention sweeps for exports/.
+
+Uploads land in exports/temp/<YYYY-MM-DD>/ while the customer pays. A paid
+order moves its file to exports/<YYYY-MM-DD>/, next to the converted STL. The
+sweep deletes:
+- temp uploads older than RETENTION_TEMP_HOURS. Their Stripe session was
+  abandoned, unless a recorded payment event still points at them.
+- order files older than RETENTION_EXPORT_DAYS. Files that an unfinished
+  order (status other than Done) or a pending printer upload still uses are
+  kept.
+
+The day in each directory name bounds the scan. Directories newer than the
+cutoff are never listed. Older ones are listed through storage.py (os.scandir
+on disk, ListObjectsV2 on S3). Live paths are looked up per directory in one
+query. Files are deleted in batches of RETENTION_BATCH (one DeleteObjects call
+on S3), and an emptied directory is removed. So the next sweep only revisits
+directories that still hold live files.
+
+It runs every RETENTION_INTERVAL seconds as a periodic job task (in the web
+processes or `python manage.py worker`), or once with
+`python manage.py sweep [--dry-run]`.
+
+    RETENTION_EXPORT_DAYS=30
+    RETENTION_TEMP_HOURS=24
+    RETENTION_INTERVAL=3600
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import datetime
+
+import metrics
+import storage
+import artifacts
+from db import get_db_connection
+
+RETENTION_EXPORT_DAYS = float(os.environ.get("RETENTION_EXPORT_DAYS", "30"))
+RETENTION_TEMP_HOURS = float(os.environ.get("RETENTION_TEMP_HOURS", "24"))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))  # Seconds between sweeps
+RETENTION_BATCH = 500
+
+FINISHED_STATUSES = ('Done',)
+PENDING_UPLOAD_STATUSES = ('queued', 'uploading')
+
+_DAY = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def _day_dirs(root, cutoff):
+    """(path, day) of the day directories under `root` on or before the cutoff day, oldest first."""
+    last = datetime.datetime.fromtimestamp(cutoff).strftime('%Y-%m-%d')
+    days = [name for name in storage.list_dirs(root) if _DAY.match(name) and name <= last]
+    return [(os.path.join(root, day), day) for day in sorted(days)]
+
+
+def _live_paths(c, directory):
+    """Files under `directory` that unfinished orders, pending uploads or unprocessed payments use."""
+    prefix = os.path.join(directory, '')
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    live = set()
+    c.execute(f"SELECT filepath, original_filepath FROM orders "
+              f"WHERE status NOT IN ({', '.join('?' * len(FINISHED_STATUSES))}) "
+              "AND (filepath LIKE ? ESCAPE '\\' OR original_filepath LIKE ? ESCAPE '\\')",
+              (*FINISHED_STATUSES, pattern, pattern))
+    for row in c.fetchall():
+        live.update(p for p in dict(row).values() if p)
+    c.execute(f"SELECT filepath FROM printer_jobs WHERE status IN ({', '.join('?' * len(PENDING_UPLOAD_STATUSES))}) "
+              "AND filepath LIKE ? ESCAPE '\\'", (*PENDING_UPLOAD_STATUSES, pattern))
+    live.update(dict(row)['filepath'] for row in c.fetchall())
+    c.execute("SELECT payload FROM stripe_events WHERE processed_at IS NULL")
+    for row in c.fetchall():
+        payload = dict(row)['payload']
+        if prefix in payload:  # Cheap pre-filter before matching the exact path
+            live.update(p for p in _temp_paths(payload) if p.startswith(prefix))
+    # A logical .stl path may be stored compressed
+    return live | {p + artifacts.COMPRESSED_SUFFIX for p in live}
+
+
+def _temp_paths(payload):
+    try:
+        metadata = json.loads(payload)['data']['object'].get('metadata') or {}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+    return [metadata['temp_file_path']] if metadata.get('temp_file_path') else []
+
+
+def _sweep_dir(directory, day, cutoff, live, dry_run, report):
+    """Delete expired, unused files in one day directory; returns True if it is now empty."""
+    boundary = day == datetime.datetime.fromtimestamp(cutoff).strftime('%Y-%m-%d')
+    kept = 0
+    batch = []
+
+    def flush():
+        try:
+            if not dry_run:
+                storage.delete_many(key for key, _ in batch)
+            report['files'] += len(batch)
+            report['bytes'] += sum(size for _, size in batch)
+        except OSError as e:
+            logging.warning(f"Retention: could not delete files in {directory}: {e}")
+        batch.clear()
+
+    for key, size, mtime in storage.scan(directory):
+        if key in live or (boundary and mtime >= cutoff):
+            kept += 1
+            continue
+        batch.append((key, size))
+        if len(batch) >= RETENTION_BATCH:
+            flush()
+    flush()
+    if kept == 0 and not dry_run and storage.remove_dir(directory):
+        report['dirs'] += 1
+    return kept == 0
+
+
+def _sweep_area(c, root, cutoff, dry_run):
+    report = {'files': 0, 'bytes': 0, 'dirs': 0, 'kept_dirs': 0}
+    for directory, day in _day_dirs(root, cutoff):
+        if not _sweep_dir(directory, day, cutoff, _live_paths(c, directory), dry_run, report):
+            report['kept_dirs'] += 1
+    return report
+
+
+def sweep(root="exports", dry_run=False, now=None):
+    """Delete expired uploads and exports; returns {"temp": report, "exports": report}.
+
+    Each report counts deleted files, reclaimed bytes, removed directories and
+    expired directories kept because they hold live files. With dry_run
+    nothing is deleted.
+    """
+    now = time.time() if now is None else now
+    started = time.perf_counter()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        reports = {
+            "temp": _sweep_area(c, os.path.join(root, "temp"), now - RETENTION_TEMP_HOURS * 3600, dry_run),
+            "exports": _sweep_area(c, root, now - RETENTION_EXPORT_DAYS * 86400, dry_run),
+        }
+    for area, report in reports.items():
+        if not dry_run:
+            metrics.inc("retention_files_deleted_total", report['files'], area=area)
+            metrics.inc("retention_bytes_reclaimed_total", report['bytes'], area=area)
+        logging.info(f"Retention ({area}{', dry run' if dry_run else ''}): {report['files']} file(s), "
+                     f"{report['bytes'] / 1024 / 1024:.1f} MB reclaimed, {report['dirs']} dir(s) removed, "
+                     f"{report['kept_dirs']} kept for live orders")
+    metrics.observe("retention_sweep_seconds", time.perf_counter() - started)
+    return reports
@@ -0,0 +1,264 @@
+"""
+Automatic dispatch of ready orders across the printer farm.
+
+An order is ready once it is paid, still 'Processing', and its file is an STL
+with no active printer job. `dispatch()` takes ready orders oldest first and
+gives each one to the available printer that would finish it soonest. That
+printer's planned work ends at `available_at`; the order adds an estimate
+based on its stamp count. So long jobs spread out, and a printer that frees up
+early takes the next order. A printer is available when it is enabled and has
+not failed an upload within PRINTER_FAILURE_COOLDOWN. Its queue is capped at
+PRINTER_MAX_QUEUE planned prints.
+
+Each job records its planned print window (print_start_at / print_end_at).
+Marking an order Done ends its window early. Utilization is the busy share
+of those windows over the last SCHEDULER_UTILIZATION_HOURS.
+
+Dispatch runs when a converted order is ready and when an upload fails for
+good (SCHEDULER_AUTO_DISPATCH, on by default once a printer is configured).
+The failed printer is then in cooldown, so its order moves to another one.
+Dispatch also runs as a periodic job task, from the dashboard and from
+`python manage.py dispatch`. One dispatch runs at a time: it takes the SQLite
+write lock, or an advisory lock on PostgreSQL.
+"""
+
+import os
+import time
+import logging
+import datetime
+
+import metrics
+import printer
+import artifacts
+from db import USE_POSTGRES, get_db_connection
+
+# On by default only when printers are configured (PRINTERS or BAMBU_IP)
+SCHEDULER_AUTO_DISPATCH = os.environ.get("SCHEDULER_AUTO_DISPATCH",
+                                         "true" if printer.REGISTRY else "false").lower() == "true"
+PRINT_SETUP_MINUTES = float(os.environ.get("PRINT_SETUP_MINUTES", "10"))  # Heat-up, levelling, plate swap
+PRINT_MINUTES_PER_STAMP = float(os.environ.get("PRINT_MINUTES_PER_STAMP", "25"))
+PRINTER_MAX_QUEUE = int(os.environ.get("PRINTER_MAX_QUEUE", "3"))  # Planned, unfinished prints per printer
+PRINTER_FAILURE_COOLDOWN = float(os.environ.get("PRINTER_FAILURE_COOLDOWN", "600"))  # Seconds
+SCHEDULER_UTILIZATION_HOURS = float(os.environ.get("SCHEDULER_UTILIZATION_HOURS", "24"))
+SCHEDULER_BATCH = 100
+
+READY_STATUS = 'Processing'
+ACTIVE_JOB_STATUSES = ('queued', 'uploading', 'done')  # Failed or cancelled jobs leave the order ready again
+
+_READY = ("o.status = ? AND o.payment_status = 'Paid' AND o.filepath LIKE ? "
+          "AND NOT EXISTS (SELECT 1 FROM printer_jobs j WHERE j.order_id = o.id "
+          f"AND j.status IN ({', '.join('?' * len(ACTIVE_JOB_STATUSES))}))")
+_READY_PARAMS = (READY_STATUS, '%.stl', *ACTIVE_JOB_STATUSES)
+
+_PG_LOCK_KEY = 4175002
+
+
+def _epoch(value):
+    """Seconds since the epoch for a stored UTC timestamp (str on SQLite, datetime on PostgreSQL)."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _stamp(epoch):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+
+def estimate_seconds(quantity):
+    return int((PRINT_SETUP_MINUTES + max(quantity or 1, 1) * PRINT_MINUTES_PER_STAMP) * 60)
+
+
+def _enabled(c):
+    c.execute('SELECT name, enabled FROM printers')
+    state = {dict(row)['name']: bool(dict(row)['enabled']) for row in c.fetchall()}
+    return {name: state.get(name, True) for name in printer.REGISTRY}
+
+
+def _load(c, now):
+    """Per-printer planning state: enabled, available, available_at, queue length, last failure."""
+    state = {name: {"name": name, "enabled": enabled, "available_at": now, "queue": 0, "failed_at": None}
+             for name, enabled in _enabled(c).items()}
+    c.execute('''
+        SELECT printer, MAX(print_end_at) AS end_at, COUNT(*) AS queue FROM printer_jobs
+        WHERE status IN ('queued', 'uploading') OR (status = 'done' AND print_end_at > ?)
+        GROUP BY printer
+    ''', (_stamp(now),))
+    for row in c.fetchall():
+        row = dict(row)
+        if row['printer'] in state:
+            end = _epoch(row['end_at'])
+            state[row['printer']].update(available_at=max(now, end or now), queue=row['queue'])
+    c.execute("SELECT printer, MAX(finished_at) AS failed_at FROM printer_jobs WHERE status = 'failed' AND finished_at > ? "
+              "GROUP BY printer", (_stamp(now - PRINTER_FAILURE_COOLDOWN),))
+    for row in c.fetchall():
+        row = dict(row)
+        if row['printer'] in state:
+            state[row['printer']]['failed_at'] = _epoch(row['failed_at'])
+    for s in state.values():
+        s['available'] = s['enabled'] and s['failed_at'] is None
+    return state
+
+
+def _choose(state, seconds):
+    """The available printer with room that would finish this print first, or None."""
+    candidates = [s for s in state.values() if s['available'] and s['queue'] < PRINTER_MAX_QUEUE]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda s: (s['available_at'] + seconds, s['queue'], s['name']))
+
+
+def _plan(c, state, order, name=None):
+    """Put one order on a printer (the best one, or `name`); returns (printer, job_id) or None."""
+    seconds = estimate_seconds(order['quantity'])
+    target = state.get(name) if name else _choose(state, seconds)
+    if target is None:
+        return None
+    start = target['available_at']
+    job_id = printer.insert_job(c, order['id'], order['filepath'], target['name'], estimated_seconds=seconds,
+                                print_start_at=_stamp(start), print_end_at=_stamp(start + seconds))
+    target['available_at'] = start + seconds
+    target['queue'] += 1
+    return target['name'], job_id
+
+
+def _lock(c):
+    if USE_POSTGRES:
+        c.execute('SELECT pg_advisory_xact_lock(%s)', (_PG_LOCK_KEY,))
+
+
+def _wake(assigned):
+    for name in {name for _, name, _ in assigned}:
+        printer.uploader(name).wake()
+
+
+def _candidates(limit):
+    """Ready orders whose file is in storage, oldest first.
+
+    Checked before dispatch takes its lock: on S3 each check is a HEAD
+    request, and every other writer would wait behind them.
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        if not any(s['available'] for s in _load(c, time.time()).values()):
+            return []  # No printer to give them to; skip the storage checks
+        c.execute(f'SELECT o.id, o.filepath FROM orders o WHERE {_READY} ORDER BY o.id LIMIT ?',
+                  _READY_PARAMS + (limit,))
+        orders = [dict(row) for row in c.fetchall()]
+    found = []
+    for order in orders:
+        if artifacts.exists(order['filepath']):
+            found.append(order['id'])
+        else:
+            logging.warning(f"Order #{order['id']}: {order['filepath']} is missing, not dispatching it")
+    return found
+
+
+def dispatch(limit=SCHEDULER_BATCH):
+    """Assign ready orders to printers; returns [(order_id, printer, job_id)]."""
+    candidates = _candidates(limit)
+    if not candidates:
+        return []
+    assigned = []
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        _lock(c)
+        state = _load(c, time.time())
+        if not any(s['available'] for s in state.values()):
+            return []
+        # Another dispatch or a status change may have got there first
+        c.execute(f'SELECT o.id, o.filepath, o.quantity FROM orders o WHERE {_READY} '
+                  f'AND o.id IN ({", ".join("?" * len(candidates))}) ORDER BY o.id',
+                  _READY_PARAMS + tuple(candidates))
+        for order in [dict(row) for row in c.fetchall()]:
+            planned = _plan(c, state, order)
+            if planned is None:
+                break  # Every available printer's queue is full
+            assigned.append((order['id'], *planned))
+    _wake(assigned)
+    for order_id, name, job_id in assigned:
+        logging.info(f"Order #{order_id}: dispatched to printer {name} (job #{job_id})")
+    metrics.inc("scheduler_dispatched_total", len(assigned))
+    return assigned
+
+
+def assign(order_id, filepath, quantity, name=None):
+    """Plan one order now, on `name` or the best available printer; returns the job id or None."""
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        _lock(c)
+        state = _load(c, time.time())
+        if name is None:
+            state = {n: s for n, s in state.items() if s['available']}
+        planned = _plan(c, state, {'id': order_id, 'filepath': filepath, 'quantity': quantity}, name)
+    if planned is None:
+        return None
+    _wake([(order_id, *planned)])
+    return planned[1]
+
+
+def orders_done(c, order_ids):
+    """End the print windows of finished orders now; call in the transaction that marks them Done."""
+    if order_ids:
+        now = printer._now()
+        c.execute(f"UPDATE printer_jobs SET print_end_at = ? WHERE print_end_at > ? "
+                  f"AND order_id IN ({', '.join('?' * len(order_ids))})", (now, now, *order_ids))
+
+
+def set_enabled(name, enabled):
+    """Take a printer in or out of rotation; its queued uploads are cancelled and re-dispatched."""
+    cancelled = 0
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute('INSERT INTO printers (name, enabled, updated_at) VALUES (?, ?, ?) '
+                  'ON CONFLICT (name) DO UPDATE SET enabled = excluded.enabled, updated_at = excluded.updated_at',
+                  (name, int(enabled), printer._now()))
+        if not enabled:
+            c.execute("UPDATE printer_jobs SET status = 'cancelled', finished_at = ?, print_end_at = NULL "
+                      "WHERE printer = ? AND status = 'queued'", (printer._now(), name))
+            cancelled = c.rowcount
+    if cancelled:
+        logging.info(f"Printer {name} disabled: {cancelled} queued job(s) cancelled for re-dispatch")
+    return dispatch() if SCHEDULER_AUTO_DISPATCH else []
+
+
+def _redispatch_failed(job):
+    if SCHEDULER_AUTO_DISPATCH:
+        dispatch()
+
+
+printer.upload_failed_hooks.append(_redispatch_failed)
+
+
+def overview():
+    """Printers with availability, backlog and utilization, plus the planned prints."""
+    now = time.time()
+    window = SCHEDULER_UTILIZATION_HOURS * 3600
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        state = _load(c, now)
+        c.execute(f"SELECT {', '.join(printer.JOB_FIELDS)} FROM printer_jobs "
+                  "WHERE status IN ('queued', 'uploading') OR (status = 'done' AND print_end_at > ?) "
+                  "ORDER BY printer, print_start_at, id", (_stamp(now - window),))
+        jobs = [dict(row) for row in c.fetchall()]
+        c.execute(f'SELECT COUNT(*) AS waiting FROM orders o WHERE {_READY}', _READY_PARAMS)
+        waiting = dict(c.fetchone())['waiting']
+
+    busy = dict.fromkeys(state, 0.0)
+    for job in jobs:
+        start, end = _epoch(job['print_start_at']), _epoch(job['print_end_at'])
+        if job['printer'] in busy and start is not None and end is not None:
+            busy[job['printer']] += max(0.0, min(end, now) - max(start, now - window))
+
+    printers = []
+    for name, s in state.items():
+        utilization = round(busy[name] / window, 3)
+        metrics.set_gauge("printer_utilization", utilization, mode="max", printer=name)
+        printers.append({
+            "name": name, "enabled": s['enabled'], "available": s['available'], "queue": s['queue'],
+            "backlog_seconds": int(s['available_at'] - now), "available_at": _stamp(s['available_at']),
+            "utilization": utilization,
+        })
+    plan = [job for job in jobs if job['status'] != 'done' or _epoch(job['print_end_at']) > now]
+    return {"printers": printers, "plan": plan, "waiting": waiting}
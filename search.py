@@ -0,0 +1,99 @@
+"""
+Full-text order search for /api/orders/search.
+
+SQLite uses the `orders_fts` FTS5 table. It is an external-content index over
+orders, kept in sync by triggers. PostgreSQL uses a GIN expression index on
+`orders_search_document(...)`. Both are created in migration 6 and cover
+name, email, message, notes and filename. Every word the user types is
+matched as a prefix, and all words must match.
+
+Results are ranked: name and email hits count most, then filename and notes,
+then message. A query that is an order number (e.g. "#42") puts that order
+first. Pages continue from a (score, id) cursor, like the date-ordered
+listing does with (created_at, id).
+"""
+
+import re
+import json
+import base64
+
+from db import USE_POSTGRES
+
+# Same separators the indexes split on, so "mario.rossi@" finds mario.rossi@gmail.com
+_WORD = re.compile(r"[^\W_]+")
+_EXACT_ID_SCORE = 1e9
+
+# bm25 column weights, in orders_fts column order: name, email, message, notes, filename
+_SQLITE_RANK = "bm25(orders_fts, 10.0, 5.0, 1.0, 2.0, 2.0)"
+_PG_DOCUMENT = "orders_search_document(name, email, message, notes, filename)"
+
+
+def terms(query):
+    return _WORD.findall(query.lower())
+
+
+def order_number(query):
+    query = query.strip().lstrip('#')
+    return int(query) if query.isdigit() else None
+
+
+def encode_cursor(row):
+    raw = json.dumps([row['score'], row['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        score, order_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return float(score), int(order_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _matches(query):
+    """Subquery yielding (id, score) for every order matching `query`."""
+    words = terms(query)
+    number = order_number(query)
+    branches, params = [], []
+    if words:
+        if USE_POSTGRES:
+            tsquery = ' & '.join(f"{w}:*" for w in words)
+            branches.append(f"SELECT id, ts_rank({_PG_DOCUMENT}, to_tsquery('simple', ?))::float8 AS score "
+                            f"FROM orders WHERE {_PG_DOCUMENT} @@ to_tsquery('simple', ?)")
+            params.extend([tsquery, tsquery])
+        else:
+            branches.append(f"SELECT rowid AS id, -{_SQLITE_RANK} AS score "
+                            f"FROM orders_fts WHERE orders_fts MATCH ?")
+            params.append(' '.join(f'"{w}"*' for w in words))
+        if number is not None:
+            branches[-1] += ' AND ' + ('id' if USE_POSTGRES else 'rowid') + ' <> ?'
+            params.append(number)
+    if number is not None:
+        branches.append(f"SELECT id, {_EXACT_ID_SCORE} AS score FROM orders WHERE id = ?")
+        params.append(number)
+    return ' UNION ALL '.join(branches), params
+
+
+def fetch_page(c, columns, limit, cursor, query, where='', params=()):
+    """Best-first page of orders matching `query`, resuming after `cursor`.
+
+    `where` holds extra filters on unqualified orders columns, as for
+    fetch_orders_page. Returns (orders, next_cursor).
+    """
+    matches, sql_params = _matches(query)
+    if not matches:
+        return [], None
+    select = ', '.join(f"o.{col}" for col in columns)
+    sql = f"SELECT {select}, m.score AS score FROM ({matches}) m JOIN orders o ON o.id = m.id WHERE 1=1{where}"
+    sql_params += list(params)
+    if cursor:
+        sql += ' AND (m.score < ? OR (m.score = ? AND o.id < ?))'
+        sql_params.extend([cursor[0], cursor[0], cursor[1]])
+    sql += ' ORDER BY m.score DESC, o.id DESC LIMIT ?'
+    sql_params.append(limit + 1)
+    c.execute(sql, sql_params)
+    rows = [dict(row) for row in c.fetchall()]
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    for row in rows:
+        del row['score']
+    return rows[:limit], next_cursor
@@ -1,15 +1,21 @@
+import time
+_import_started = time.perf_counter()
+
 import os
 import datetime
 import logging
-import sqlite3
 import json
-import ftplib
-import ssl
 import threading
+import tempfile
 import stripe
+import stripe_client
 import csv
 import io
-from flask import Flask, request, jsonify, send_from_directory, abort, redirect, make_response
+import base64
+import functools
+import zlib
+import mimetypes
+from flask import Flask, request, jsonify, send_file, abort, redirect, make_response
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -21,28 +27,21 @@ from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
 
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+# Logging
+# Configured before anything logs: the first logging.info() call on an
+# unconfigured root logger installs a WARNING-level default and turns this into
+# a no-op.
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Security Configuration ---
 # 1. Externalize Secrets (Environment Variables)
 ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "CHANGE_ME_IN_PROD")
-BAMBU_IP = os.environ.get("BAMBU_IP", "192.168.1.108")
-BAMBU_ACCESS_CODE = os.environ.get("BAMBU_ACCESS_CODE", "CHANGE_ME")
 
 # Stripe Configuration (loaded from .env)
 STRIPE_SECRET_KEY = os.environ.get("STRIPE_SECRET_KEY")
 STRIPE_PUBLISHABLE_KEY = os.environ.get("STRIPE_PUBLISHABLE_KEY")
 STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET", "") # Optional for webhook verification
-stripe.api_key = STRIPE_SECRET_KEY
-
-# Email Configuration
-# To use Gmail: Generate an App Password at https://myaccount.google.com/apppasswords
-SMTP_EMAIL = os.environ.get("SMTP_EMAIL", "orders@gassstro.com") 
-SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD")  # MUST be set in .env
-SMTP_SERVER = os.environ.get("SMTP_SERVER", "mail.gassstro.com")
-SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+stripe_client.configure(STRIPE_SECRET_KEY)  # Pooled client with bounded timeouts (STRIPE_* env vars)
 
 # 2. CORS Restriction
 ALLOWED_ORIGINS = os.environ.get("ALLOWED_ORIGINS", "*").split(",")
@@ -58,35 +57,60 @@ CORS(app, resources={
 })
 
 # 3. Rate Limiting (Prevent DDoS/Spam)
+# memory:// counts per process; gunicorn.conf.py switches multi-worker
+# deployments to sqlite:// (ratelimit.py) so every worker shares one count.
+# RATELIMIT_ENABLED=false is only meant for local load tests.
+import ratelimit  # Registers the sqlite:// storage scheme
 limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=["2000 per day", "500 per hour"],
-    storage_uri="memory://"
+    storage_uri=os.environ.get("RATELIMIT_STORAGE_URI", "memory://"),
+    enabled=os.environ.get("RATELIMIT_ENABLED", "true").lower() != "false"
 )
 
 # Configuration
 EXPORT_DIR = "exports"
-DB_FILE = "orders.db"
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'stl', 'obj', 'step', '3mf', 'gcode'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
 DOMAIN = os.environ.get("DOMAIN", "http://localhost:8080") # Frontend runs on port 8080
 
-# Database Configuration - PostgreSQL or SQLite
-DATABASE_URL = os.environ.get("DATABASE_URL")
-USE_POSTGRES = DATABASE_URL is not None
-
-if USE_POSTGRES:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
-    logging.info("🐘 Using PostgreSQL database")
-else:
-    logging.info("📁 Using SQLite database (local dev)")
+# Database Configuration - PostgreSQL or SQLite (pooled connections, see db.py)
+from db import USE_POSTGRES, get_db_connection, bump_version, get_version
+import migrations
+import events
+import search
+import stats
+import storage  # Uploads and meshes: local disk or S3 (ARTIFACT_STORAGE)
+import artifacts
+import printer
+import scheduler
+import mailer  # Email: SMTP_* env vars, queued delivery
+import jobs
+import metrics
+import querylog
+import retention
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
-# Logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# --- Request metrics ---
+@app.before_request
+def start_request_timer():
+    request.environ['gassstro.started'] = time.perf_counter()
+    request.environ['gassstro.querylog'] = querylog.begin_request()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = request.environ.get('gassstro.started')
+    if started is not None:
+        # The route pattern, not the path, keeps label cardinality bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe("http_request_seconds", time.perf_counter() - started,
+                        route=route, method=request.method, status=str(response.status_code))
+        querylog.end_request(request.environ.pop('gassstro.querylog'), f"{request.method} {route}")
+    return response
+
 
 # --- Security Headers ---
 @app.after_request
@@ -123,119 +147,52 @@ def add_security_headers(response):
     return response
 
 # --- Database Setup ---
-def get_db_connection():
-    """Get database connection (PostgreSQL or SQLite)"""
-    if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-        return conn
-    else:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        return conn
-
 def init_db():
-    """Initialize database tables"""
-    if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id SERIAL PRIMARY KEY,
-                name TEXT,
-                email TEXT,
-                quantity INTEGER,
-                total_price REAL,
-                date_event TEXT,
-                message TEXT,
-                filename TEXT,
-                filepath TEXT,
-                status TEXT DEFAULT 'Pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                stripe_session_id TEXT,
-                payment_status TEXT DEFAULT 'Unpaid',
-                original_filepath TEXT,
-                notes TEXT
-            )
-        ''')
-        
-        # Add notes column if missing
-        try:
-            c.execute('SELECT notes FROM orders LIMIT 1')
-        except:
-            c.execute('ALTER TABLE orders ADD COLUMN notes TEXT')
-            
-        conn.commit()
-        conn.close()
-    else:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                email TEXT,
-                quantity INTEGER,
-                total_price REAL,
-                date_event TEXT,
-                message TEXT,
-                filename TEXT,
-                filepath TEXT,
-                status TEXT DEFAULT 'Pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                stripe_session_id TEXT,
-                payment_status TEXT DEFAULT 'Unpaid',
-                original_filepath TEXT,
-                notes TEXT
-            )
-        ''')
-        
-        # Simple migration: check if columns exist, if not add them
-        try:
-            c.execute('SELECT stripe_session_id FROM orders LIMIT 1')
-        except sqlite3.OperationalError:
-            print("Migrating DB: Adding stripe_session_id")
-            c.execute('ALTER TABLE orders ADD COLUMN stripe_session_id TEXT')
-            
-        try:
-            c.execute('SELECT payment_status FROM orders LIMIT 1')
-        except sqlite3.OperationalError:
-            print("Migrating DB: Adding payment_status")
-            c.execute("ALTER TABLE orders ADD COLUMN payment_status TEXT DEFAULT 'Unpaid'")
-
-        try:
-            c.execute('SELECT original_filepath FROM orders LIMIT 1')
-        except sqlite3.OperationalError:
-            print("Migrating DB: Adding original_filepath")
-            c.execute("ALTER TABLE orders ADD COLUMN original_filepath TEXT")
-            
-        try:
-            c.execute('SELECT notes FROM orders LIMIT 1')
-        except sqlite3.OperationalError:
-            print("Migrating DB: Adding notes")
-            c.execute("ALTER TABLE orders ADD COLUMN notes TEXT")
-
-        conn.commit()
-        conn.close()
-
-init_db()
-
-from converter import LogoConverter
+    """Create or upgrade the database schema (versioned, see migrations.py)"""
+    started = time.perf_counter()
+    applied = migrations.migrate()
+    if applied:
+        logging.info(f"Applied migrations {applied} in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+# Schema setup runs when the app is imported. Under gunicorn's preload_app that
+# is once in the master per deploy; workers and max_requests recycles inherit
+# the result. Set INIT_DB_ON_STARTUP=false when `python manage.py init-db` runs
+# as a separate release step.
+if os.environ.get("INIT_DB_ON_STARTUP", "true").lower() != "false":
+    init_db()
 
 # Initialize Converter
-converter = LogoConverter()
+# converter.py pulls in cv2, numpy and numpy-stl, so it is imported on the first
+# conversion rather than at startup.
+# LogoConverter keeps no per-call state, so one instance is shared by all
+# request threads. Conversions are CPU and memory heavy, so cap how many run at
+# once per process; the rest wait instead of thrashing a threaded worker.
+converter = None
+_converter_lock = threading.Lock()
+CONVERSION_CONCURRENCY = int(os.environ.get("CONVERSION_CONCURRENCY", "1"))
+conversion_slots = threading.BoundedSemaphore(CONVERSION_CONCURRENCY)
+# Convert uploads while the customer is still on the Stripe page; the paid
+# order then adopts the finished mesh. Unpaid results expire with exports/temp.
+SPECULATIVE_CONVERSION = os.environ.get("SPECULATIVE_CONVERSION", "false").lower() == "true"
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg')
+
+def get_converter():
+    """Return the shared LogoConverter, importing converter.py on first use."""
+    global converter
+    if converter is None:
+        with _converter_lock:
+            if converter is None:
+                started = time.perf_counter()
+                from converter import LogoConverter
+                converter = LogoConverter()
+                logging.info(f"Converter loaded in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return converter
 
 # --- Helpers ---
 def send_confirmation_email(to_email, order_data):
-    if not SMTP_EMAIL or not SMTP_PASSWORD:
-        logging.warning("Email not configured. Skipping confirmation email.")
-        return
-
+    """Queue the order confirmation; the mail sender thread delivers it."""
     try:
-        msg = MIMEMultipart()
-        msg['From'] = f"GASsstro System <{SMTP_EMAIL}>"
-        msg['To'] = to_email
-        msg['Subject'] = f"COMMISSIONE ACCETTATA: Ordine #{order_data['id']}"
-
+        subject = f"COMMISSIONE ACCETTATA: Ordine #{order_data['id']}"
         body = f"""
         <!DOCTYPE html>
         <html>
@@ -292,21 +249,12 @@ def send_confirmation_email(to_email, order_data):
         </body>
         </html>
         """
-        
-        msg.attach(MIMEText(body, 'html'))
 
-        if SMTP_PORT == 465:
-            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
-        else:
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-            server.starttls()
-            
-        server.login(SMTP_EMAIL, SMTP_PASSWORD)
-        server.sendmessage(msg)
-        server.quit()
-        logging.info(f"Confirmation email sent to {to_email}")
+        email_id = mailer.enqueue(to_email, subject, body, order_id=order_data['id'])
+        if email_id:
+            logging.info(f"Confirmation email #{email_id} queued for {to_email}")
     except Exception as e:
-        logging.error(f"Failed to send email: {e}")
+        logging.error(f"Failed to queue email: {e}")
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -320,35 +268,149 @@ def check_auth(req):
         return False
     return True
 
+# --- Conditional GETs ---
+def orders_etag(*scope):
+    """Decorator: ETag admin reads on the orders change version.
+
+    A matching If-None-Match is answered with 304 after one primary-key
+    lookup, without running the view's queries. `scope` callables add parts
+    that change without a write (e.g. today's date for the stats).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or not check_auth(request):
+                return view(*args, **kwargs)
+
+            with get_db_connection() as conn:
+                version = get_version(conn.cursor())
+            tag = '-'.join(['orders', str(version)] + [str(part()) for part in scope])
+
+            if request.if_none_match.contains(tag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(tag)
+            response.headers['Cache-Control'] = 'private, no-cache'  # Always revalidate
+            return response
+        return wrapper
+    return decorator
+
+# --- Order listing: keyset pagination ---
+ORDER_FIELDS = ('id', 'name', 'email', 'quantity', 'total_price', 'date_event', 'message', 'filename',
+                'filepath', 'status', 'created_at', 'stripe_session_id', 'payment_status',
+                'original_filepath', 'notes')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(order):
+    """Opaque next-page token for the (created_at, id) position of `order`."""
+    created_at = order['created_at']
+    if hasattr(created_at, 'isoformat'):
+        created_at = created_at.isoformat(sep=' ')
+    raw = json.dumps([created_at, order['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token):
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return str(created_at), int(order_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def parse_page_args(args, decode=decode_cursor):
+    """Read `limit`, `cursor` and `fields` (comma-separated projection) from the query string."""
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Invalid limit")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    cursor = decode(args['cursor']) if args.get('cursor') else None
+
+    fields = args.get('fields')
+    if fields:
+        columns = [f.strip() for f in fields.split(',') if f.strip()]
+        unknown = set(columns) - set(ORDER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        # The cursor needs both sort keys
+        columns = [col for col in ('id', 'created_at') if col not in columns] + columns
+    else:
+        columns = list(ORDER_FIELDS)
+    return columns, limit, cursor
+
+def parse_order_filters(args):
+    """Build the WHERE fragment for the status, payment_status, date_from and date_to filters."""
+    status = args.get('status', '')
+    payment_status = args.get('payment_status', '')
+    date_from = args.get('date_from', '')
+    date_to = args.get('date_to', '')
+    if date_from:
+        datetime.date.fromisoformat(date_from)
+    if date_to:
+        # Inclusive end date, compared as a range so the created_at index applies
+        date_to = (datetime.date.fromisoformat(date_to) + datetime.timedelta(days=1)).isoformat()
+
+    where = ''
+    params = []
+    
+    if status:
+        where += ' AND status = ?'
+        params.append(status)
+    
+    if payment_status:
+        where += ' AND payment_status = ?'
+        params.append(payment_status)
+    
+    if date_from:
+        where += ' AND created_at >= ?'
+        params.append(date_from)
+    
+    if date_to:
+        where += ' AND created_at < ?'
+        params.append(date_to)
+    return where, params
+
+def fetch_orders_page(c, columns, limit, cursor, where='', params=()):
+    """Newest-first page of orders, resuming after `cursor`. Uses idx_orders_created_at."""
+    sql = f"SELECT {', '.join(columns)} FROM orders WHERE 1=1{where}"
+    params = list(params)
+    if cursor:
+        sql += ' AND (created_at, id) < (?, ?)'
+        params.extend(cursor)
+    sql += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+    params.append(limit + 1)  # One extra row tells us whether there is a next page
+    c.execute(sql, params)
+    orders = [dict(row) for row in c.fetchall()]
+    next_cursor = encode_cursor(orders[limit - 1]) if len(orders) > limit else None
+    return orders[:limit], next_cursor
+
 # --- Routes ---
 
 # --- Background Tasks ---
-def cleanup_old_files():
-    """Deletes files in exports/ older than 30 days."""
+def dispatch_ready_orders():
+    """Let the scheduler place newly ready orders on printers; never fails the caller."""
+    if not scheduler.SCHEDULER_AUTO_DISPATCH:
+        return
     try:
-        cutoff = datetime.datetime.now() - datetime.timedelta(days=30)
-        cutoff_timestamp = cutoff.timestamp()
-        
-        # Traverse exports directory
-        for root, dirs, files in os.walk(EXPORT_DIR):
-            for file in files:
-                filepath = os.path.join(root, file)
-                try:
-                    if os.path.getmtime(filepath) < cutoff_timestamp:
-                        os.remove(filepath)
-                        logging.info(f"Deleted old file: {filepath}")
-                except Exception as e:
-                    logging.warning(f"Error deleting {filepath}: {e}")
-                    
-        logging.info("Cleanup complete.")
+        scheduler.dispatch()
     except Exception as e:
-        logging.error(f"Cleanup failed: {e}")
+        logging.error(f"Printer dispatch failed: {e}")
 
+@jobs.handler('process-order')
 def process_order_background(order_id, original_filepath, stl_filepath, email_info):
-    """Handles STL conversion and Email sending in background."""
+    """Handles STL conversion and Email sending in background.
+
+    Runs from the job queue, so it can run again after a worker is lost
+    mid-way: conversion simply redoes its work, and the email is queued once.
+    """
     logging.info(f"Background processing started for Order #{order_id}")
     
     conversion_success = False
+    needs_conversion = False
     final_filepath = original_filepath # Default to original if fails
     final_filename = os.path.basename(original_filepath)
 
@@ -356,30 +418,47 @@ def process_order_background(order_id, original_filepath, stl_filepath, email_in
     try:
         # Check if it needs conversion (png/jpg)
         ext = final_filename.rsplit('.', 1)[1].lower()
-        if ext in ['png', 'jpg', 'jpeg']:
-            logging.info(f"Converting {final_filename} to STL...")
-            converter.generate_stl(original_filepath, stl_filepath)
-            
+        if ext in IMAGE_EXTENSIONS:
+            needs_conversion = True
+            if artifacts.exists(stl_filepath):
+                # Adopted from a speculative conversion (or left by an earlier run)
+                logging.info(f"Order #{order_id}: {os.path.basename(stl_filepath)} already converted")
+                converted = True
+            else:
+                logging.info(f"Converting {final_filename} to STL...")
+                converted = convert_to_stl(original_filepath, stl_filepath)
+
             # If successful, update DB to point to STL
-            if os.path.exists(stl_filepath):
+            if converted:
                 final_filepath = stl_filepath
                 final_filename = os.path.basename(stl_filepath)
                 conversion_success = True
                 
                 # Update DB
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute('UPDATE orders SET filename = ?, filepath = ? WHERE id = ?', 
-                         (final_filename, final_filepath, order_id))
-                conn.commit()
-                conn.close()
+                with get_db_connection(write=True) as conn:
+                    c = conn.cursor()
+                    c.execute('UPDATE orders SET filename = ?, filepath = ? WHERE id = ?', 
+                             (final_filename, final_filepath, order_id))
+                    bump_version(c)
+                    events.record(c, 'conversion-finished', order_id, ok=True, filename=final_filename)
                 logging.info(f"Conversion successful: {final_filename}")
             else:
                 logging.error("Conversion ran but file missing.")
     except Exception as e:
         logging.error(f"Conversion failed for Order #{order_id}: {e}")
 
-    # 2. Send Email (Only if everything is ready - or strictly speaking, we confirmed receipt)
+    if needs_conversion and not conversion_success:
+        try:
+            with get_db_connection(write=True) as conn:
+                events.record(conn.cursor(), 'conversion-finished', order_id, ok=False, filename=final_filename)
+        except Exception as e:
+            logging.error(f"Could not record conversion event for Order #{order_id}: {e}")
+
+    # 2. Hand the mesh to the printer farm
+    if final_filepath.lower().endswith('.stl'):
+        dispatch_ready_orders()
+
+    # 3. Send Email (Only if everything is ready - or strictly speaking, we confirmed receipt)
     # The email template says "Commission Accepted". We send it regardless of conversion outcome?
     # Yes, manual review will catch bad files.
     
@@ -389,7 +468,71 @@ def process_order_background(order_id, original_filepath, stl_filepath, email_in
     # We send the "Receipt" email immediately now. 
     # Or maybe we wait for payment? 
     # Let's keep sending "Receipt" email but maybe mark as unpaid.
-    send_confirmation_email(email_info['email'], email_info)
+    if not mailer.queued_for_order(order_id):
+        send_confirmation_email(email_info['email'], email_info)
+
+def convert_to_stl(source_path, stl_filepath):
+    """Convert a stored image to a stored (compressed) STL; False if the converter produced nothing."""
+    # The converter works on local files: fetch the upload (a no-op on local
+    # storage) and build the mesh in a scratch directory
+    with storage.local_copy(source_path) as source, tempfile.TemporaryDirectory() as work:
+        local_stl = os.path.join(work, os.path.basename(stl_filepath))
+        with conversion_slots:
+            get_converter().generate_stl(source, local_stl)
+        if not os.path.exists(local_stl):
+            return False
+        # Stored as .stl.gz; the order keeps the logical .stl path
+        stored = artifacts.store(local_stl)
+        storage.put_file(stl_filepath + stored[len(local_stl):], stored)
+    return True
+
+@jobs.handler('speculative-convert')
+def speculative_convert(temp_filepath, session_id=None):
+    """Convert an upload before it is paid for, next to it in exports/temp.
+
+    Low priority and a single attempt: if it fails, is late, or the upload was
+    already adopted by a paid order, the order simply converts as usual.
+    """
+    temp_stl = f"{temp_filepath.rsplit('.', 1)[0]}.stl"
+    if artifacts.exists(temp_stl) or not storage.exists(temp_filepath):
+        return
+    started = time.perf_counter()
+    try:
+        ok = convert_to_stl(temp_filepath, temp_stl)
+    except Exception as e:  # E.g. the order adopted the upload meanwhile
+        logging.info(f"Speculative conversion for session {session_id} abandoned: {e}")
+        ok = False
+    metrics.inc("speculative_conversions_total", outcome="converted" if ok else "failed")
+    logging.info(f"Speculative conversion for session {session_id}: {'done' if ok else 'no output'} "
+                 f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def adopt_speculative_stl(temp_file_path, stl_filepath):
+    """Move a finished speculative STL next to the paid order's file; True if there was one."""
+    if not temp_file_path:
+        return False
+    temp_stl = f"{temp_file_path.rsplit('.', 1)[0]}.stl"
+    stored, _ = artifacts.locate(temp_stl)
+    if stored is None:
+        return False
+    storage.move(stored, stl_filepath + stored[len(temp_stl):])
+    metrics.inc("speculative_conversions_total", outcome="adopted")
+    return True
+
+@jobs.every(60, 'resume-background-work')
+def resume_background_work():
+    """Restart queue consumers in this process so work left by a lost process gets picked up."""
+    jobs.wake()
+    mailer.sender().wake()
+    for name in printer.REGISTRY:
+        printer.uploader(name).wake()
+
+@jobs.every(60, 'dispatch-ready-orders')
+def dispatch_ready_orders_periodically():
+    dispatch_ready_orders()
+
+@jobs.every(retention.RETENTION_INTERVAL, 'retention-sweep')
+def sweep_expired_files():
+    retention.sweep(EXPORT_DIR)
 
 # --- Routes ---
 
@@ -423,19 +566,18 @@ def create_payment():
         # Save file TEMPORARILY (not creating order yet!)
         today = datetime.datetime.now().strftime("%Y-%m-%d")
         temp_dir = os.path.join(EXPORT_DIR, "temp", today)
-        os.makedirs(temp_dir, exist_ok=True)
         
         clean_name = secure_filename(file.filename)
         timestamp = int(datetime.datetime.now().timestamp())
         temp_filename = f"{timestamp}_{clean_name}"
         temp_filepath = os.path.join(temp_dir, temp_filename)
         
-        file.save(temp_filepath)
+        storage.save(temp_filepath, file.stream)
         
         logging.info(f"File saved temporarily at {temp_filepath}. Creating Stripe session...")
 
         # Create Stripe Checkout Session IMMEDIATELY
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = stripe_client.create_checkout_session(
             payment_method_types=['card'],
             line_items=[{
                 'price_data': {
@@ -467,6 +609,16 @@ def create_payment():
         )
         
         logging.info(f"Stripe session created: {checkout_session.id}. Awaiting payment to create order.")
+
+        if SPECULATIVE_CONVERSION and clean_name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS:
+            try:
+                with get_db_connection(write=True) as conn:
+                    jobs.enqueue(conn.cursor(), 'speculative-convert',
+                                 {"temp_filepath": temp_filepath, "session_id": checkout_session.id},
+                                 max_attempts=1, priority=jobs.PRIORITY_LOW)
+                jobs.wake()
+            except Exception as e:  # Only an optimization; the paid order converts anyway
+                logging.warning(f"Could not queue speculative conversion for {temp_filepath}: {e}")
         
         return jsonify({
             "message": "Payment session created",
@@ -488,12 +640,10 @@ def create_checkout_session():
         return jsonify({"error": "Missing order_id"}), 400
         
     try:
-        conn = get_db_connection()
-        
-        c = conn.cursor()
-        c.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
-        order = c.fetchone()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
+            order = c.fetchone()
         
         if not order:
             return jsonify({"error": "Order not found"}), 404
@@ -501,7 +651,7 @@ def create_checkout_session():
         # Calculate amount in cents
         amount = int(order['total_price'] * 100)
         
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = stripe_client.create_checkout_session(
             payment_method_types=['card'], # Add 'paypal' if needed and enabled in Stripe Dashboard
             line_items=[{
                 'price_data': {
@@ -526,11 +676,10 @@ def create_checkout_session():
         )
         
         # Save session ID
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('UPDATE orders SET stripe_session_id = ? WHERE id = ?', (checkout_session.id, order_id))
-        conn.commit()
-        conn.close()
+        with get_db_connection(write=True) as conn:
+            c = conn.cursor()
+            c.execute('UPDATE orders SET stripe_session_id = ? WHERE id = ?', (checkout_session.id, order_id))
+            bump_version(c)
         
         return jsonify({'url': checkout_session.url})
         
@@ -538,8 +687,17 @@ def create_checkout_session():
         logging.error(f"Stripe Error: {e}")
         return jsonify({'error': str(e)}), 500
 
+STRIPE_HANDLED_EVENTS = ('checkout.session.completed',)
+
+
 @app.route('/api/webhook', methods=['POST'])
 def webhook():
+    """Record the Stripe event and acknowledge it; a 'stripe-event' job creates the order.
+
+    Stripe redelivers events until it gets a 2xx, so each one is stored once,
+    keyed on its event id and (type, session id). A redelivery finds the row and
+    is acknowledged without queueing anything.
+    """
     payload = request.get_data(as_text=True)
     sig_header = request.headers.get('Stripe-Signature')
 
@@ -557,89 +715,141 @@ def webhook():
     except stripe.error.SignatureVerificationError as e:
         return 'Invalid signature', 400
 
-    # Handle the event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        
-        # Retrieve order data from metadata
-        metadata = session.get('metadata', {})
-        temp_file_path = metadata.get('temp_file_path')
-        temp_filename = metadata.get('temp_filename')
-        name = metadata.get('name')
-        email = metadata.get('email')
-        quantity = int(metadata.get('quantity', 0))
-        total_price = float(metadata.get('total_price', 0))
-        message = metadata.get('message', '')
-        date_event = metadata.get('date_event', '')
-        
-        if temp_file_path and os.path.exists(temp_file_path):
-            logging.info(f"Payment successful! Creating order for {name}...")
-            
-            try:
-                # Move file from temp to permanent location
-                today = datetime.datetime.now().strftime("%Y-%m-%d")
-                final_dir = os.path.join(EXPORT_DIR, today)
-                os.makedirs(final_dir, exist_ok=True)
-                
-                final_filepath = os.path.join(final_dir, temp_filename)
-                os.rename(temp_file_path, final_filepath)
-                
-                # Prepare STL path for background job
-                stl_filename = f"{temp_filename.rsplit('.', 1)[0]}.stl"
-                stl_filepath = os.path.join(final_dir, stl_filename)
-                
-                # NOW create the order in DB (ONLY after payment!)
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute('''
-                    INSERT INTO orders (name, email, quantity, total_price, date_event, message, filename, filepath, original_filepath, payment_status, stripe_session_id, status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'Paid', ?, 'Processing')
-                ''', (name, email, quantity, total_price, date_event, message, temp_filename, final_filepath, final_filepath, session['id']))
-                order_id = c.lastrowid
-                conn.commit()
-                conn.close()
-                
-                logging.info(f"Order #{order_id} created AFTER payment for {name}. Starting file processing...")
-                
-                # Prepare Email Data
-                email_info = {
-                    "id": order_id,
-                    "name": name,
-                    "email": email,
-                    "filename": temp_filename,
-                    "quantity": quantity,
-                    "total_price": total_price,
-                    "payment_status": "Paid"
-                }
-                
-                # Start Background Thread for STL conversion and email
-                t = threading.Thread(target=process_order_background, args=(order_id, final_filepath, stl_filepath, email_info))
-                t.start()
-                
-                logging.info(f"Order #{order_id} processing started in background.")
-                
-            except Exception as e:
-                logging.error(f"Error creating order after payment: {e}")
-        else:
-            logging.warning(f"Payment received but temp file not found: {temp_file_path}")
-            
+    if event['type'] not in STRIPE_HANDLED_EVENTS:
+        metrics.inc("stripe_webhook_total", outcome="ignored")
+        return 'Success', 200
+
+    session_id = event['data']['object'].get('id')
+    # Dev payloads posted by hand may lack an id; the session id stands in for it
+    event_id = event.get('id') or f"{event['type']}:{session_id}"
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute('INSERT INTO stripe_events (event_id, type, session_id, payload, received_at) '
+                  'VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+                  (event_id, event['type'], session_id, payload, jobs._now()))
+        queued = c.rowcount > 0
+        if queued:
+            jobs.enqueue(c, 'stripe-event', {"event_id": event_id})
+    if queued:
+        jobs.wake()
+        logging.info(f"Stripe event {event_id} ({event['type']}) recorded for session {session_id}")
+    else:
+        logging.info(f"Stripe event {event_id} for session {session_id} already recorded, ignoring redelivery")
+    metrics.inc("stripe_webhook_total", outcome="queued" if queued else "duplicate")
     return 'Success', 200
 
 
+@jobs.handler('stripe-event')
+def process_stripe_event(event_id):
+    """Create the order for a recorded checkout.session.completed event.
+
+    Safe to run again: an order that already exists for the session is kept,
+    and a file moved by an earlier attempt is picked up where it landed.
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT payload, received_at, processed_at FROM stripe_events WHERE event_id = ?', (event_id,))
+        row = c.fetchone()
+    if row is None or row['processed_at']:
+        return
+    session = json.loads(row['payload'])['data']['object']
+    # The order's folder is the day the payment arrived, however late (or often) this runs
+    received_day = str(row['received_at'])[:10]
+
+    # Retrieve order data from metadata
+    metadata = session.get('metadata', {})
+    temp_file_path = metadata.get('temp_file_path')
+    temp_filename = metadata.get('temp_filename')
+    name = metadata.get('name')
+    email = metadata.get('email')
+    quantity = int(metadata.get('quantity', 0))
+    total_price = float(metadata.get('total_price', 0))
+    message = metadata.get('message', '')
+    date_event = metadata.get('date_event', '')
+
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT id, filepath FROM orders WHERE stripe_session_id = ?', (session['id'],))
+        existing = c.fetchone()
+    if existing:
+        final_filepath = existing['filepath']
+    else:
+        # Move file from temp to permanent location
+        final_filepath = os.path.join(EXPORT_DIR, received_day, temp_filename or '')
+        if temp_file_path and storage.exists(temp_file_path):
+            storage.move(temp_file_path, final_filepath)
+        elif not (temp_filename and storage.exists(final_filepath)):  # Else an earlier attempt moved it
+            logging.warning(f"Payment received but temp file not found: {temp_file_path}")
+            with get_db_connection(write=True) as conn:
+                conn.cursor().execute('UPDATE stripe_events SET processed_at = ? WHERE event_id = ?',
+                                      (jobs._now(), event_id))
+            return
+        logging.info(f"Payment successful! Creating order for {name}...")
+
+    # Prepare STL path for background job
+    stl_filepath = f"{final_filepath.rsplit('.', 1)[0]}.stl"
+    if not existing and adopt_speculative_stl(temp_file_path, stl_filepath):
+        logging.info(f"Adopted the speculative conversion for session {session['id']}")
+
+    # NOW create the order in DB (ONLY after payment!), together with the job
+    # that converts the file and sends the email
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute('SELECT id FROM orders WHERE stripe_session_id = ?', (session['id'],))
+        existing = c.fetchone()
+        if existing:
+            order_id, job_id = existing['id'], None
+        else:
+            c.execute('''
+                INSERT INTO orders (name, email, quantity, total_price, date_event, message, filename, filepath, original_filepath, payment_status, stripe_session_id, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'Paid', ?, 'Processing')
+            ''' + (' RETURNING id' if USE_POSTGRES else ''),
+            (name, email, quantity, total_price, date_event, message, temp_filename, final_filepath, final_filepath, session['id']))
+            order_id = c.fetchone()['id'] if USE_POSTGRES else c.lastrowid
+            stats.order_added(c, order_id)
+            bump_version(c)
+            events.record(c, 'order-created', order_id, name=name, total_price=total_price,
+                          status='Processing', payment_status='Paid')
+
+            # Prepare Email Data
+            email_info = {
+                "id": order_id,
+                "name": name,
+                "email": email,
+                "filename": temp_filename,
+                "quantity": quantity,
+                "total_price": total_price,
+                "payment_status": "Paid"
+            }
+            job_id = jobs.enqueue(c, 'process-order', {
+                "order_id": order_id, "original_filepath": final_filepath,
+                "stl_filepath": stl_filepath, "email_info": email_info,
+            })
+        c.execute('UPDATE stripe_events SET processed_at = ?, order_id = ? WHERE event_id = ?',
+                  (jobs._now(), order_id, event_id))
+    if job_id is None:
+        logging.info(f"Order #{order_id} already exists for session {session['id']}")
+        return
+    jobs.wake()
+    logging.info(f"Order #{order_id} created AFTER payment for {name}; processing queued as job #{job_id}.")
+
+
 @app.route('/api/orders', methods=['GET'])
+@orders_etag()
 def get_orders():
     if not check_auth(request):
         return jsonify({"error": "Unauthorized"}), 401
 
     try:
-        conn = get_db_connection()
-        
-        c = conn.cursor()
-        c.execute('SELECT * FROM orders ORDER BY created_at DESC')
-        rows = c.fetchall()
-        orders = [dict(row) for row in rows]
-        conn.close()
-        return jsonify(orders), 200
+        columns, limit, cursor = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            orders, next_cursor = fetch_orders_page(c, columns, limit, cursor)
+        return jsonify({"orders": orders, "next_cursor": next_cursor}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -655,56 +865,193 @@ def update_order_status(order_id):
         return jsonify({"error": "Missing status"}), 400
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('UPDATE orders SET status = ? WHERE id = ?', (new_status, order_id))
-        conn.commit()
-        conn.close()
+        with get_db_connection(write=True) as conn:
+            c = conn.cursor()
+            # Lock the row on PostgreSQL (SQLite's write lock already covers it), so a
+            # concurrent change can't move the same old status in the rollups twice
+            c.execute('SELECT status FROM orders WHERE id = ?' + (' FOR UPDATE' if USE_POSTGRES else ''), (order_id,))
+            row = c.fetchone()
+            c.execute('UPDATE orders SET status = ? WHERE id = ?', (new_status, order_id))
+            if row:
+                stats.status_changed(c, dict(row)['status'], new_status)
+            if new_status == 'Done':
+                scheduler.orders_done(c, [order_id])
+            bump_version(c)
+            events.record(c, 'status-changed', order_id, status=new_status)
+        dispatch_ready_orders()
         return jsonify({"message": "Status updated"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+BULK_MAX_ORDERS = 500
+
+@app.route('/api/orders/bulk', methods=['POST'])
+def bulk_update_orders():
+    """Set status and/or notes on many orders in one transaction.
+
+    Body: {"ids": [...], "status": "...", "notes": "..."}; at least one of
+    status/notes. Returns the updated rows (projected with ?fields= like
+    /api/orders) plus any ids that don't exist, so the dashboard can patch
+    its table in place.
+    """
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    updates = {key: data[key] for key in ('status', 'notes') if data.get(key) is not None}
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return jsonify({"error": "ids must be a non-empty list of order ids"}), 400
+    if len(ids) > BULK_MAX_ORDERS:
+        return jsonify({"error": f"At most {BULK_MAX_ORDERS} orders per request"}), 400
+    if not updates or not all(isinstance(v, str) for v in updates.values()) or updates.get('status') == '':
+        return jsonify({"error": "Provide a status and/or notes"}), 400
+    try:
+        columns, _, _ = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    ids = list(dict.fromkeys(ids))
+    placeholders = ', '.join('?' * len(ids))
+    try:
+        with get_db_connection(write=True) as conn:
+            c = conn.cursor()
+            # Locked in id order, so overlapping bulk updates queue up instead of deadlocking
+            c.execute(f'SELECT id, status FROM orders WHERE id IN ({placeholders}) ORDER BY id'
+                      + (' FOR UPDATE' if USE_POSTGRES else ''), ids)
+            before = {dict(row)['id']: dict(row)['status'] for row in c.fetchall()}
+            found = [i for i in ids if i in before]
+
+            if found:
+                assignments = ', '.join(f'{key} = ?' for key in updates)
+                c.executemany(f'UPDATE orders SET {assignments} WHERE id = ?',
+                              [(*updates.values(), order_id) for order_id in found])
+
+                if 'status' in updates:
+                    moved = {}
+                    for order_id in found:
+                        moved[before[order_id]] = moved.get(before[order_id], 0) + 1
+                    for old_status, count in moved.items():
+                        stats.status_changed(c, old_status, updates['status'], count)
+                    events.record_many(c, 'status-changed', [(i, {"status": updates['status']}) for i in found])
+                    if updates['status'] == 'Done':
+                        scheduler.orders_done(c, found)
+                bump_version(c)
+
+                c.execute(f"SELECT {', '.join(columns)} FROM orders WHERE id IN ({', '.join('?' * len(found))}) "
+                          "ORDER BY created_at DESC, id DESC", found)
+                orders = [dict(row) for row in c.fetchall()]
+            else:
+                orders = []
+
+        if 'status' in updates:
+            dispatch_ready_orders()
+        return jsonify({"orders": orders, "missing": [i for i in ids if i not in before]}), 200
+    except Exception as e:
+        logging.error(f"Bulk update error: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/printer/upload/<int:order_id>', methods=['POST'])
 def upload_to_printer(order_id):
+    """Queue the order's file for a printer; poll /api/printer/jobs/<id> for progress.
+
+    Body (optional): {"printer": "<name>"}; without it the scheduler picks the
+    available printer that would finish the order first.
+    """
     if not check_auth(request):
         return jsonify({"error": "Unauthorized"}), 401
-    
+
+    name = (request.get_json(silent=True) or {}).get('printer')
+    if name is not None and name not in printer.REGISTRY:
+        return jsonify({"error": f"Unknown printer {name}"}), 400
+
     try:
-        conn = get_db_connection()
-        
-        c = conn.cursor()
-        c.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
-        order = c.fetchone()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id, filepath, quantity FROM orders WHERE id = ?', (order_id,))
+            order = c.fetchone()
 
         if not order:
             return jsonify({"error": "Order not found"}), 404
             
         filepath = order['filepath']
-        if not os.path.exists(filepath):
-            return jsonify({"error": "File missing locally"}), 404
+        if not artifacts.exists(filepath):
+            return jsonify({"error": "File missing from storage"}), 404
 
-        filename = os.path.basename(filepath)
-
-        logging.info(f"Connecting to Printer at {BAMBU_IP}...")
-        
-        ftps = ftplib.FTP_TLS()
-        ftps.timeout = 10
-        ftps.connect(BAMBU_IP, 990)
-        ftps.login('bblp', BAMBU_ACCESS_CODE)
-        ftps.prot_p()
-        
-        with open(filepath, 'rb') as file:
-            ftps.storbinary(f'STOR {filename}', file)
-            
-        ftps.quit()
-        
-        logging.info(f"Successfully uploaded {filename} to printer")
-        return jsonify({"message": "File sent to printer!"}), 200
+        job_id = scheduler.assign(order_id, filepath, order['quantity'], name)
+        if job_id is None:
+            return jsonify({"error": "No printer available"}), 409
+        job = printer.get_job(job_id)
+        logging.info(f"Order #{order_id}: printer job #{job_id} queued on {job['printer']} for {job['remote_name']}")
+        return jsonify({"message": "Queued for the printer", "job": job}), 202
 
     except Exception as e:
         logging.error(f"Printer Error: {e}")
-        return jsonify({"error": f"Printer Connection Failed: {str(e)}"}), 500
+        return jsonify({"error": f"Could not queue printer upload: {str(e)}"}), 500
+
+@app.route('/api/printers', methods=['GET'])
+def list_printers():
+    """The farm: per-printer availability, queue, backlog and utilization, plus the print plan."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(scheduler.overview()), 200
+
+@app.route('/api/printers/<name>', methods=['POST'])
+def update_printer(name):
+    """Body: {"enabled": true|false}. Disabling moves the printer's queued uploads elsewhere."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    if name not in printer.REGISTRY:
+        return jsonify({"error": "Printer not found"}), 404
+    enabled = (request.get_json(silent=True) or {}).get('enabled')
+    if not isinstance(enabled, bool):
+        return jsonify({"error": "enabled must be true or false"}), 400
+    assigned = scheduler.set_enabled(name, enabled)
+    return jsonify({"printer": name, "enabled": enabled, "dispatched": len(assigned)}), 200
+
+@app.route('/api/printers/dispatch', methods=['POST'])
+def dispatch_printers():
+    """Assign every ready order the farm has room for now."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    assigned = scheduler.dispatch()
+    return jsonify({"dispatched": [{"order_id": o, "printer": p, "job_id": j} for o, p, j in assigned]}), 200
+
+@app.route('/api/printer/jobs', methods=['GET'])
+def list_printer_jobs():
+    """Recent printer jobs, newest first; ?order_id= narrows to one order."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    order_id = request.args.get('order_id', type=int)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    return jsonify({"jobs": printer.list_jobs(order_id, limit)}), 200
+
+@app.route('/api/printer/jobs/<int:job_id>', methods=['GET'])
+def get_printer_job(job_id):
+    """Status, attempts, bytes sent and throughput of one upload."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    job = printer.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+@app.route('/api/jobs', methods=['GET'])
+def list_background_jobs():
+    """Background jobs, newest first; ?status=dead lists the dead letters."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    return jsonify({"jobs": jobs.list_jobs(request.args.get('status'), limit)}), 200
+
+@app.route('/api/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_background_job(job_id):
+    """Requeue a dead job with a fresh set of attempts."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    if not jobs.retry(job_id):
+        return jsonify({"error": "No dead or waiting job with that id"}), 404
+    return jsonify(jobs.get_job(job_id)), 200
 
 @app.route('/api/download', methods=['GET'])
 def download():
@@ -719,8 +1066,37 @@ def download():
     path = os.path.normpath(path)
     if not path.startswith(EXPORT_DIR) or '..' in path:
         return "Access denied", 403
-        
-    return send_from_directory('.', path, as_attachment=True)
+
+    stored, compressed = artifacts.locate(path)
+    if stored is None:
+        abort(404)
+    name = os.path.basename(path)
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    local = storage.local_path(stored)
+    if not compressed:
+        if local:
+            # sendfile, with Range and If-None-Match/If-Modified-Since handled for us.
+            # exports/ is relative to the working directory, like every write to it.
+            return send_file(os.path.abspath(local), as_attachment=True)
+        response = app.response_class(artifacts.iter_stored(stored), mimetype=mimetype)
+        response.headers['Content-Length'] = str(storage.size(stored))
+        response.headers['Content-Disposition'] = f'attachment; filename={name}'
+        return response
+
+    # Stored gzipped: hand the bytes over as-is to clients that can decode them
+    if request.accept_encodings['gzip']:
+        if local:
+            response = send_file(os.path.abspath(local), as_attachment=True, download_name=name)
+        else:
+            response = app.response_class(artifacts.iter_stored(stored), mimetype=mimetype)
+            response.headers['Content-Length'] = str(storage.size(stored))
+            response.headers['Content-Disposition'] = f'attachment; filename={name}'
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(artifacts.iter_decompressed(stored), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={name}'
+    response.vary.add('Accept-Encoding')
+    return response
 
 # --- NEW ADMIN API ENDPOINTS ---
 
@@ -741,155 +1117,85 @@ def admin_login():
     else:
         return jsonify({"error": "Invalid password"}), 401
 
+def utc_today():
+    """The day stats.read() calls today (UTC, as DATE('now') is)."""
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
 @app.route('/api/admin/stats', methods=['GET'])
+@orders_etag(utc_today)
 def get_admin_stats():
     """Get dashboard statistics"""
     if not check_auth(request):
         return jsonify({"error": "Unauthorized"}), 401
     
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Total orders
-        c.execute('SELECT COUNT(*) as count FROM orders')
-        total_orders = dict(c.fetchone())['count']
-        
-        # Total revenue
-        c.execute('SELECT SUM(total_price) as revenue FROM orders WHERE payment_status = %s' if USE_POSTGRES else 'SELECT SUM(total_price) as revenue FROM orders WHERE payment_status = ?', ('Paid',))
-        total_revenue = dict(c.fetchone())['revenue'] or 0
-        
-        # Orders by status
-        c.execute('SELECT status, COUNT(*) as count FROM orders GROUP BY status')
-        orders_by_status = {dict(row)['status']: dict(row)['count'] for row in c.fetchall()}
-        
-        # Orders by payment status
-        c.execute('SELECT payment_status, COUNT(*) as count FROM orders GROUP BY payment_status')
-        orders_by_payment = {dict(row)['payment_status']: dict(row)['count'] for row in c.fetchall()}
-        
-        # Recent orders (last 7 days)
-        c.execute('''
-            SELECT DATE(created_at) as date, COUNT(*) as count, SUM(total_price) as revenue
-            FROM orders
-            WHERE created_at >= NOW() - INTERVAL '7 days'
-            GROUP BY DATE(created_at)
-            ORDER BY date DESC
-        ''' if USE_POSTGRES else '''
-            SELECT DATE(created_at) as date, COUNT(*) as count, SUM(total_price) as revenue
-            FROM orders
-            WHERE created_at >= datetime('now', '-7 days')
-            GROUP BY DATE(created_at)
-            ORDER BY date DESC
-        ''')
-        recent_activity = [dict(row) for row in c.fetchall()]
-        
-        # Today's orders
-        c.execute('''
-            SELECT COUNT(*) as count FROM orders
-            WHERE DATE(created_at) = CURRENT_DATE
-        ''' if USE_POSTGRES else '''
-            SELECT COUNT(*) as count FROM orders
-            WHERE DATE(created_at) = DATE('now')
-        ''')
-        today_orders = dict(c.fetchone())['count']
-        
-        conn.close()
-        
-        return jsonify({
-            "total_orders": total_orders,
-            "total_revenue": float(total_revenue),
-            "orders_by_status": orders_by_status,
-            "orders_by_payment": orders_by_payment,
-            "recent_activity": recent_activity,
-            "today_orders": today_orders
-        }), 200
+        # Small rollup rows maintained by the order write paths (see stats.py)
+        with get_db_connection() as conn:
+            return jsonify(stats.read(conn.cursor())), 200
         
     except Exception as e:
         logging.error(f"Stats error: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/orders/search', methods=['GET'])
+@orders_etag()
 def search_orders():
-    """Search and filter orders"""
+    """Search and filter orders.
+
+    With `q`, results come from the full-text index, best match first;
+    without it, newest first like /api/orders.
+    """
     if not check_auth(request):
         return jsonify({"error": "Unauthorized"}), 401
     
     try:
         # Get query parameters
-        query = request.args.get('q', '')
-        status = request.args.get('status', '')
-        payment_status = request.args.get('payment_status', '')
-        date_from = request.args.get('date_from', '')
-        date_to = request.args.get('date_to', '')
-        
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Build dynamic query
-        sql = 'SELECT * FROM orders WHERE 1=1'
-        params = []
-        
-        if query:
-            sql += ' AND (name LIKE %s OR email LIKE %s OR CAST(id AS TEXT) LIKE %s)' if USE_POSTGRES else ' AND (name LIKE ? OR email LIKE ? OR CAST(id AS TEXT) LIKE ?)'
-            search_term = f'%{query}%'
-            params.extend([search_term, search_term, search_term])
-        
-        if status:
-            sql += ' AND status = %s' if USE_POSTGRES else ' AND status = ?'
-            params.append(status)
-        
-        if payment_status:
-            sql += ' AND payment_status = %s' if USE_POSTGRES else ' AND payment_status = ?'
-            params.append(payment_status)
-        
-        if date_from:
-            sql += ' AND DATE(created_at) >= %s' if USE_POSTGRES else ' AND DATE(created_at) >= ?'
-            params.append(date_from)
-        
-        if date_to:
-            sql += ' AND DATE(created_at) <= %s' if USE_POSTGRES else ' AND DATE(created_at) <= ?'
-            params.append(date_to)
-        
-        sql += ' ORDER BY created_at DESC'
-        
-        c.execute(sql, params)
-        rows = c.fetchall()
-        orders = [dict(row) for row in rows]
-        conn.close()
+        query = request.args.get('q', '').strip()
+        columns, limit, cursor = parse_page_args(request.args, search.decode_cursor if query else decode_cursor)
+        where, params = parse_order_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            if query:
+                orders, next_cursor = search.fetch_page(c, columns, limit, cursor, query, where, params)
+            else:
+                orders, next_cursor = fetch_orders_page(c, columns, limit, cursor, where, params)
         
-        return jsonify(orders), 200
+        return jsonify({"orders": orders, "next_cursor": next_cursor}), 200
         
     except Exception as e:
         logging.error(f"Search error: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/orders/<int:order_id>/notes', methods=['GET', 'POST'])
+@orders_etag()
 def manage_order_notes(order_id):
     """Get or update order notes"""
     if not check_auth(request):
         return jsonify({"error": "Unauthorized"}), 401
     
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
+        with get_db_connection(write=request.method == 'POST') as conn:
+            c = conn.cursor()
         
-        if request.method == 'GET':
-            c.execute('SELECT notes FROM orders WHERE id = %s' if USE_POSTGRES else 'SELECT notes FROM orders WHERE id = ?', (order_id,))
-            row = c.fetchone()
-            conn.close()
+            if request.method == 'GET':
+                c.execute('SELECT notes FROM orders WHERE id = %s' if USE_POSTGRES else 'SELECT notes FROM orders WHERE id = ?', (order_id,))
+                row = c.fetchone()
             
-            if not row:
-                return jsonify({"error": "Order not found"}), 404
+                if not row:
+                    return jsonify({"error": "Order not found"}), 404
             
-            return jsonify({"notes": dict(row)['notes']}), 200
+                return jsonify({"notes": dict(row)['notes']}), 200
         
-        else:  # POST
-            data = request.get_json()
-            notes = data.get('notes', '')
+            else:  # POST
+                data = request.get_json()
+                notes = data.get('notes', '')
             
-            c.execute('UPDATE orders SET notes = %s WHERE id = %s' if USE_POSTGRES else 'UPDATE orders SET notes = ? WHERE id = ?', (notes, order_id))
-            conn.commit()
-            conn.close()
+                c.execute('UPDATE orders SET notes = %s WHERE id = %s' if USE_POSTGRES else 'UPDATE orders SET notes = ? WHERE id = ?', (notes, order_id))
+                bump_version(c)
             
             return jsonify({"message": "Notes updated"}), 200
             
@@ -899,52 +1205,71 @@ def manage_order_notes(order_id):
 
 @app.route('/api/orders/export', methods=['GET'])
 def export_orders():
-    """Export orders to CSV"""
+    """Export orders to CSV, streamed as it is read.
+
+    Takes the same status/payment_status/date_from/date_to filters as
+    /api/orders/search. Add gzip=1 for a .csv.gz download.
+    """
     if not check_auth(request):
         return jsonify({"error": "Unauthorized"}), 401
     
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('SELECT * FROM orders ORDER BY created_at DESC')
-        rows = c.fetchall()
-        conn.close()
-        
-        # Create CSV
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Headers
-        writer.writerow(['ID', 'Name', 'Email', 'Quantity', 'Total Price', 'Date Event', 
-                        'Status', 'Payment Status', 'Created At', 'Message', 'Filename'])
-        
-        # Data
-        for row in rows:
-            row_dict = dict(row)
-            writer.writerow([
-                row_dict['id'],
-                row_dict['name'],
-                row_dict['email'],
-                row_dict['quantity'],
-                row_dict['total_price'],
-                row_dict.get('date_event', ''),
-                row_dict['status'],
-                row_dict['payment_status'],
-                row_dict['created_at'],
-                row_dict.get('message', ''),
-                row_dict.get('filename', '')
-            ])
-        
-        # Create response
-        response = make_response(output.getvalue())
-        response.headers['Content-Disposition'] = f'attachment; filename=orders_{datetime.datetime.now().strftime("%Y%m%d")}.csv'
-        response.headers['Content-Type'] = 'text/csv'
-        
-        return response
-        
-    except Exception as e:
-        logging.error(f"Export error: {e}")
-        return jsonify({"error": str(e)}), 500
+        where, params = parse_order_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+
+    body = export_csv_rows(where, params)
+    if compress:
+        body = gzip_stream(body)
+
+    filename = f'orders_{datetime.datetime.now().strftime("%Y%m%d")}.csv' + ('.gz' if compress else '')
+    response = app.response_class(body, mimetype='application/gzip' if compress else 'text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+EXPORT_HEADER = ['ID', 'Name', 'Email', 'Quantity', 'Total Price', 'Date Event',
+                 'Status', 'Payment Status', 'Created At', 'Message', 'Filename']
+EXPORT_COLUMNS = ['id', 'name', 'email', 'quantity', 'total_price', 'date_event',
+                  'status', 'payment_status', 'created_at', 'message', 'filename']
+EXPORT_CHUNK_ROWS = 1000
+
+def export_csv_rows(where='', params=()):
+    """Yield the export CSV a chunk of rows at a time.
+
+    Postgres reads through a named (server-side) cursor, so only one chunk is
+    ever held in the worker; SQLite steps the same query with fetchmany().
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_HEADER)
+    yield output.getvalue()
+
+    with get_db_connection() as conn:
+        c = conn.cursor(name='orders_export') if USE_POSTGRES else conn.cursor()
+        c.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM orders WHERE 1=1{where} "
+                  "ORDER BY created_at DESC, id DESC", params)
+        while True:
+            rows = c.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            output.seek(0)
+            output.truncate()
+            for row in rows:
+                row = dict(row)
+                writer.writerow([row[col] for col in EXPORT_COLUMNS])
+            yield output.getvalue()
+        c.close()
+
+def gzip_stream(chunks, level=6):
+    """Gzip a stream of text chunks on the fly."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
 
 @app.route('/api/orders/new-count', methods=['GET'])
 def get_new_orders_count():
@@ -956,29 +1281,28 @@ def get_new_orders_count():
         # Get timestamp from query param (last check time)
         last_check = request.args.get('since', '')
         
-        conn = get_db_connection()
-        c = conn.cursor()
+        with get_db_connection() as conn:
+            c = conn.cursor()
         
-        if last_check:
-            c.execute('''
-                SELECT COUNT(*) as count FROM orders
-                WHERE created_at > %s
-            ''' if USE_POSTGRES else '''
-                SELECT COUNT(*) as count FROM orders
-                WHERE created_at > ?
-            ''', (last_check,))
-        else:
-            # Return orders from last hour
-            c.execute('''
-                SELECT COUNT(*) as count FROM orders
-                WHERE created_at >= NOW() - INTERVAL '1 hour'
-            ''' if USE_POSTGRES else '''
-                SELECT COUNT(*) as count FROM orders
-                WHERE created_at >= datetime('now', '-1 hour')
-            ''')
+            if last_check:
+                c.execute('''
+                    SELECT COUNT(*) as count FROM orders
+                    WHERE created_at > %s
+                ''' if USE_POSTGRES else '''
+                    SELECT COUNT(*) as count FROM orders
+                    WHERE created_at > ?
+                ''', (last_check,))
+            else:
+                # Return orders from last hour
+                c.execute('''
+                    SELECT COUNT(*) as count FROM orders
+                    WHERE created_at >= NOW() - INTERVAL '1 hour'
+                ''' if USE_POSTGRES else '''
+                    SELECT COUNT(*) as count FROM orders
+                    WHERE created_at >= datetime('now', '-1 hour')
+                ''')
         
-        count = dict(c.fetchone())['count']
-        conn.close()
+            count = dict(c.fetchone())['count']
         
         return jsonify({"new_orders": count}), 200
         
@@ -986,16 +1310,102 @@ def get_new_orders_count():
         logging.error(f"New count error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/orders/events', methods=['GET'])
+def order_events_stream():
+    """Server-Sent Events: order-created, status-changed, conversion-finished.
+
+    EventSource cannot send headers, so the token comes as ?token=. Resumes
+    from the Last-Event-ID header (or ?last_event_id=); a fresh connection
+    only gets events from now on. 503 means this worker has no free stream
+    slot and the dashboard should keep polling.
+    """
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID"}), 400
+
+    broker = events.broker
+    if not broker.subscribe():
+        response = jsonify({"error": "Too many event streams, poll instead"})
+        response.headers['Retry-After'] = '60'
+        return response, 503
+    try:
+        if last_id is None:
+            last_id = events.latest_id()
+    except Exception:
+        broker.unsubscribe()
+        raise
+
+    response = app.response_class(events.stream(broker, last_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let nginx-style proxies buffer the stream
+    return response
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     db_type = "PostgreSQL" if USE_POSTGRES else "SQLite"
     return jsonify({"status": "ok", "db": db_type}), 200
 
 
+def queue_depth_gauges():
+    """Backlog of the jobs, mail and printer queues, read from the database at scrape time.
+
+    These are shared state, so they are added to the merged view as-is rather
+    than recorded per process (where every worker would report the same rows).
+    Every known kind, printer and status starts at 0, so a drained queue reads
+    0 instead of its series disappearing (and alerts on it going stale).
+    """
+    queries = (
+        ("jobs_queued", "SELECT kind, status, COUNT(*) AS n FROM jobs "
+                        "WHERE status IN (?, ?) GROUP BY kind, status",
+         ('queued', 'running'), [{"kind": kind} for kind in jobs._handlers]),
+        ("mail_queued", "SELECT status, COUNT(*) AS n FROM outbound_emails "
+                        "WHERE status IN (?, ?) GROUP BY status",
+         ('queued', 'sending'), [{}]),
+        ("printer_jobs_queued", "SELECT printer, status, COUNT(*) AS n FROM printer_jobs "
+                                "WHERE status IN (?, ?) GROUP BY printer, status",
+         ('queued', 'uploading'), [{"printer": name} for name in printer.REGISTRY]),
+    )
+    gauges = {}
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        for name, sql, statuses, series in queries:
+            for labels in series:
+                for status in statuses:
+                    gauges[(name, tuple(sorted({**labels, "status": status}.items())))] = 0
+            c.execute(sql, statuses)
+            for row in c.fetchall():
+                row = dict(row)
+                n = row.pop('n')
+                gauges[(name, tuple(sorted((k, str(v)) for k, v in row.items())))] = n
+    return gauges
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text format, merged across every worker process (admin token required)."""
+    if not check_auth(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    snap = metrics.collect()
+    try:
+        snap["gauges"].update(queue_depth_gauges())
+    except Exception as e:
+        logging.warning(f"Metrics: queue depth unavailable: {e}")
+    response = make_response(metrics.render(snap))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+logging.info(f"App loaded in {(time.perf_counter() - _import_started) * 1000:.0f} ms (pid {os.getpid()})")
+
 if __name__ == '__main__':
-    # Startup tasks
-    cleanup_thread = threading.Thread(target=cleanup_old_files)
-    cleanup_thread.start()
+    # Startup tasks: sweeps and re-dispatch, as under gunicorn
+    jobs.start_periodic()
 
     # WARNING: This is a development server. 
     # For production, use: gunicorn -w 4 -b 0.0.0.0:5000 server:app
@@ -0,0 +1,108 @@
+"""
+Dashboard rollups for /api/admin/stats.
+
+`stats_daily` keeps one row per day: order count, stamps, revenue, and
+revenue from paid orders. `stats_counts` keeps order counts per status and
+per payment status. The write paths update both inside the transaction
+that changes the order, so reading the stats costs a few small rows,
+however long the order history gets.
+
+If the rollups drift (manual SQL, a restored backup), rebuild them:
+
+    python manage.py rebuild-stats
+"""
+
+from db import USE_POSTGRES, get_db_connection
+
+_DAY = "CAST(DATE(created_at) AS TEXT)" if USE_POSTGRES else "DATE(created_at)"
+_UNKNOWN = "Unknown"  # Stands in for NULL status values, which can't be a primary key
+
+
+def _upsert_daily(select_sql, params):
+    return (f"INSERT INTO stats_daily (day, orders, stamps, revenue, paid_revenue) {select_sql} "
+            "ON CONFLICT (day) DO UPDATE SET orders = stats_daily.orders + excluded.orders, "
+            "stamps = stats_daily.stamps + excluded.stamps, revenue = stats_daily.revenue + excluded.revenue, "
+            "paid_revenue = stats_daily.paid_revenue + excluded.paid_revenue"), params
+
+
+def _bump_count(c, dimension, value, delta):
+    c.execute('INSERT INTO stats_counts (dimension, value, count) VALUES (?, ?, ?) '
+              'ON CONFLICT (dimension, value) DO UPDATE SET count = stats_counts.count + excluded.count',
+              (dimension, value or _UNKNOWN, delta))
+
+
+def order_added(c, order_id):
+    """Count a newly inserted order; call in the same transaction as the INSERT."""
+    c.execute(*_upsert_daily(
+        f"SELECT {_DAY}, 1, COALESCE(quantity, 0), COALESCE(total_price, 0), "
+        "CASE WHEN payment_status = 'Paid' THEN COALESCE(total_price, 0) ELSE 0 END "
+        "FROM orders WHERE id = ?", (order_id,)))
+    c.execute('SELECT status, payment_status FROM orders WHERE id = ?', (order_id,))
+    row = dict(c.fetchone())
+    _bump_count(c, 'status', row['status'], 1)
+    _bump_count(c, 'payment_status', row['payment_status'], 1)
+
+
+def status_changed(c, old_status, new_status, count=1):
+    """Move `count` orders between status counts; call in the transaction that updates them."""
+    if old_status != new_status:
+        _bump_count(c, 'status', old_status, -count)
+        _bump_count(c, 'status', new_status, count)
+
+
+def rebuild():
+    """Recompute every rollup from the orders table in one write transaction."""
+    with get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        rebuild_in(c)
+        c.execute('SELECT COUNT(*) AS days FROM stats_daily')
+        return dict(c.fetchone())['days']
+
+
+def rebuild_in(c):
+    c.execute('DELETE FROM stats_daily')
+    c.execute('DELETE FROM stats_counts')
+    c.execute(f'''
+        INSERT INTO stats_daily (day, orders, stamps, revenue, paid_revenue)
+        SELECT {_DAY}, COUNT(*), COALESCE(SUM(quantity), 0), COALESCE(SUM(total_price), 0),
+               COALESCE(SUM(CASE WHEN payment_status = 'Paid' THEN total_price ELSE 0 END), 0)
+        FROM orders GROUP BY {_DAY}
+    ''')
+    for dimension in ('status', 'payment_status'):
+        c.execute(f'''
+            INSERT INTO stats_counts (dimension, value, count)
+            SELECT ?, COALESCE({dimension}, '{_UNKNOWN}'), COUNT(*) FROM orders GROUP BY COALESCE({dimension}, '{_UNKNOWN}')
+        ''', (dimension,))
+
+
+def read(c, days=7):
+    """Dashboard figures from the rollups (same shape the stats endpoint always returned)."""
+    c.execute('SELECT COALESCE(SUM(orders), 0) AS orders, COALESCE(SUM(stamps), 0) AS stamps, '
+              'COALESCE(SUM(paid_revenue), 0) AS revenue FROM stats_daily')
+    totals = dict(c.fetchone())
+
+    counts = {'status': {}, 'payment_status': {}}
+    c.execute('SELECT dimension, value, count FROM stats_counts WHERE count <> 0')
+    for row in c.fetchall():
+        row = dict(row)
+        counts[row['dimension']][row['value']] = row['count']
+
+    # Days are UTC, like created_at; CURRENT_DATE would follow the session time zone
+    utc_today = "(NOW() AT TIME ZONE 'UTC')::date"
+    since = f"CAST({utc_today} - {int(days)} AS TEXT)" if USE_POSTGRES else f"DATE('now', '-{int(days)} days')"
+    c.execute(f'SELECT day AS date, orders AS count, revenue FROM stats_daily WHERE day >= {since} ORDER BY day DESC')
+    recent_activity = [dict(row) for row in c.fetchall()]
+
+    today = f"CAST({utc_today} AS TEXT)" if USE_POSTGRES else "DATE('now')"
+    c.execute(f'SELECT orders FROM stats_daily WHERE day = {today}')
+    row = c.fetchone()
+
+    return {
+        "total_orders": int(totals['orders']),
+        "total_stamps": int(totals['stamps']),
+        "total_revenue": float(totals['revenue']),
+        "orders_by_status": counts['status'],
+        "orders_by_payment": counts['payment_status'],
+        "recent_activity": recent_activity,
+        "today_orders": dict(row)['orders'] if row else 0,
+    }
@@ -0,0 +1,413 @@
+"""
+Where uploads and generated meshes are kept.
+
+Orders store keys such as `exports/2026-10-19/logo.png`, and every read and
+write goes through this module:
+- local (the default): a key is a path relative to the working directory,
+  as before. Everything must then run on one machine.
+- s3: a key is an object in S3_BUCKET (under S3_PREFIX) on any
+  S3-compatible store (AWS, R2, MinIO...). Web, conversion and printer
+  workers then share nothing but the database and the bucket, and scale out
+  independently.
+
+Writes never expose partial files. Local writes go to a temp file that is
+renamed into place. S3 writes stream in S3_PART_SIZE multipart chunks and
+only appear once the upload completes.
+
+    ARTIFACT_STORAGE=local|s3
+    S3_BUCKET=gassstro
+    S3_ENDPOINT_URL=http://127.0.0.1:9000  # Unset for AWS; local stand-in: python mock_s3.py
+    S3_REGION=auto
+    S3_PREFIX=                             # Optional key prefix, e.g. prod/
+    S3_ACCESS_KEY_ID / S3_SECRET_ACCESS_KEY (else the usual AWS_* credentials)
+    S3_PART_SIZE=8388608                   # Bytes per multipart part (S3 minimum: 5 MiB)
+
+The s3 backend needs boto3, which is imported only when it is configured.
+"""
+
+import os
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+ARTIFACT_STORAGE = os.environ.get("ARTIFACT_STORAGE", "local").lower()
+S3_BUCKET = os.environ.get("S3_BUCKET", "")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+S3_REGION = os.environ.get("S3_REGION") or None
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+S3_ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID") or None
+S3_SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY") or None
+S3_PART_SIZE = int(os.environ.get("S3_PART_SIZE", str(8 * 1024 * 1024)))
+S3_POOL_SIZE = 20
+CHUNK_SIZE = 256 * 1024
+
+
+class LocalStorage:
+    """Keys are file paths under `root`."""
+
+    name = "local"
+
+    def __init__(self, root="."):
+        self.root = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def open(self, key, offset=0):
+        f = open(self.local_path(key), "rb")
+        if offset:
+            f.seek(offset)
+        return f
+
+    def tail(self, key, n):
+        with open(self.local_path(key), "rb") as f:
+            f.seek(-n, os.SEEK_END)
+            return f.read(n)
+
+    def save(self, key, fileobj):
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return os.path.getsize(path)
+
+    def put_file(self, key, local):
+        path = self.local_path(key)
+        if os.path.abspath(local) == os.path.abspath(path):
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            os.replace(local, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            with open(local, "rb") as f:  # Another filesystem: copy next to the target, then rename
+                self.save(key, f)
+            os.remove(local)
+
+    @contextmanager
+    def local_copy(self, key):
+        path = self.local_path(key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(key)
+        yield path
+
+    def move(self, src, dst):
+        path = self.local_path(dst)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        os.replace(self.local_path(src), path)
+
+    def delete_many(self, keys):
+        deleted = 0
+        for key in keys:
+            try:
+                os.remove(self.local_path(key))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    def list_dirs(self, prefix):
+        try:
+            with os.scandir(self.local_path(prefix)) as entries:
+                return [e.name for e in entries if e.is_dir()]
+        except FileNotFoundError:
+            return []
+
+    def scan(self, prefix):
+        """(key, size, mtime) of the files directly under `prefix`."""
+        try:
+            with os.scandir(self.local_path(prefix)) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        yield os.path.join(prefix, entry.name), stat.st_size, stat.st_mtime
+        except FileNotFoundError:
+            return
+
+    def remove_dir(self, prefix):
+        """Remove an empty directory; False if something is still in it."""
+        try:
+            os.rmdir(self.local_path(prefix))
+            return True
+        except OSError:
+            return False
+
+
+class S3Storage:
+    """Keys are objects in one bucket of an S3-compatible store."""
+
+    name = "s3"
+
+    def __init__(self, bucket=S3_BUCKET, endpoint_url=S3_ENDPOINT_URL, region=S3_REGION, prefix=S3_PREFIX,
+                 access_key=S3_ACCESS_KEY_ID, secret_key=S3_SECRET_ACCESS_KEY, part_size=S3_PART_SIZE):
+        if not bucket:
+            raise ValueError("S3_BUCKET is required for ARTIFACT_STORAGE=s3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self._options = dict(endpoint_url=endpoint_url, region_name=region,
+                             aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+        self._client = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork_in_child)
+
+    def _after_fork_in_child(self):
+        # The client's connection pool must not be shared across fork()
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import boto3
+                from botocore.config import Config
+
+                config = Config(
+                    # Custom endpoints (MinIO, R2, mock_s3.py) rarely do virtual-host buckets
+                    s3={"addressing_style": "path" if self._options["endpoint_url"] else "auto"},
+                    max_pool_connections=S3_POOL_SIZE,
+                    retries={"max_attempts": 3, "mode": "standard"},
+                    request_checksum_calculation="when_required",
+                    response_checksum_validation="when_required",
+                )
+                self._client = boto3.client("s3", config=config, **self._options)
+            return self._client
+
+    def _key(self, key):
+        return self.prefix + key.replace(os.sep, "/")
+
+    def _missing(self, e):
+        from botocore.exceptions import ClientError
+        return isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def local_path(self, key):
+        return None
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except Exception as e:
+            if self._missing(e):
+                return False
+            raise
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+        except Exception as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def _get(self, key, **kwargs):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key), **kwargs)["Body"]
+        except Exception as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def open(self, key, offset=0):
+        # A StreamingBody cannot seek: start the download at `offset` instead
+        return self._get(key, Range=f"bytes={offset}-") if offset else self._get(key)
+
+    def tail(self, key, n):
+        body = self._get(key, Range=f"bytes=-{n}")
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def save(self, key, fileobj):
+        """Stream `fileobj` to the object; parts are read and sent one at a time."""
+        target = self._key(key)
+        first = fileobj.read(self.part_size)
+        if len(first) < self.part_size:
+            self.client.put_object(Bucket=self.bucket, Key=target, Body=first)
+            return len(first)
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=target)["UploadId"]
+        parts, total, chunk = [], 0, first
+        try:
+            while chunk:
+                number = len(parts) + 1
+                etag = self.client.upload_part(Bucket=self.bucket, Key=target, UploadId=upload_id,
+                                               PartNumber=number, Body=chunk)["ETag"]
+                parts.append({"PartNumber": number, "ETag": etag})
+                total += len(chunk)
+                chunk = fileobj.read(self.part_size)
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=target, UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except BaseException:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=target, UploadId=upload_id)
+            except Exception as e:
+                logging.warning(f"Could not abort multipart upload of {target}: {e}")
+            raise
+        return total
+
+    def put_file(self, key, local):
+        with open(local, "rb") as f:
+            self.save(key, f)
+        os.remove(local)
+
+    @contextmanager
+    def local_copy(self, key):
+        suffix = os.path.splitext(key)[1]
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            body = self._get(key)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    shutil.copyfileobj(body, f, CHUNK_SIZE)
+            finally:
+                body.close()
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def move(self, src, dst):
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=self._key(dst),
+                                    CopySource={"Bucket": self.bucket, "Key": self._key(src)})
+        except Exception as e:
+            if self._missing(e):
+                raise FileNotFoundError(src) from e
+            raise
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(src))
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):  # DeleteObjects takes up to 1000 keys
+            batch = [{"Key": self._key(k)} for k in keys[i:i + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch, "Quiet": True})
+        return len(keys)
+
+    def _pages(self, prefix, **kwargs):
+        paginator = self.client.get_paginator("list_objects_v2")
+        return paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix).rstrip("/") + "/", **kwargs)
+
+    def list_dirs(self, prefix):
+        names = []
+        for page in self._pages(prefix, Delimiter="/"):
+            names += [p["Prefix"].rstrip("/").rsplit("/", 1)[-1] for p in page.get("CommonPrefixes", [])]
+        return names
+
+    def scan(self, prefix):
+        """(key, size, mtime) of the objects directly under `prefix`."""
+        base = prefix.rstrip("/") + "/"
+        for page in self._pages(prefix, Delimiter="/"):
+            for obj in page.get("Contents", []):
+                name = obj["Key"].rsplit("/", 1)[-1]
+                yield base + name, obj["Size"], obj["LastModified"].timestamp()
+
+    def remove_dir(self, prefix):
+        return True  # Prefixes vanish with their last object
+
+
+_backend = None
+
+
+def configure(kind=None, **options):
+    """Select the backend ('local' or 's3'); options override the S3_* settings."""
+    global _backend
+    kind = (kind or ARTIFACT_STORAGE).lower()
+    if kind == "s3":
+        backend = S3Storage(**options)
+    elif kind == "local":
+        backend = LocalStorage(**options)
+    else:
+        raise ValueError(f"Unknown ARTIFACT_STORAGE {kind!r}")
+    _backend = backend
+    logging.info(f"Artifact storage: {kind}" + (f" (bucket {backend.bucket})" if kind == "s3" else ""))
+    return backend
+
+
+def backend():
+    return _backend or configure()
+
+
+# Module-level shortcuts to the configured backend
+
+def local_path(key):
+    """Path on this machine's disk, or None when the backend is remote."""
+    return backend().local_path(key)
+
+
+def exists(key):
+    return backend().exists(key)
+
+
+def size(key):
+    return backend().size(key)
+
+
+def open_stream(key, offset=0):
+    """Binary reader over the stored bytes from `offset` on; close it (or use `with`) when done.
+
+    The reader is not necessarily seekable (S3 bodies are not).
+    """
+    return backend().open(key, offset)
+
+
+def tail(key, n):
+    return backend().tail(key, n)
+
+
+def save(key, fileobj):
+    """Write a stream to `key`; returns the number of bytes stored."""
+    with metrics.timer("storage_seconds", backend=backend().name, operation="save"):
+        written = backend().save(key, fileobj)
+    metrics.inc("storage_bytes_written_total", written, backend=backend().name)
+    return written
+
+
+def put_file(key, local):
+    """Move a finished local file into storage under `key` (the local file is consumed)."""
+    with metrics.timer("storage_seconds", backend=backend().name, operation="put"):
+        backend().put_file(key, local)
+
+
+def local_copy(key):
+    """Context manager giving a local path with the key's contents (a temp copy for remote backends)."""
+    return backend().local_copy(key)
+
+
+def move(src, dst):
+    backend().move(src, dst)
+
+
+def delete_many(keys):
+    return backend().delete_many(keys)
+
+
+def list_dirs(prefix):
+    return backend().list_dirs(prefix)
+
+
+def scan(prefix):
+    return backend().scan(prefix)
+
+
+def remove_dir(prefix):
+    return backend().remove_dir(prefix)
@@ -0,0 +1,72 @@
+"""
+Stripe HTTP client configuration.
+
+Replaces the library default (a fresh session per thread, 80 s timeout) with a
+shared keep-alive connection pool, bounded connect/read timeouts and a small
+retry budget, and times every API call into `metrics`.
+
+Set STRIPE_API_BASE to point the app at a local stand-in (see mock_stripe.py).
+"""
+
+import os
+import logging
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+STRIPE_API_BASE = os.environ.get("STRIPE_API_BASE")  # e.g. http://127.0.0.1:12111 for mock_stripe.py
+STRIPE_CONNECT_TIMEOUT = float(os.environ.get("STRIPE_CONNECT_TIMEOUT", "3"))
+STRIPE_READ_TIMEOUT = float(os.environ.get("STRIPE_READ_TIMEOUT", "10"))
+STRIPE_MAX_RETRIES = int(os.environ.get("STRIPE_MAX_RETRIES", "2"))
+STRIPE_POOL_SIZE = int(os.environ.get("STRIPE_POOL_SIZE", "10"))
+
+
+def _build_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def configure(api_key, api_base=STRIPE_API_BASE, connect_timeout=STRIPE_CONNECT_TIMEOUT,
+              read_timeout=STRIPE_READ_TIMEOUT, max_retries=STRIPE_MAX_RETRIES,
+              pool_size=STRIPE_POOL_SIZE):
+    """Install the pooled, timed HTTP client as the Stripe default."""
+    stripe.api_key = api_key
+    if api_base:
+        stripe.api_base = api_base.rstrip("/")
+    # Stripe retries idempotently (it sends an Idempotency-Key on POST retries)
+    stripe.max_network_retries = max_retries
+    stripe.default_http_client = stripe.RequestsClient(
+        timeout=(connect_timeout, read_timeout),
+        session=_build_session(pool_size),
+    )
+    logging.info(
+        f"Stripe client configured (timeout={connect_timeout}s/{read_timeout}s, "
+        f"retries={max_retries}, pool={pool_size}, base={stripe.api_base})"
+    )
+
+
+def _reset_after_fork():
+    # Pooled sockets must not be shared between a parent and forked workers
+    client = stripe.default_http_client
+    if isinstance(client, stripe.RequestsClient):
+        client._session = _build_session(STRIPE_POOL_SIZE)
+        client._thread_local.__dict__.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def create_checkout_session(**params):
+    """`stripe.checkout.Session.create` with latency and outcome metrics."""
+    with metrics.timer("stripe_request_seconds", operation="checkout.session.create") as labels:
+        try:
+            return stripe.checkout.Session.create(**params)
+        except stripe.error.StripeError as e:
+            labels["outcome"] = type(e).__name__
+            raise
@@ -0,0 +1,55 @@
+import gzip
+import os
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import pytest
+
+import artifacts
+import server
+
+TOKEN = "test-admin-token"
+MESH = b"solid x\n" + b"facet normal 0 0 1\n outer loop\n vertex 0 0 0\n endloop\nendfacet\n" * 2000
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    os.makedirs("exports/2026-10-01")
+    return server.app.test_client()
+
+
+def test_store_compresses_and_keeps_logical_path(client):
+    path = "exports/2026-10-01/logo.stl"
+    with open(path, "wb") as f:
+        f.write(MESH)
+
+    stored = artifacts.store(path)
+    assert stored == path + ".gz" and not os.path.exists(path)
+    assert os.path.getsize(stored) < len(MESH) / 10
+    assert artifacts.locate(path) == (stored, True)
+    with artifacts.open_artifact(path) as f:
+        assert f.read() == MESH
+
+    url = f"/api/download?path={path}&token={TOKEN}"
+    raw = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert raw.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in raw.headers["Vary"]
+    assert "logo.stl" in raw.headers["Content-Disposition"] and gzip.decompress(raw.data) == MESH
+
+    plain = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers and plain.data == MESH
+
+
+def test_uncompressed_download_supports_range_and_conditional(client):
+    path = "exports/2026-10-01/photo.png"
+    with open(path, "wb") as f:
+        f.write(b"0123456789")
+    url = f"/api/download?path={path}&token={TOKEN}"
+
+    partial = client.get(url, headers={"Range": "bytes=2-5"})
+    assert partial.status_code == 206 and partial.data == b"2345"
+
+    etag = client.get(url).headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(f"/api/download?path=exports/missing.stl&token={TOKEN}").status_code == 404
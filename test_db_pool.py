@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import db
+import metrics
+from db import ConnectionPool, Connection, PoolTimeout
+
+
+def sqlite_factory():
+    return sqlite3.connect(":memory:", check_same_thread=False)
+
+
+def test_pool_reuses_connections_and_returns_them_on_error():
+    pool = ConnectionPool(sqlite_factory, minconn=1, maxconn=2, timeout=0.5, name="test")
+    pool.fill()
+
+    first = pool.getconn()
+    pool.putconn(first)
+    second = pool.getconn()
+    assert second is first  # reused, not reconnected
+
+    try:
+        with Connection(second, pool.putconn) as conn:
+            conn.cursor().execute("SELECT 1")
+            raise RuntimeError("route failed")
+    except RuntimeError:
+        pass
+    assert pool.size == 1 and pool._in_use == 0
+
+
+def test_pool_blocks_until_timeout_when_saturated():
+    metrics.reset()
+    pool = ConnectionPool(sqlite_factory, minconn=0, maxconn=1, timeout=0.2, name="test")
+    held = pool.getconn()
+
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - started >= 0.2
+
+    # A waiter is woken as soon as the connection comes back
+    threading.Timer(0.05, pool.putconn, args=(held,)).start()
+    assert pool.getconn() is held
+
+    counters = metrics.snapshot()["counters"]
+    assert counters[("db_pool_timeouts_total", (("pool", "test"),))] == 1
+    gauges = metrics.snapshot()["gauges"]
+    assert gauges[("db_pool_saturation", (("pool", "test"),))] == 1.0
+
+
+def test_pool_replaces_stale_connections():
+    pool = ConnectionPool(sqlite_factory, minconn=0, maxconn=1, timeout=0.5, check_interval=0, name="test")
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.close()  # Simulates the server dropping an idle session
+
+    fresh = pool.getconn()
+    assert fresh is not conn
+    fresh.cursor().execute("SELECT 1")
+
+
+@pytest.mark.skipif(not os.environ.get("TEST_DATABASE_URL"), reason="set TEST_DATABASE_URL to a local Postgres")
+def test_postgres_pool_round_trip(monkeypatch):
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+
+    monkeypatch.setattr(db, "USE_POSTGRES", True)
+
+    pool = ConnectionPool(lambda: psycopg2.connect(os.environ["TEST_DATABASE_URL"], cursor_factory=RealDictCursor),
+                          minconn=1, maxconn=2, name="test")
+    pool.fill()
+    with Connection(pool.getconn(), pool.putconn) as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 AS one")
+        assert c.fetchone()["one"] == 1
+        assert c.execute("SELECT ? AS two", (2,)).fetchone()["two"] == 2  # Chains like sqlite3
+    assert pool._in_use == 0
+    pool.closeall()
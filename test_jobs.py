@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import pytest
+
+import db
+import jobs
+import mailer
+import migrations
+import server
+
+TOKEN = "test-admin-token"
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    monkeypatch.setattr(jobs, "JOBS_INLINE", False)
+    monkeypatch.setattr(jobs, "JOBS_RETRY_BACKOFF", 0)
+    migrations.migrate()
+    calls = []
+
+    def flaky(n, fail_times=0):
+        calls.append(n)
+        if calls.count(n) <= fail_times:
+            raise RuntimeError(f"boom {n}")
+
+    monkeypatch.setitem(jobs._handlers, "flaky", flaky)
+    return calls
+
+
+def enqueue(kind, payload, **kwargs):
+    with db.get_db_connection(write=True) as conn:
+        return jobs.enqueue(conn.cursor(), kind, payload, **kwargs)
+
+
+def test_failed_jobs_retry_then_dead_letter_and_can_be_requeued(queue):
+    retried = enqueue("flaky", {"n": 1, "fail_times": 1})
+    dead = enqueue("flaky", {"n": 2, "fail_times": 5}, max_attempts=2)
+    while jobs.run_one("w1"):
+        pass
+
+    assert jobs.get_job(retried)["status"] == "done" and jobs.get_job(retried)["attempts"] == 2
+    job = jobs.get_job(dead)
+    assert job["status"] == "dead" and job["attempts"] == 2 and job["last_error"] == "boom 2"
+
+    api = server.app.test_client()
+    assert [j["id"] for j in api.get(f"/api/jobs?status=dead&token={TOKEN}").get_json()["jobs"]] == [dead]
+    assert api.post(f"/api/jobs/{dead}/retry?token={TOKEN}").get_json()["status"] == "queued"
+    assert api.post(f"/api/jobs/{retried}/retry?token={TOKEN}").status_code == 404  # Already done
+    while jobs.run_one("w1"):
+        pass
+    assert jobs.get_job(dead)["status"] == "dead" and jobs.get_job(dead)["attempts"] == 2  # A fresh set of attempts
+
+
+def test_inline_worker_outlives_its_idle_window_for_a_pending_retry(queue, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_IDLE_SECONDS", 0.2)
+    monkeypatch.setattr(jobs, "JOBS_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(jobs, "JOBS_RETRY_BACKOFF", 1)  # Retries come due after the idle window
+    job_id = enqueue("flaky", {"n": 7, "fail_times": 2})
+    worker = jobs.InlineWorker()
+    worker.wake()
+
+    deadline = time.monotonic() + 10
+    while jobs.get_job(job_id)["status"] != "done" and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert jobs.get_job(job_id)["status"] == "done" and jobs.get_job(job_id)["attempts"] == 3
+    while worker._thread is not None and time.monotonic() < deadline:  # Nothing scheduled: it exits
+        time.sleep(0.05)
+    assert worker._thread is None
+
+
+def test_expired_lease_is_reclaimed_and_the_old_owner_cannot_finish(queue):
+    job_id = enqueue("flaky", {"n": 3})
+    lost = jobs._claim("lost-worker")
+    assert lost["id"] == job_id and jobs._claim("w2") is None  # Leased
+
+    with db.get_db_connection(write=True) as conn:
+        conn.execute("UPDATE jobs SET lease_until = '2000-01-01 00:00:00' WHERE id = ?", (job_id,))
+    assert jobs.run_one("w2") and queue == [3]
+    assert not jobs._finish(lost, "lost-worker", status='done')
+    assert jobs.get_job(job_id)["attempts"] == 2
+
+
+def test_webhook_queues_order_processing_that_is_safe_to_rerun(queue, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "STRIPE_WEBHOOK_SECRET", "")
+    monkeypatch.setattr(server, "EXPORT_DIR", str(tmp_path / "exports"))
+    monkeypatch.setattr(mailer, "SMTP_PASSWORD", "secret")
+    monkeypatch.setattr(mailer.Sender, "wake", lambda self: None)  # Leave mail queued
+    upload = tmp_path / "temp.stl"
+    upload.write_bytes(b"solid x")
+    session = {"id": "cs_job_1", "metadata": {"temp_file_path": str(upload), "temp_filename": "temp.stl",
+               "name": "c", "email": "c@x.it", "quantity": "2", "total_price": "8.0"}}
+    event = {"id": "evt_1", "type": "checkout.session.completed", "data": {"object": session}}
+    client = server.app.test_client()
+    assert client.post("/api/webhook", json=event).status_code == 200
+    # Redeliveries, including one under a fresh event id, are acknowledged and dropped
+    assert client.post("/api/webhook", json=event).status_code == 200
+    assert client.post("/api/webhook", json={**event, "id": "evt_2"}).status_code == 200
+    (created,) = jobs.list_jobs()
+    with db.get_db_connection(write=True) as conn:  # The job runs after midnight
+        conn.execute("UPDATE stripe_events SET received_at = '2026-10-18 23:59:59' WHERE event_id = 'evt_1'")
+    assert created["kind"] == "stripe-event" and jobs.run_one("w1")
+    server.process_stripe_event("evt_1")  # Running it again changes nothing
+    with db.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) AS n FROM orders").fetchone()["n"] == 1
+        filepath = conn.execute("SELECT filepath FROM orders").fetchone()["filepath"]
+    assert filepath == str(tmp_path / "exports" / "2026-10-18" / "temp.stl")
+
+    job, _ = jobs.list_jobs()
+    assert job["kind"] == "process-order" and job["status"] == "queued"
+    assert jobs.run_one("w1") and jobs.get_job(job["id"])["status"] == "done"
+    assert jobs.retry(job["id"]) is False  # Done jobs stay done
+
+    # A second run (as after a lost lease) doesn't send the confirmation twice
+    server.process_order_background(**json.loads(job["payload"]))
+    with db.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) AS n FROM outbound_emails WHERE order_id = 1").fetchone()["n"] == 1
+
+
+def test_standalone_worker_drains_the_queue_and_stops(queue, monkeypatch):
+    # Not server.py's periodic tasks: they start the real mail sender and sweep ./exports
+    ticks = []
+    monkeypatch.setattr(jobs, "_periodic", [("tick", 60, lambda: ticks.append(1))])
+    for n in range(6):
+        enqueue("flaky", {"n": n})
+    stop = threading.Event()
+    worker = threading.Thread(target=jobs.run_worker, args=(3, stop))
+    worker.start()
+    try:
+        for _ in range(100):
+            if len(queue) == 6:
+                break
+            stop.wait(0.05)
+    finally:
+        stop.set()
+        worker.join(10)
+    assert sorted(queue) == list(range(6)) and not worker.is_alive()
+    assert ticks == [1] and not jobs._standalone.is_set()
+
+
+def test_speculative_conversion_is_low_priority_and_adopted_by_the_paid_order(queue, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "STRIPE_WEBHOOK_SECRET", "")
+    monkeypatch.setattr(server, "EXPORT_DIR", str(tmp_path / "exports"))
+    monkeypatch.setattr(mailer.Sender, "wake", lambda self: None)
+    conversions = []
+
+    class Converter:
+        def generate_stl(self, source, target):
+            conversions.append(source)
+            with open(target, "wb") as f:
+                f.write(b"solid x\n" * 100)
+
+    monkeypatch.setattr(server, "get_converter", lambda: Converter())
+    upload = tmp_path / "exports" / "temp" / "2026-10-19" / "1_logo.png"
+    upload.parent.mkdir(parents=True)
+    upload.write_bytes(b"png")
+    with db.get_db_connection(write=True) as conn:
+        jobs.enqueue(conn.cursor(), "speculative-convert", {"temp_filepath": str(upload)},
+                     max_attempts=1, priority=jobs.PRIORITY_LOW)
+    paid = enqueue("flaky", {"n": 1})
+    assert jobs.run_one("w1") and queue == [1] and jobs.get_job(paid)["status"] == "done"  # Paid work first
+    assert jobs.run_one("w1") and len(conversions) == 1
+
+    session = {"id": "cs_spec", "metadata": {"temp_file_path": str(upload), "temp_filename": upload.name,
+               "name": "c", "email": "c@x.it", "quantity": "1", "total_price": "4.0"}}
+    server.app.test_client().post("/api/webhook", json={"type": "checkout.session.completed",
+                                                        "data": {"object": session}})
+    while jobs.run_one("w1"):  # stripe-event, then process-order
+        pass
+    assert len(conversions) == 1 and not os.listdir(upload.parent)
+    with db.get_db_connection() as conn:
+        filepath = conn.execute("SELECT filepath FROM orders").fetchone()["filepath"]
+    assert filepath.endswith("1_logo.stl") and os.path.exists(filepath + ".gz")
+
+
+def test_web_process_runs_the_sweep_once_per_interval_without_a_worker(queue, tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_INLINE", True)
+    monkeypatch.setattr(jobs, "JOBS_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(server, "EXPORT_DIR", str(tmp_path / "exports"))
+    # Only the sweep: the other tasks start the real mail sender and printer uploads
+    monkeypatch.setattr(jobs, "_periodic", [task for task in jobs._periodic if task[0] == "retention-sweep"])
+    expired = tmp_path / "exports" / "temp" / "2026-01-01" / "abandoned.png"
+    expired.parent.mkdir(parents=True)
+    expired.write_bytes(b"png")
+    os.utime(expired, (0, 0))
+
+    runner = jobs._PeriodicRunner()
+    monkeypatch.setattr(jobs, "_periodic_runner", runner)
+    jobs.start_periodic()  # As gunicorn's post_worker_init does
+    try:
+        for _ in range(100):
+            if not expired.exists():
+                break
+            time.sleep(0.05)
+    finally:
+        runner.stop.set()
+        runner._thread.join(5)
+    assert not expired.exists()
+
+    # Another web worker finds this interval taken
+    claimed, wait = jobs._claim_periodic("retention-sweep", 3600, "other-worker")
+    assert not claimed and 3500 < wait <= 3600
@@ -0,0 +1,80 @@
+import os
+import time
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import pytest
+
+import db
+import mailer
+import migrations
+import server
+from mock_smtp import MockSMTPServer
+
+
+@pytest.fixture
+def sink(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    monkeypatch.setattr(mailer, "SMTP_PASSWORD", "secret")
+    monkeypatch.setattr(mailer, "MAIL_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(mailer, "MAIL_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(mailer, "MAIL_SESSION_IDLE_SECONDS", 0.5)
+    migrations.migrate()
+
+    srv = MockSMTPServer(password="secret").start()
+    client = mailer.SMTPClient(host="127.0.0.1", port=srv.port, password="secret",
+                               starttls=srv.tls_context is not None, timeout=5)
+    sender = mailer.Sender(client)
+    monkeypatch.setattr(mailer, "_sender", sender)
+    yield srv
+    while sender._thread is not None:  # Idles out and closes the session
+        time.sleep(0.05)
+    srv.stop()
+
+
+def wait_for(email_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        email = mailer.get_email(email_id)
+        if email["status"] in ("sent", "failed"):
+            return email
+        time.sleep(0.05)
+    raise AssertionError(f"email {email_id} still {email['status']}")
+
+
+def test_queue_retries_transient_failures_over_one_session(sink):
+    sink.fail_data = 1
+    ids = [mailer.enqueue(f"c{i}@example.com", f"Ordine #{i}", f"<p>{i}</p>", order_id=i) for i in range(5)]
+    emails = [wait_for(email_id) for email_id in ids]
+
+    assert [e["status"] for e in emails] == ["sent"] * 5
+    assert [e["attempts"] for e in emails] == [2, 1, 1, 1, 1]  # Only the message refused with 451 was retried
+    assert all(e["latency_ms"] is not None for e in emails)
+    assert sorted(r[0] for r, _ in sink.messages) == [f"c{i}@example.com" for i in range(5)]
+    assert sink.logins == 1 and ("STARTTLS" in sink.commands) == (sink.tls_context is not None)
+
+
+def test_rejected_recipient_fails_without_retrying(sink):
+    sink.reject.add("nobody@example.com")
+    bad = wait_for(mailer.enqueue("nobody@example.com", "x", "<p>x</p>"))
+    good = wait_for(mailer.enqueue("ok@example.com", "y", "<p>y</p>"))
+    assert bad["status"] == "failed" and bad["attempts"] == 1 and "550" in bad["error"]
+    assert good["status"] == "sent" and sink.logins == 1
+
+
+def test_confirmation_email_is_queued_not_sent_inline(sink):
+    order = {"id": 42, "name": "Ada", "filename": "logo.stl", "quantity": 2, "total_price": 18.0}
+    server.send_confirmation_email("ada@example.com", order)
+    deadline = time.monotonic() + 10
+    while not sink.messages and time.monotonic() < deadline:
+        time.sleep(0.05)
+    (recipients, raw), = sink.messages
+    assert recipients == ["ada@example.com"] and b"COMMISSIONE ACCETTATA: Ordine #42" in raw
+
+
+def test_sender_outlives_its_idle_window_for_a_pending_retry(sink, monkeypatch):
+    monkeypatch.setattr(mailer, "MAIL_SESSION_IDLE_SECONDS", 0.2)
+    monkeypatch.setattr(mailer, "MAIL_RETRY_BACKOFF", 1)  # Retries come due after the idle window
+    sink.fail_data = 2
+    email = wait_for(mailer.enqueue("late@example.com", "Ordine", "<p>x</p>", order_id=1))
+    assert email["status"] == "sent" and email["attempts"] == 3
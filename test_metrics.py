@@ -0,0 +1,81 @@
+import os
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import pytest
+
+import db
+import jobs
+import metrics
+import migrations
+import server
+
+TOKEN = "test-admin-token"
+
+
+def record_in_child(amount, utilization):
+    """Fork a worker that records metrics, flushes them and exits; returns its pid."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            metrics.inc("orders_total", amount, outcome="ok")
+            metrics.observe("http_request_seconds", 0.02 * amount, route="/api/orders")
+            metrics.set_gauge("sse_streams", amount)
+            metrics.set_gauge("printer_utilization", utilization, mode="max", printer="p1")
+            metrics.flush()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+def test_collect_merges_workers_and_keeps_exited_ones(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    metrics.reset()
+    first = record_in_child(1, 0.5)
+    record_in_child(2, 0.25)
+
+    view = metrics.collect()
+    assert view["counters"][("orders_total", (("outcome", "ok"),))] == 3
+    hist = view["histograms"][("http_request_seconds", (("route", "/api/orders"),))]
+    assert hist["count"] == 2 and hist["sum"] == pytest.approx(0.06)
+    assert view["gauges"][("sse_streams", ())] == 3
+    assert view["gauges"][("printer_utilization", (("printer", "p1"),))] == 0.5
+
+    # An exited worker's counters stay in the totals; its gauges go
+    metrics.mark_process_dead(first)
+    assert not (tmp_path / f"{first}.json").exists()
+    view = metrics.collect()
+    assert view["counters"][("orders_total", (("outcome", "ok"),))] == 3
+    assert view["histograms"][("http_request_seconds", (("route", "/api/orders"),))]["count"] == 2
+    assert view["gauges"][("sse_streams", ())] == 2
+    metrics.reset()
+
+
+def test_metrics_endpoint_renders_prometheus_text(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    monkeypatch.setattr(jobs, "JOBS_INLINE", False)
+    monkeypatch.setattr(metrics, "METRICS_DIR", None)
+    migrations.migrate()
+    metrics.reset()
+    with db.get_db_connection(write=True) as conn:
+        jobs.enqueue(conn.cursor(), "process-order", {"order_id": 1})
+    client = server.app.test_client()
+
+    assert client.get("/api/metrics").status_code == 401
+    client.get("/api/health")
+    response = client.get(f"/api/metrics?token={TOKEN}")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = response.get_data(as_text=True)
+    assert "# TYPE gassstro_http_request_seconds histogram" in text
+    assert 'gassstro_http_request_seconds_count{method="GET",route="/api/health",status="200"} 1' in text
+    assert 'gassstro_http_request_seconds_bucket{method="GET",route="/api/health",status="200",le="+Inf"} 1' in text
+    assert 'gassstro_jobs_queued{kind="process-order",status="queued"} 1' in text
+    # Empty queues still report, as 0
+    assert 'gassstro_jobs_queued{kind="process-order",status="running"} 0' in text
+    assert 'gassstro_jobs_queued{kind="stripe-event",status="queued"} 0' in text
+    assert 'gassstro_mail_queued{status="queued"} 0' in text
+    metrics.reset()
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import db
+import migrations
+
+
+def _plan(conn, sql, params=()):
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return " | ".join(row[3] for row in rows)
+
+
+def test_fresh_database_migrates_once(tmp_path):
+    db.DB_FILE = str(tmp_path / "orders.db")
+    try:
+        assert migrations.migrate() == [m[0] for m in migrations.MIGRATIONS]
+        assert migrations.migrate() == []
+    finally:
+        db.DB_FILE = "orders.db"
+
+
+def test_legacy_database_is_upgraded(tmp_path):
+    path = str(tmp_path / "orders.db")
+    legacy = sqlite3.connect(path)
+    legacy.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, email TEXT, "
+                   "quantity INTEGER, total_price REAL, date_event TEXT, message TEXT, filename TEXT, "
+                   "filepath TEXT, status TEXT DEFAULT 'Pending', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+                   "stripe_session_id TEXT)")
+    # A webhook retry once created the same order twice
+    legacy.executemany("INSERT INTO orders (name, stripe_session_id) VALUES (?, ?)",
+                       [("A", "cs_1"), ("A", "cs_1"), ("B", "cs_2")])
+    legacy.commit()
+    legacy.close()
+
+    db.DB_FILE = path
+    try:
+        migrations.migrate()
+        with db.get_db_connection() as conn:
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(orders)")}
+            assert {"payment_status", "original_filepath", "notes"} <= columns
+            sessions = [row[0] for row in conn.execute("SELECT stripe_session_id FROM orders ORDER BY id")]
+            assert sessions == ["cs_1", "cs_1:dup:2", "cs_2"]
+            # The rollups start out filled from the existing orders
+            counts = {(row[0], row[1]): row[2] for row in conn.execute("SELECT * FROM stats_counts")}
+            assert counts == {("status", "Pending"): 3, ("payment_status", "Unpaid"): 3}
+            assert conn.execute("SELECT SUM(orders) FROM stats_daily").fetchone()[0] == 3
+    finally:
+        db.DB_FILE = "orders.db"
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    db.DB_FILE = str(tmp_path / "orders.db")
+    try:
+        migrations.migrate()
+        with db.get_db_connection(write=True) as conn:
+            conn.executemany(
+                "INSERT INTO orders (name, email, status, payment_status, stripe_session_id) VALUES (?, ?, ?, ?, ?)",
+                [(f"n{i}", f"{i}@x.it", ["Pending", "Processing", "Done"][i % 3], "Paid", f"cs_{i}")
+                 for i in range(500)])
+            conn.execute("ANALYZE")
+
+        with db.get_db_connection() as conn:
+            assert "USING INDEX idx_orders_created_at" in _plan(conn, "SELECT * FROM orders ORDER BY created_at DESC")
+            assert "USING INDEX idx_orders_status" in _plan(
+                conn, "SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC", ("Done",))
+            assert "idx_orders_payment_status" in _plan(
+                conn, "SELECT COUNT(*) FROM orders WHERE payment_status = ?", ("Paid",))
+            assert "idx_orders_email" in _plan(conn, "SELECT * FROM orders WHERE email = ?", ("1@x.it",))
+            assert "idx_orders_stripe_session_id" in _plan(
+                conn, "SELECT id FROM orders WHERE stripe_session_id = ?", ("cs_1",))
+            try:
+                conn.execute("INSERT INTO orders (stripe_session_id) VALUES ('cs_1')")
+                assert False, "duplicate session accepted"
+            except sqlite3.IntegrityError:
+                pass
+    finally:
+        db.DB_FILE = "orders.db"
@@ -0,0 +1,224 @@
+import csv
+import datetime
+import gzip
+import io
+import os
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import pytest
+
+import db
+import events
+import jobs
+import migrations
+import server
+import stats
+
+TOKEN = "test-admin-token"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    monkeypatch.setattr(jobs, "JOBS_INLINE", False)  # Jobs stay queued unless a test runs them
+    migrations.migrate()
+    server.app.config["TESTING"] = True
+    return server.app.test_client()
+
+
+def add_orders(rows):
+    with db.get_db_connection(write=True) as conn:
+        conn.executemany(
+            "INSERT INTO orders (name, email, quantity, total_price, status, payment_status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def test_orders_keyset_pagination_walks_every_order_once(client):
+    # Several orders share a timestamp, so the id tie-breaker matters
+    add_orders([(f"n{i}", f"{i}@x.it", 2, 8.0, "Pending", "Paid", f"2026-10-0{1 + i % 4} 10:00:00")
+                for i in range(23)])
+
+    seen, cursor = [], None
+    while True:
+        url = f"/api/orders?limit=5&fields=name,status&token={TOKEN}" + (f"&cursor={cursor}" if cursor else "")
+        page = client.get(url).get_json()
+        assert set(page["orders"][0]) == {"id", "created_at", "name", "status"}
+        seen += [(o["created_at"], o["id"]) for o in page["orders"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    assert len(seen) == 23
+    assert seen == sorted(seen, reverse=True)
+
+
+def test_search_pages_with_filters(client):
+    add_orders([(f"n{i}", f"{i}@x.it", 2, 8.0, "Done" if i % 2 else "Pending", "Paid",
+                 f"2026-10-0{1 + i % 4} 10:00:00") for i in range(20)])
+
+    page = client.get(f"/api/orders/search?status=Done&date_from=2026-10-02&date_to=2026-10-02&limit=50&token={TOKEN}").get_json()
+    assert page["next_cursor"] is None
+    assert page["orders"] and all(o["status"] == "Done" and o["created_at"].startswith("2026-10-02")
+                                  for o in page["orders"])
+
+    assert client.get(f"/api/orders?fields=password&token={TOKEN}").status_code == 400
+    assert client.get(f"/api/orders?cursor=not-a-cursor&token={TOKEN}").status_code == 400
+
+
+def test_keyset_query_uses_created_at_index(client):
+    with db.get_db_connection() as conn:
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT id FROM orders WHERE (created_at, id) < (?, ?) "
+                            "ORDER BY created_at DESC, id DESC LIMIT 51", ("2026-10-01", 10)).fetchall()
+    assert "idx_orders_created_at" in plan[0][3]
+
+
+def test_orders_etag_revalidates_until_a_write(client):
+    add_orders([("n", "n@x.it", 2, 8.0, "Pending", "Paid", "2026-10-01 10:00:00")])
+    headers = {"X-Admin-Token": TOKEN}
+
+    first = client.get("/api/orders", headers=headers)
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and first.headers["Cache-Control"] == "private, no-cache"
+
+    cached = client.get("/api/orders", headers={**headers, "If-None-Match": etag})
+    assert cached.status_code == 304 and cached.headers["ETag"] == etag
+
+    order_id = first.get_json()["orders"][0]["id"]
+    client.post(f"/api/orders/{order_id}/status", json={"status": "Done"}, headers=headers)
+    changed = client.get("/api/orders", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert changed.get_json()["orders"][0]["status"] == "Done"
+
+    # No ETag for callers that fail auth
+    assert "ETag" not in client.get("/api/orders", headers={"If-None-Match": etag}).headers
+
+
+def test_event_stream_resumes_from_last_event_id(client, monkeypatch):
+    broker = events.EventBroker(poll_interval=0.05, max_streams=1)
+    monkeypatch.setattr(events, "broker", broker)
+    add_orders([("n", "n@x.it", 2, 8.0, "Pending", "Paid", "2026-10-01 10:00:00")])
+    headers = {"X-Admin-Token": TOKEN}
+    client.post("/api/orders/1/status", json={"status": "Processing"}, headers=headers)
+    client.post("/api/orders/1/status", json={"status": "Done"}, headers=headers)
+
+    response = client.get(f"/api/orders/events?token={TOKEN}", headers={"Last-Event-ID": "1"}, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    body = iter(response.response)
+    assert next(body).startswith(b"retry:")
+    assert next(body) == b'id: 2\nevent: status-changed\ndata: {"id": 1, "status": "Done"}\n\n'
+
+    # One slot per process here: a second dashboard is told to poll
+    assert client.get(f"/api/orders/events?token={TOKEN}").status_code == 503
+
+    # New events reach the open stream through the broker's poller
+    client.post("/api/orders/1/status", json={"status": "Pending"}, headers=headers)
+    assert next(body).startswith(b"id: 3\nevent: status-changed")
+
+    response.close()
+    assert broker._subscribers == 0
+
+
+def test_full_text_search_ranks_and_pages(client):
+    add_orders([(f"Cliente {i}", f"c{i}@shop.it", 1, 4.0, "Pending", "Paid", "2026-10-01 10:00:00")
+                for i in range(12)])
+    with db.get_db_connection(write=True) as conn:
+        conn.execute("UPDATE orders SET message = 'regalo per Mario' WHERE id = 3")
+        conn.execute("UPDATE orders SET name = 'Mario Rossi', email = 'mario.rossi@gmail.com' WHERE id = 7")
+    headers = {"X-Admin-Token": TOKEN}
+    client.post("/api/orders/5/notes", json={"notes": "chiamare Mario"}, headers=headers)
+
+    def ids(url):
+        return [o["id"] for o in client.get(url, headers=headers).get_json()["orders"]]
+
+    # Name beats notes beats message; words match as prefixes, in any field
+    assert ids("/api/orders/search?q=mar") == [7, 5, 3]
+    assert ids("/api/orders/search?q=rossi@gmail") == [7]
+    assert ids("/api/orders/search?q=mario&status=Done") == []
+    # An order number comes first, ahead of text matches
+    assert ids("/api/orders/search?q=%2311")[0] == 11
+
+    seen, cursor = [], None
+    while True:
+        page = client.get("/api/orders/search?q=cliente&limit=5&fields=name" + (f"&cursor={cursor}" if cursor else ""),
+                          headers=headers).get_json()
+        seen += [o["id"] for o in page["orders"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert sorted(seen) == [i for i in range(1, 13) if i != 7]
+
+
+def test_stats_rollups_follow_writes_and_match_a_rebuild(client, tmp_path, monkeypatch):
+    add_orders([("a", "a@x.it", 3, 12.0, "Pending", "Paid", "2026-10-01 10:00:00"),
+                ("b", "b@x.it", 1, 4.0, "Pending", "Unpaid", "2026-10-02 10:00:00")])
+    stats.rebuild()
+    headers = {"X-Admin-Token": TOKEN}
+
+    # A paid order arriving through the webhook (no conversion needed for .stl)
+    monkeypatch.setattr(server, "STRIPE_WEBHOOK_SECRET", "")
+    upload = tmp_path / "temp.stl"
+    upload.write_bytes(b"solid x")
+    monkeypatch.setattr(server, "EXPORT_DIR", str(tmp_path / "exports"))
+    session = {"id": "cs_test_1", "metadata": {"temp_file_path": str(upload), "temp_filename": "temp.stl",
+               "name": "c", "email": "c@x.it", "quantity": "2", "total_price": "8.0"}}
+    assert client.post("/api/webhook", json={"type": "checkout.session.completed",
+                                             "data": {"object": session}}).status_code == 200
+    assert jobs.run_one("w1")  # The webhook only records the event; its job creates the order
+    client.post("/api/orders/1/status", json={"status": "Done"}, headers=headers)
+
+    live = client.get("/api/admin/stats", headers=headers).get_json()
+    assert live["total_orders"] == 3 and live["total_stamps"] == 6 and live["total_revenue"] == 20.0
+    assert live["orders_by_status"] == {"Done": 1, "Pending": 1, "Processing": 1}
+    assert live["orders_by_payment"] == {"Paid": 2, "Unpaid": 1}
+    assert live["today_orders"] == 1
+    # "Today" in the ETag is the stats query's day (UTC), not the host's local date
+    etag = client.get("/api/admin/stats", headers=headers).headers["ETag"]
+    assert etag.strip('"').endswith(str(datetime.datetime.now(datetime.timezone.utc).date()))
+
+    stats.rebuild()
+    assert client.get("/api/admin/stats", headers=headers).get_json() == live
+
+
+def test_export_streams_filtered_csv_and_gzip(client, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_CHUNK_ROWS", 4)
+    add_orders([(f"n{i}", f"{i}@x.it", 1, 4.0, "Done" if i % 2 else "Pending", "Paid",
+                 f"2026-10-0{1 + i % 3} 10:00:00") for i in range(15)])
+
+    response = client.get(f"/api/orders/export?status=Done&date_from=2026-10-02&token={TOKEN}", buffered=False)
+    assert response.mimetype == "text/csv"
+    chunks = list(response.response)
+    assert len(chunks) > 2  # header, then one chunk per fetch
+    rows = list(csv.reader(io.StringIO("".join(c.decode() if isinstance(c, bytes) else c for c in chunks))))
+    assert rows[0][:3] == ["ID", "Name", "Email"]
+    assert rows[1:] and all(r[6] == "Done" and r[8] >= "2026-10-02" for r in rows[1:])
+
+    packed = client.get(f"/api/orders/export?gzip=1&token={TOKEN}")
+    assert packed.headers["Content-Disposition"].endswith(".csv.gz")
+    assert len(gzip.decompress(packed.data).decode().splitlines()) == 16
+
+    assert client.get(f"/api/orders/export?date_to=yesterday&token={TOKEN}").status_code == 400
+
+
+def test_bulk_update_applies_in_one_transaction(client):
+    add_orders([(f"n{i}", f"{i}@x.it", 1, 4.0, "Pending", "Paid", "2026-10-01 10:00:00") for i in range(5)])
+    stats.rebuild()
+    headers = {"X-Admin-Token": TOKEN}
+
+    res = client.post("/api/orders/bulk?fields=status,notes", headers=headers,
+                      json={"ids": [1, 2, 3, 3, 99], "status": "Done", "notes": "spedito"})
+    body = res.get_json()
+    assert res.status_code == 200 and body["missing"] == [99]
+    assert [(o["id"], o["status"], o["notes"]) for o in body["orders"]] == [(3, "Done", "spedito"),
+                                                                            (2, "Done", "spedito"),
+                                                                            (1, "Done", "spedito")]
+    live = client.get("/api/admin/stats", headers=headers).get_json()
+    assert live["orders_by_status"] == {"Done": 3, "Pending": 2}
+
+    # Notes only: status untouched
+    res = client.post("/api/orders/bulk", headers=headers, json={"ids": [4], "notes": ""})
+    assert res.get_json()["orders"][0]["status"] == "Pending"
+
+    assert client.post("/api/orders/bulk", headers=headers, json={"ids": [1]}).status_code == 400
+    assert client.post("/api/orders/bulk", headers=headers, json={"ids": "1", "status": "Done"}).status_code == 400
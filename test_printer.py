@@ -0,0 +1,169 @@
+import os
+import shutil
+import time
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import pytest
+
+import artifacts
+import db
+import migrations
+import printer
+import scheduler
+import server
+from mock_printer import MockPrinterServer
+
+pytestmark = pytest.mark.skipif(not shutil.which("openssl"), reason="mock printer needs the openssl CLI")
+
+TOKEN = "test-admin-token"
+MESH = b"solid x\n" + b"facet normal 0 0 1\n outer loop\n vertex 0 0 0\n endloop\nendfacet\n" * 20000
+
+
+@pytest.fixture
+def mock_printer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    monkeypatch.setattr(printer, "PRINTER_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(printer, "PRINTER_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(printer, "PRINTER_SESSION_IDLE_SECONDS", 0.5)
+    migrations.migrate()
+    os.makedirs("exports/2026-10-01")
+
+    srv = MockPrinterServer(fail_after=300_000).start()
+    client = printer.PrinterClient(host="127.0.0.1", port=srv.port, access_code=srv.access_code, timeout=5)
+    uploader = printer.Uploader("default", client)
+    monkeypatch.setattr(printer, "REGISTRY", {"default": {"host": "127.0.0.1", "port": srv.port,
+                                                          "access_code": srv.access_code}})
+    monkeypatch.setitem(printer._uploaders, "default", uploader)
+    yield srv
+    while uploader._thread is not None:  # Idles out and closes the session
+        time.sleep(0.05)
+    srv.stop()
+
+
+def add_order(name):
+    path = f"exports/2026-10-01/{name}"
+    with open(path, "wb") as f:
+        f.write(MESH)
+    artifacts.store(path)
+    with db.get_db_connection(write=True) as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO orders (name, email, filepath) VALUES ('n', 'n@x.it', ?)", (path,))
+        return c.lastrowid
+
+
+def wait_for(job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = printer.get_job(job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} still {job['status']}")
+
+
+def test_upload_is_queued_resumed_and_reuses_the_session(mock_printer):
+    api = server.app.test_client()
+    first, second = add_order("one.stl"), add_order("two.stl")
+
+    queued = api.post(f"/api/printer/upload/{first}?token={TOKEN}")
+    assert queued.status_code == 202 and queued.get_json()["job"]["status"] in ("queued", "uploading")
+    job = wait_for(queued.get_json()["job"]["id"])
+
+    # The first transfer was cut off; the retry picked up from the printer's partial copy
+    assert job["status"] == "done" and job["attempts"] == 2
+    assert job["bytes_sent"] == job["bytes_total"] == len(MESH)
+    assert mock_printer.files["one.stl"] == MESH and "REST" in mock_printer.commands
+
+    mock_printer.fail_after = None
+    logins = mock_printer.logins
+    job = wait_for(api.post(f"/api/printer/upload/{second}?token={TOKEN}").get_json()["job"]["id"])
+    assert job["status"] == "done" and job["attempts"] == 1 and mock_printer.files["two.stl"] == MESH
+    assert mock_printer.logins == logins  # Same FTPS session as the previous job
+
+    listed = api.get(f"/api/printer/jobs?order_id={second}&token={TOKEN}").get_json()["jobs"]
+    assert [j["id"] for j in listed] == [job["id"]]
+    assert api.get(f"/api/printer/jobs/{job['id']}?token={TOKEN}").get_json()["status"] == "done"
+    assert api.get(f"/api/printer/jobs/999?token={TOKEN}").status_code == 404
+
+
+def test_missing_file_fails_without_retrying(mock_printer):
+    job = printer.enqueue(1, "exports/2026-10-01/gone.stl")
+    job = wait_for(job["id"])
+    assert job["status"] == "failed" and job["attempts"] == 1 and "gone.stl" in job["error"]
+
+
+@pytest.fixture
+def farm(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    monkeypatch.setattr(printer, "REGISTRY", printer.parse_registry("p1=10.0.0.1/a,p2=10.0.0.2:9990/b"))
+    monkeypatch.setattr(scheduler, "SCHEDULER_AUTO_DISPATCH", True)
+    monkeypatch.setattr(scheduler, "_wake", lambda assigned: None)  # Plan only; nothing is uploaded
+    migrations.migrate()
+    os.makedirs("exports/2026-10-01")
+    return server.app.test_client()
+
+
+def ready_order(name, quantity):
+    order_id = add_order(name)
+    with db.get_db_connection(write=True) as conn:
+        conn.execute("UPDATE orders SET status = 'Processing', payment_status = 'Paid', quantity = ? WHERE id = ?",
+                     (quantity, order_id))
+    return order_id
+
+
+def test_dispatch_balances_by_finish_time_and_moves_work_off_disabled_printers(farm):
+    assert printer.REGISTRY["p2"] == {"host": "10.0.0.2", "port": 9990, "access_code": "b"}
+    big, small, third = ready_order("big.stl", 8), ready_order("small.stl", 1), ready_order("third.stl", 1)
+
+    dispatched = farm.post(f"/api/printers/dispatch?token={TOKEN}").get_json()["dispatched"]
+    placed = {d["order_id"]: d["printer"] for d in dispatched}
+    # The long print takes one printer; both short ones queue on the other, which frees up sooner
+    assert placed == {big: "p1", small: "p2", third: "p2"}
+    assert farm.post(f"/api/printers/dispatch?token={TOKEN}").get_json()["dispatched"] == []
+
+    overview = farm.get(f"/api/printers?token={TOKEN}").get_json()
+    p1, p2 = overview["printers"]
+    assert (p1["queue"], p2["queue"]) == (1, 2) and overview["waiting"] == 0
+    assert p1["backlog_seconds"] == pytest.approx(scheduler.estimate_seconds(8), abs=5)
+    assert [job["order_id"] for job in overview["plan"] if job["printer"] == "p2"] == [small, third]
+
+    # Disabling p2 cancels its queued uploads and re-plans them on p1, after the long print
+    moved = farm.post(f"/api/printers/p2?token={TOKEN}", json={"enabled": False}).get_json()
+    assert moved["dispatched"] == 2
+    p1, p2 = farm.get(f"/api/printers?token={TOKEN}").get_json()["printers"]
+    assert (p1["queue"], p2["queue"], p2["enabled"]) == (3, 0, False)
+    assert farm.post(f"/api/printer/upload/{small}?token={TOKEN}", json={"printer": "nope"}).status_code == 400
+
+    # Finishing an order ends its print window now, so p1 frees up earlier
+    backlog = p1["backlog_seconds"]
+    farm.post(f"/api/orders/bulk?token={TOKEN}", json={"ids": [third], "status": "Done"})
+    p1 = farm.get(f"/api/printers?token={TOKEN}").get_json()["printers"][0]
+    assert p1["backlog_seconds"] == pytest.approx(backlog - scheduler.estimate_seconds(1), abs=5)
+    farm.post(f"/api/orders/bulk?token={TOKEN}", json={"ids": [big, small], "status": "Done"})
+    p1 = farm.get(f"/api/printers?token={TOKEN}").get_json()["printers"][0]
+    assert p1["backlog_seconds"] <= 0
+
+    # Utilization: busy share of the last 24 hours
+    with db.get_db_connection(write=True) as conn:
+        printer.insert_job(conn.cursor(), big, "exports/2026-10-01/big.stl", "p2",
+                           print_start_at=scheduler._stamp(time.time() - 6 * 3600),
+                           print_end_at=scheduler._stamp(time.time() - 3 * 3600))
+        conn.execute("UPDATE printer_jobs SET status = 'done' WHERE printer = 'p2' AND status = 'queued'")
+    assert farm.get(f"/api/printers?token={TOKEN}").get_json()["printers"][1]["utilization"] == 0.125
+
+
+def test_an_order_whose_upload_fails_for_good_moves_to_another_printer(farm, monkeypatch):
+    monkeypatch.setattr(printer, "PRINTER_MAX_ATTEMPTS", 1)
+    order = ready_order("one.stl", 1)
+    ((_, first, job_id),) = scheduler.dispatch()
+
+    # The uploader gives up: that printer cools down and the order is placed on the other at once
+    job = {**printer.get_job(job_id), "attempts": 1}
+    printer.Uploader(first, client=object())._failed(job, ConnectionRefusedError("refused"), 0)
+    (retry,) = [job for job in printer.list_jobs(order) if job["status"] == "queued"]
+    assert retry["printer"] == ({"p1", "p2"} - {first}).pop()
@@ -0,0 +1,44 @@
+import logging
+import os
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import db
+import metrics
+import migrations
+import querylog
+import server
+
+
+def test_slow_queries_are_logged_normalized_and_redacted(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    migrations.migrate()
+    monkeypatch.setattr(querylog, "DB_SLOW_QUERY_MS", 0)
+    monkeypatch.setattr(querylog, "DB_EXPLAIN_SLOW_QUERIES", True)
+
+    with caplog.at_level(logging.WARNING), db.get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id FROM orders\n  WHERE email = ? AND status = 'Pending' AND id IN (?, ?, ?) LIMIT 5",
+                  ("mario.rossi@gmail.com", 1, 2, 3))
+        assert c.fetchall() == []
+
+    message = caplog.records[-1].getMessage()
+    assert "SELECT id FROM orders WHERE email = ? AND status = ? AND id IN (?, ...) LIMIT ?" in message
+    assert "params=['<str:21>', '<int>', '<int>', '<int>']" in message
+    assert "mario" not in message and "Pending" not in message
+    assert "orders" in message.splitlines()[1]  # The plan follows the statement
+
+
+def test_queries_are_counted_per_request(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "t")
+    migrations.migrate()
+    metrics.reset()
+
+    server.app.test_client().get("/api/orders?token=t")
+
+    counts = metrics.snapshot()["histograms"][("db_queries_per_request", ())]
+    assert counts["count"] == 1 and counts["sum"] >= 1
+    timed = [k for k in metrics.snapshot()["histograms"] if k[0] == "db_query_seconds"]
+    assert (("backend", "sqlite"), ("op", "SELECT")) in [labels for _, labels in timed]
+    metrics.reset()
@@ -0,0 +1,24 @@
+import time
+
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+
+import ratelimit  # noqa: F401  (registers sqlite://)
+
+
+def test_workers_share_one_count_and_windows_expire(tmp_path, monkeypatch):
+    uri = f"sqlite:///{tmp_path / 'rl.db'}"
+    # Two storages on one file stand in for two gunicorn workers
+    first, second = FixedWindowRateLimiter(storage_from_string(uri)), FixedWindowRateLimiter(storage_from_string(uri))
+    limit = parse("3 per minute")
+    assert first.hit(limit, "1.2.3.4") and second.hit(limit, "1.2.3.4") and first.hit(limit, "1.2.3.4")
+    assert not second.hit(limit, "1.2.3.4")
+    assert second.hit(limit, "5.6.7.8")  # Other clients keep their own count
+    assert first.get_window_stats(limit, "1.2.3.4").remaining == 0
+
+    now = time.time()
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now + 61)
+    assert second.hit(limit, "1.2.3.4")  # A new window starts over
+    assert second.storage.get(limit.key_for("1.2.3.4")) == 1
+    assert second.storage.reset() == 1  # The other client's expired counter was swept
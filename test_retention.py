@@ -0,0 +1,52 @@
+import json
+import os
+import time
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import db
+import migrations
+import retention
+
+NOW = time.mktime((2026, 10, 19, 12, 0, 0, 0, 0, -1))
+
+
+def touch(path, size, age_hours):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (NOW - age_hours * 3600,) * 2)
+
+
+def test_sweep_expires_abandoned_uploads_and_old_exports_but_keeps_live_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    migrations.migrate()
+    touch("exports/temp/2026-10-17/abandoned.png", 100, 48)
+    touch("exports/temp/2026-10-17/paid.png", 10, 48)  # Payment recorded, order not created yet
+    touch("exports/temp/2026-10-19/fresh.png", 10, 1)
+    touch("exports/2026-08-01/done.png", 1000, 80 * 24)
+    touch("exports/2026-08-01/done.stl.gz", 500, 80 * 24)
+    touch("exports/2026-08-02/open.png", 10, 79 * 24)
+    touch("exports/2026-08-02/open.stl.gz", 10, 79 * 24)  # Logical path open.stl in the orders table
+    touch("exports/2026-10-18/recent.png", 10, 24)
+    with db.get_db_connection(write=True) as conn:
+        conn.executemany("INSERT INTO orders (name, status, filepath, original_filepath) VALUES (?, ?, ?, ?)", [
+            ("a", "Done", "exports/2026-08-01/done.stl", "exports/2026-08-01/done.png"),
+            ("b", "Processing", "exports/2026-08-02/open.stl", "exports/2026-08-02/open.png"),
+        ])
+        event = {"data": {"object": {"metadata": {"temp_file_path": "exports/temp/2026-10-17/paid.png"}}}}
+        conn.execute("INSERT INTO stripe_events (event_id, type, session_id, payload, received_at) "
+                     "VALUES ('evt_1', 'checkout.session.completed', 'cs_1', ?, '2026-10-17 10:00:00')",
+                     (json.dumps(event),))
+
+    preview = retention.sweep("exports", dry_run=True, now=NOW)
+    assert preview["temp"]["files"] == 1 and os.path.exists("exports/temp/2026-10-17/abandoned.png")
+
+    reports = retention.sweep("exports", now=NOW)
+    assert reports["temp"] == {"files": 1, "bytes": 100, "dirs": 0, "kept_dirs": 1}
+    assert reports["exports"] == {"files": 2, "bytes": 1500, "dirs": 1, "kept_dirs": 1}
+    left = sorted(os.path.join(root, f) for root, _, files in os.walk("exports") for f in files)
+    assert left == ["exports/2026-08-02/open.png", "exports/2026-08-02/open.stl.gz",
+                    "exports/2026-10-18/recent.png", "exports/temp/2026-10-17/paid.png",
+                    "exports/temp/2026-10-19/fresh.png"]
@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import threading
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import db
+import server
+
+PROCESSES = 4
+THREADS = 4
+ORDERS_PER_THREAD = 25
+
+
+def _worker(db_file, worker_id, errors):
+    db.DB_FILE = db_file
+
+    def write_orders(thread_id):
+        for i in range(ORDERS_PER_THREAD):
+            try:
+                with db.get_db_connection(write=True) as conn:
+                    c = conn.cursor()
+                    c.execute(
+                        "INSERT INTO orders (name, email, quantity, total_price, payment_status, status) "
+                        "VALUES (?, ?, ?, ?, 'Paid', 'Processing')",
+                        (f"w{worker_id}-t{thread_id}", f"{i}@test.local", 10, 40.0))
+                    order_id = c.lastrowid
+                # Admin-style update racing the inserts
+                with db.get_db_connection(write=True) as conn:
+                    conn.cursor().execute("UPDATE orders SET status = 'Done' WHERE id = ?", (order_id,))
+                with db.get_db_connection() as conn:
+                    conn.cursor().execute("SELECT COUNT(*) FROM orders").fetchone()
+            except Exception as e:
+                errors.put(repr(e))
+
+    threads = [threading.Thread(target=write_orders, args=(t,)) for t in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_many_workers_write_orders_without_lock_errors(tmp_path):
+    db_file = str(tmp_path / "orders.db")
+    db.DB_FILE = db_file
+    try:
+        server.init_db()
+
+        ctx = multiprocessing.get_context("fork")
+        errors = ctx.Queue()
+        procs = [ctx.Process(target=_worker, args=(db_file, w, errors)) for w in range(PROCESSES)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join(60)
+            assert p.exitcode == 0
+
+        failures = []
+        while not errors.empty():
+            failures.append(errors.get())
+        assert failures == []
+
+        with db.get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT COUNT(*) AS n, SUM(status = 'Done') AS done FROM orders")
+            row = c.fetchone()
+            assert row["n"] == PROCESSES * THREADS * ORDERS_PER_THREAD
+            assert row["done"] == row["n"]
+            assert c.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    finally:
+        db.DB_FILE = "orders.db"
@@ -0,0 +1,121 @@
+import gzip
+import io
+import os
+import shutil
+import time
+
+os.environ.setdefault("INIT_DB_ON_STARTUP", "false")
+
+import pytest
+
+import artifacts
+import db
+import migrations
+import printer
+import retention
+import server
+import storage
+from mock_printer import MockPrinterServer
+from mock_s3 import MockS3Server
+
+TOKEN = "test-admin-token"
+MESH = b"solid x\n" + b"facet normal 0 0 1\n outer loop\n vertex 0 0 0\n endloop\nendfacet\n" * 2000
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "orders.db"))
+    migrations.migrate()
+    mock = MockS3Server().start()
+    backend = storage.configure("s3", bucket="orders", endpoint_url=mock.url, region="us-east-1",
+                                access_key="test", secret_key="test")
+    backend.part_size = 64 * 1024  # Below S3's 5 MiB minimum, to get several parts cheaply
+    try:
+        yield mock
+    finally:
+        storage.configure("local")
+        mock.stop()
+
+
+class Failing(io.BytesIO):
+    def read(self, n=-1):
+        if self.tell() >= 100 * 1024:
+            raise IOError("client went away")
+        return super().read(n)
+
+
+def test_s3_backend_streams_multipart_and_serves_artifacts(s3):
+    upload = os.urandom(200 * 1024)
+    assert storage.save("exports/temp/2026-10-01/a.png", io.BytesIO(upload)) == len(upload)
+    assert s3.completed_uploads == [("exports/temp/2026-10-01/a.png", 4)]
+    with pytest.raises(IOError):
+        storage.save("exports/temp/2026-10-01/b.png", Failing(upload))
+    assert s3.aborted_uploads == 1 and not storage.exists("exports/temp/2026-10-01/b.png")
+
+    storage.move("exports/temp/2026-10-01/a.png", "exports/2026-10-01/a.png")
+    assert s3.objects("orders") == {"exports/2026-10-01/a.png": upload}
+    with storage.local_copy("exports/2026-10-01/a.png") as local:
+        assert open(local, "rb").read() == upload
+    assert not os.path.exists(local)
+
+    # A converted mesh: compressed locally, then moved into the bucket
+    with open("logo.stl", "wb") as f:
+        f.write(MESH)
+    storage.put_file("exports/2026-10-01/logo.stl.gz", artifacts.store("logo.stl"))
+    assert not os.path.exists("logo.stl.gz")
+    path = "exports/2026-10-01/logo.stl"
+    assert artifacts.locate(path) == (path + ".gz", True) and artifacts.size(path) == len(MESH)
+    with artifacts.open_artifact(path) as f:
+        assert f.read() == MESH
+
+    client = server.app.test_client()
+    raw = client.get(f"/api/download?path={path}&token={TOKEN}", headers={"Accept-Encoding": "gzip"})
+    assert raw.headers["Content-Encoding"] == "gzip" and gzip.decompress(raw.data) == MESH
+    plain = client.get(f"/api/download?path={path}&token={TOKEN}", headers={"Accept-Encoding": "identity"})
+    assert plain.data == MESH
+    assert client.get(f"/api/download?path=exports/2026-10-01/a.png&token={TOKEN}").data == upload
+
+
+def test_retention_sweeps_the_bucket(s3):
+    storage.save("exports/temp/2026-10-01/abandoned.png", io.BytesIO(b"x" * 10))
+    storage.save("exports/2026-08-01/done.png", io.BytesIO(b"x" * 20))
+    storage.save("exports/2026-08-01/open.png", io.BytesIO(b"x" * 30))
+    with db.get_db_connection(write=True) as conn:
+        conn.execute("INSERT INTO orders (name, status, original_filepath) VALUES ('o', 'Processing', ?)",
+                     ("exports/2026-08-01/open.png",))
+
+    reports = retention.sweep("exports", now=time.mktime((2026, 10, 19, 12, 0, 0, 0, 0, -1)))
+    assert reports["temp"]["bytes"] == 10 and reports["exports"]["bytes"] == 20
+    assert list(s3.objects("orders")) == ["exports/2026-08-01/open.png"]
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="mock printer needs the openssl CLI")
+def test_printer_uploads_resume_from_the_bucket(s3, monkeypatch):
+    monkeypatch.setattr(printer, "PRINTER_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(printer, "PRINTER_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(printer, "PRINTER_SESSION_IDLE_SECONDS", 0.5)
+    mesh = MESH * 10
+    # An uncompressed STL (ARTIFACT_COMPRESSION=none, or moved from disk) and a compressed one
+    storage.save("exports/2026-10-01/plain.stl", io.BytesIO(mesh))
+    storage.save("exports/2026-10-01/packed.stl.gz", io.BytesIO(gzip.compress(mesh)))
+
+    srv = MockPrinterServer(fail_after=300_000).start()
+    client = printer.PrinterClient(host="127.0.0.1", port=srv.port, access_code=srv.access_code, timeout=5)
+    uploader = printer.Uploader("default", client)
+    monkeypatch.setitem(printer._uploaders, "default", uploader)
+    try:
+        for name in ("plain.stl", "packed.stl"):
+            srv.fail_after = 300_000  # Cut the first transfer off, so the retry resumes mid-file
+            job = printer.enqueue(1, f"exports/2026-10-01/{name}")
+            deadline = time.monotonic() + 10
+            while printer.get_job(job["id"])["status"] not in ("done", "failed") and time.monotonic() < deadline:
+                time.sleep(0.05)
+            job = printer.get_job(job["id"])
+            assert job["status"] == "done" and job["attempts"] == 2, job["error"]
+            assert srv.files[name] == mesh
+    finally:
+        while uploader._thread is not None:
+            time.sleep(0.05)
+        srv.stop()
@@ -0,0 +1,60 @@
+import pytest
+
+import metrics
+import stripe
+import stripe_client
+from mock_stripe import MockStripeServer
+
+
+@pytest.fixture(autouse=True)
+def stripe_config(monkeypatch):
+    # configure() sets these globals; put back whatever the next test module expects
+    for name in ("api_key", "api_base", "max_network_retries", "default_http_client"):
+        monkeypatch.setattr(stripe, name, getattr(stripe, name))
+
+
+def test_checkout_sessions_reuse_pooled_connection():
+    server = MockStripeServer().start()
+    try:
+        stripe_client.configure("sk_test_mock", api_base=server.url, max_retries=0)
+        metrics.reset()
+
+        first = stripe_client.create_checkout_session(
+            mode='payment',
+            success_url='http://localhost/success.html',
+            cancel_url='http://localhost/cancel.html',
+            metadata={'name': 'Mario', 'quantity': '50'},
+        )
+        second = stripe_client.create_checkout_session(mode='payment', metadata={})
+
+        assert first.id.startswith("cs_test_")
+        assert first.metadata['name'] == 'Mario'
+        assert second.id != first.id
+        # Both calls went over a single keep-alive connection
+        assert server.requests == 2
+        assert server.connections == 1
+
+        histograms = metrics.snapshot()["histograms"]
+        key = ("stripe_request_seconds", (("operation", "checkout.session.create"), ("outcome", "ok")))
+        assert histograms[key]["count"] == 2
+    finally:
+        server.stop()
+
+
+def test_read_timeout_is_bounded():
+    server = MockStripeServer(latency=1.0).start()
+    try:
+        stripe_client.configure("sk_test_mock", api_base=server.url, read_timeout=0.2, max_retries=0)
+        metrics.reset()
+        try:
+            stripe_client.create_checkout_session(mode='payment')
+            assert False, "Expected a timeout"
+        except stripe.error.APIConnectionError:
+            pass
+
+        histograms = metrics.snapshot()["histograms"]
+        key = ("stripe_request_seconds", (("operation", "checkout.session.create"), ("outcome", "APIConnectionError")))
+        assert histograms[key]["count"] == 1
+        assert histograms[key]["sum"] < 1.0
+    finally:
+        server.stop()
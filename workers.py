@@ -0,0 +1,97 @@
+"""
+On-demand worker threads for the background queues (jobs, mail, printer uploads).
+
+Each queue has one thread per process, started by `wake()` when work is
+committed. The thread runs `step()` until a call finds nothing to do, then
+polls. After `idle_seconds()` without work, it calls `on_idle()` (to close
+its session). It exits only if `next_due()` reports no scheduled work, such
+as a retry waiting out its backoff. Otherwise it sleeps until that work is
+due, so retries never depend on an unrelated wake-up. The next `wake()`
+after an exit starts a fresh thread.
+
+`wake()` sets the event while holding the lock, and the idle exit checks the
+event under the same lock. So a wake-up cannot slip in between the check and
+the exit and get lost.
+"""
+
+import time
+import logging
+import datetime
+import threading
+
+
+def seconds_until(stamp):
+    """Seconds from now to a stored UTC timestamp (str on SQLite, datetime on PostgreSQL); None stays None."""
+    if stamp is None:
+        return None
+    if isinstance(stamp, str):
+        stamp = datetime.datetime.fromisoformat(stamp)
+    return stamp.replace(tzinfo=datetime.timezone.utc).timestamp() - time.time()
+
+
+class OnDemandWorker:
+    """Base class: subclasses implement `step()` and the timing hooks."""
+
+    thread_name = "worker"
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def idle_seconds(self):
+        """How long the thread lingers without work before exiting."""
+        raise NotImplementedError
+
+    def poll_interval(self):
+        raise NotImplementedError
+
+    def step(self):
+        """Process some due work; return True if there was any."""
+        raise NotImplementedError
+
+    def on_idle(self):
+        """Called once the thread has been idle for `idle_seconds()` (e.g. to close a session)."""
+
+    def next_due(self):
+        """Seconds until the earliest scheduled (not yet due) work, or None if there is none."""
+        return None
+
+    def describe_error(self, error):
+        return f"{self.thread_name}: could not claim work: {error}"
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+            self._wake.set()
+
+    def _run(self):
+        idle_since = time.monotonic()
+        while True:
+            try:
+                worked = self.step()
+            except Exception as e:
+                logging.warning(self.describe_error(e))
+                worked = False
+            if worked:
+                idle_since = time.monotonic()
+                continue
+            wait = self.poll_interval()
+            if time.monotonic() - idle_since > self.idle_seconds():
+                self.on_idle()
+                try:
+                    due = self.next_due()
+                except Exception as e:
+                    logging.warning(self.describe_error(e))
+                    due = 0.0  # Unknown: keep polling rather than strand anything
+                if due is None:
+                    with self._lock:
+                        if not self._wake.is_set():  # Otherwise work arrived meanwhile
+                            self._thread = None
+                            return
+                else:
+                    wait = max(due, wait)
+            self._wake.wait(wait)
+            self._wake.clear()